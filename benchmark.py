@@ -0,0 +1,425 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+# bot.py reads these at import time
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('OWNER_ID', '0')
+
+import bot
+from telegram import Chat, Message, Update, User
+from telegram.constants import ChatType
+
+# Synthetic dataset shaped like bot_data
+def make_dataset(users: int, cards: int, cards_per_user: int, seed: int = 1, groups: int = 0) -> dict:
+    rng = random.Random(seed)
+    rarities = list(bot.RARITIES)
+    data = bot.empty_data()
+    for cid in range(1, cards + 1):
+        data['cards'][str(cid)] = {
+            'name': f'Card {cid}',
+            'movie': f'Movie {cid % 97}',
+            'rarity': rng.choice(rarities),
+            'file_id': f'AgACAgUAAxkBAAI{cid:012d}',
+            'type': 'image',
+            'created_at': '2024-01-01T00:00:00'
+        }
+    for uid in range(users):
+        owned = rng.sample(range(1, cards + 1), min(cards, rng.randint(0, cards_per_user * 2)))
+        data['users'][str(100000000 + uid)] = {
+            'username': f'user{uid}',
+            'cards': {str(c): rng.randint(1, 3) for c in owned},
+            'balance': rng.randint(0, 100000),
+            'last_daily': None,
+            'favorite_cards': [],
+            'titles': [],
+            'married_to': None,
+            'inventory': {},
+            'completed_missions': []
+        }
+    for gid in range(groups):
+        data['groups'][str(-1001000000000 - gid)] = {
+            'title': f'Group {gid}',
+            'message_count': rng.randint(0, 49),
+            'last_drop': None
+        }
+    return data
+
+# Load one snapshot in a fresh interpreter and report time and peak RSS.
+# mode 'json_load' is the plain json.load path bot.py used before snapshots
+# went through read_snapshot_file()
+LOAD_SCRIPT = """
+import sys, time, json
+sys.path.insert(0, sys.argv[3])
+import bot
+start = time.perf_counter()
+if sys.argv[2] == 'json_load':
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        json.load(f)
+else:
+    bot.read_snapshot_file(sys.argv[1])
+elapsed = time.perf_counter() - start
+# VmHWM is reset by exec, unlike ru_maxrss which keeps the parent's peak
+with open('/proc/self/status') as f:
+    rss = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+print(elapsed, rss)
+"""
+
+def measure_load(path: str, mode: str) -> dict:
+    out = subprocess.check_output([
+        sys.executable, '-c', LOAD_SCRIPT, path, mode,
+        os.path.dirname(os.path.abspath(__file__))
+    ])
+    elapsed, rss = out.split()
+    return {'load_seconds': round(float(elapsed), 4), 'peak_rss_kb': int(rss)}
+
+def bench_snapshot(args) -> dict:
+    data = make_dataset(args.users, args.cards, args.cards_per_user)
+    json_path = os.path.join(args.dir, 'bench_data.json')
+    bin_path = os.path.join(args.dir, 'bench_data.bin')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    bot.convert_snapshot(json_path, bin_path)
+    assert bot.read_snapshot_file(bin_path) == data
+    del data
+    results = {}
+    for name, path in (('json_load', json_path), ('json', json_path), ('binary', bin_path)):
+        results[name] = measure_load(path, name)
+        results[name]['file_bytes'] = os.path.getsize(path)
+    os.remove(json_path)
+    os.remove(bin_path)
+    return results
+
+# Load a snapshot in a fresh interpreter and report resident memory with
+# plain dict users ('dict', json.load) or the UserRecord/CardInventory
+# records read_snapshot_file() builds ('compact')
+MEMORY_SCRIPT = """
+import sys, time, gc, json
+sys.path.insert(0, sys.argv[3])
+import bot
+start = time.perf_counter()
+if sys.argv[2] == 'dict':
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        data = json.load(f)
+else:
+    data = bot.read_snapshot_file(sys.argv[1])
+elapsed = time.perf_counter() - start
+gc.collect()
+with open('/proc/self/status') as f:
+    status = dict(line.split(':', 1) for line in f)
+print(elapsed, int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0]))
+"""
+
+def bench_memory(args) -> dict:
+    data = make_dataset(args.users, args.cards, args.cards_per_user)
+    path = os.path.join(args.dir, 'bench_memory.json')
+    bot.write_snapshot_file(path, data, indent=None)
+    del data
+    results = {'users': args.users, 'file_bytes': os.path.getsize(path)}
+    try:
+        for mode in ('dict', 'compact'):
+            out = subprocess.check_output([
+                sys.executable, '-c', MEMORY_SCRIPT, path, mode,
+                os.path.dirname(os.path.abspath(__file__))
+            ])
+            elapsed, rss, peak = out.split()
+            results[mode] = {
+                'load_seconds': round(float(elapsed), 3),
+                'rss_kb': int(rss),
+                'peak_rss_kb': int(peak)
+            }
+    finally:
+        os.remove(path)
+    results['rss_reduction_pct'] = round(100 * (1 - results['compact']['rss_kb'] / results['dict']['rss_kb']), 1)
+    return results
+
+# Stub Bot: records outgoing API calls instead of hitting the network
+class StubBot:
+    def __init__(self):
+        self.calls = {}
+
+    def record(self, method: str, chat_id=None):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if chat_id is not None:
+            # Drops keep the sent message's id
+            return Message(self.calls[method], datetime.now(), Chat(int(chat_id), ChatType.SUPERGROUP))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.record('send_message')
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        return self.record('send_photo', chat_id)
+
+    async def send_video(self, chat_id, video, caption=None, **kwargs):
+        return self.record('send_video', chat_id)
+
+    async def edit_message_caption(self, chat_id=None, message_id=None, caption=None, **kwargs):
+        self.record('edit_message_caption')
+
+# Stand-in for CallbackContext with the attributes handlers use
+class StubContext:
+    def __init__(self, stub_bot: StubBot, chat_data: dict, args: list):
+        self.bot = stub_bot
+        self.chat_data = chat_data
+        self.args = args
+        self.application = None
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    n = len(samples)
+    def at(q):
+        return round(samples[min(n - 1, int(n * q))] * 1000, 4)
+    return {
+        'count': n,
+        'total_ms': round(sum(samples) * 1000, 2),
+        'p50_ms': at(0.50),
+        'p99_ms': at(0.99),
+        'max_ms': round(samples[-1] * 1000, 4)
+    }
+
+def peak_rss_kb() -> int:
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+
+def revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# Workload name -> (handler, args builder); args are built when the op runs
+# so /catch can guess the chat's live drop
+LOAD_HANDLERS = {
+    'group': (bot.handle_group_message, lambda rng, chat_data: []),
+    'catch': (bot.catch_card, lambda rng, chat_data: (
+        chat_data['last_drop']['card_name'].split()
+        if 'last_drop' in chat_data and rng.random() < 0.5 else ['wrong', 'name']
+    )),
+    'slots': (bot.slots, lambda rng, chat_data: [str(rng.choice((10, 100, 1000)))]),
+    'daily': (bot.daily, lambda rng, chat_data: []),
+    'top': (bot.top, lambda rng, chat_data: [str(rng.randint(1, 5))]),
+    'buy': (bot.buy, lambda rng, chat_data: [str(rng.randint(1, len(bot.SHOP_ITEMS)))]),
+}
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in LOAD_HANDLERS:
+            raise SystemExit(f"Unknown workload {name!r}, choose from {', '.join(LOAD_HANDLERS)}")
+        mix[name] = float(weight)
+    return mix
+
+# Synthetic updates: real telegram objects bound to the stub bot
+def make_updates(args, stub_bot: StubBot, user_ids: list, group_ids: list, rng) -> list:
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    users = {}
+    chats = {gid: Chat(int(gid), ChatType.SUPERGROUP, title=f'Group {gid}') for gid in group_ids}
+    now = datetime.now()
+    ops = []
+    for update_id, name in enumerate(rng.choices(names, [mix[n] for n in names], k=args.ops), 1):
+        uid = rng.choice(user_ids)
+        if uid not in users:
+            users[uid] = User(int(uid), f'User {uid}', False, username=f'user{uid}')
+        chat = chats[rng.choice(group_ids)]
+        message = Message(update_id, now, chat, from_user=users[uid],
+                          text='hello' if name == 'group' else f'/{name}')
+        message.set_bot(stub_bot)
+        ops.append((name, Update(update_id, message=message)))
+    return ops
+
+async def replay(ops: list, stub_bot: StubBot, concurrency: int, rng) -> tuple:
+    latencies = {name: [] for name in LOAD_HANDLERS}
+    chat_data = {}
+    queue = iter(ops)
+
+    async def worker():
+        for name, update in queue:
+            handler, build_args = LOAD_HANDLERS[name]
+            data = chat_data.setdefault(update.effective_chat.id, {})
+            context = StubContext(stub_bot, data, build_args(rng, data))
+            start = time.perf_counter()
+            await handler(update, context)
+            latencies[name].append(time.perf_counter() - start)
+
+    await bot.flusher.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await bot.flusher.stop()
+    return elapsed, latencies
+
+def bench_load(args) -> dict:
+    rng = random.Random(args.seed)
+    setup_start = time.perf_counter()
+    data = make_dataset(args.users, args.cards, args.cards_per_user, args.seed, groups=args.groups)
+    args.dir = os.path.abspath(args.dir)
+    workdir = tempfile.mkdtemp(prefix='bench_load_', dir=args.dir)
+    os.chdir(workdir)
+    bot.USER_CACHE_SIZE = args.cache_size
+    bot.storage = bot.create_storage(args.storage)
+    bot.flusher = bot.Flusher(args.flush_interval)
+    bot.pack_users(data['users'])
+    if bot.lazy_users():
+        # Store everything, then start from an empty user cache
+        bot.storage.save(data, ())
+        data = bot.storage.load()
+    bot.bot_data = data
+    bot.rebuild_indexes()
+
+    # Time save_data() on the event loop and storage writes on the writer thread
+    save_times, write_times = [], []
+    save_data, write_data = bot.save_data, bot.write_data
+    def timed_save(*keys, **kwargs):
+        start = time.perf_counter()
+        save_data(*keys, **kwargs)
+        save_times.append(time.perf_counter() - start)
+    def timed_write(keys, data=None):
+        start = time.perf_counter()
+        ok = write_data(keys, data)
+        write_times.append(time.perf_counter() - start)
+        return ok
+    bot.save_data, bot.write_data = timed_save, timed_write
+
+    stub_bot = StubBot()
+    ops = make_updates(args, stub_bot, list(data['users']), list(data['groups']), rng)
+    setup_seconds = time.perf_counter() - setup_start
+    baseline_rss = peak_rss_kb()
+
+    try:
+        elapsed, latencies = asyncio.run(replay(ops, stub_bot, args.concurrency, rng))
+        users = bot.bot_data['users']
+    finally:
+        bot.save_data, bot.write_data = save_data, write_data
+        os.chdir(args.dir)
+        shutil.rmtree(workdir)
+
+    return {
+        'revision': revision(),
+        'config': {
+            'users': args.users, 'groups': args.groups, 'cards': args.cards,
+            'ops': args.ops, 'mix': parse_mix(args.mix), 'concurrency': args.concurrency,
+            'storage': args.storage, 'flush_interval': args.flush_interval, 'seed': args.seed,
+            'cache_size': args.cache_size
+        },
+        'setup_seconds': round(setup_seconds, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_ops_per_sec': round(args.ops / elapsed, 1),
+        'handlers': {name: percentiles(samples) for name, samples in latencies.items() if samples},
+        'save_data': percentiles(save_times),
+        'storage_writes': percentiles(write_times),
+        'bot_calls': stub_bot.calls,
+        'user_cache': users.stats() if isinstance(users, bot.UserCache) else None,
+        'baseline_rss_kb': baseline_rss,
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+# Seeded battles straight through the duel simulator, no Telegram involved:
+# throughput, how often the team with more total power wins, and the win
+# rate of each rarity against the one below it
+def bench_duel(args) -> dict:
+    rng = random.Random(args.seed)
+    rarities = list(bot.RARITIES)
+    teams = [
+        [[rng.choice(rarities) for _ in range(args.team_size)] for _ in range(2)]
+        for _ in range(args.duels)
+    ]
+    start = time.perf_counter()
+    duels = [bot.simulate_duel(pair, args.seed + i) for i, pair in enumerate(teams)]
+    elapsed = time.perf_counter() - start
+
+    def power(team):
+        return sum(bot.CARD_HP[r] * bot.CARD_ATTACK[r] for r in team)
+    uneven = [(pair, duel) for pair, duel in zip(teams, duels) if power(pair[0]) != power(pair[1])]
+    stronger_wins = sum(
+        duel.winner == (0 if power(pair[0]) > power(pair[1]) else 1) for pair, duel in uneven
+    )
+    tiers = {}
+    for weaker, stronger in zip(rarities, rarities[1:]):
+        result = bot.simulate_duels([[stronger] * args.team_size, [weaker] * args.team_size],
+                                    args.tier_duels, args.seed)
+        tiers[f"{stronger}>{weaker}"] = round(100 * result['wins'][0] / args.tier_duels, 1)
+
+    return {
+        'revision': revision(),
+        'config': {'duels': args.duels, 'team_size': args.team_size,
+                   'tier_duels': args.tier_duels, 'seed': args.seed,
+                   'max_turns': bot.DUEL_MAX_TURNS},
+        'elapsed_seconds': round(elapsed, 3),
+        'duels_per_sec': round(args.duels / elapsed, 1),
+        'us_per_duel': round(elapsed / args.duels * 1e6, 2),
+        'avg_turns': round(sum(d.turn for d in duels) / args.duels, 2),
+        'draws': sum(d.winner is None for d in duels),
+        'stronger_team_win_pct': round(100 * stronger_wins / len(uneven), 1) if uneven else None,
+        'tier_win_pct': tiers
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Card Collection Bot benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('snapshot', help="JSON vs binary snapshot load time and peak RSS")
+    p.add_argument('--users', type=int, default=50000)
+    p.add_argument('--cards', type=int, default=2000)
+    p.add_argument('--cards-per-user', type=int, default=20)
+    p.add_argument('--dir', default='.')
+    p.set_defaults(func=bench_snapshot)
+
+    p = sub.add_parser('memory', help="Resident memory of dict vs compact user records")
+    p.add_argument('--users', type=int, default=500000)
+    p.add_argument('--cards', type=int, default=2000)
+    p.add_argument('--cards-per-user', type=int, default=20)
+    p.add_argument('--dir', default='.')
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser('load', help="Replay synthetic updates through the real handlers")
+    p.add_argument('--users', type=int, default=100000)
+    p.add_argument('--groups', type=int, default=1000)
+    p.add_argument('--cards', type=int, default=2000)
+    p.add_argument('--cards-per-user', type=int, default=20)
+    p.add_argument('--ops', type=int, default=100000)
+    p.add_argument('--mix', default='group=90,catch=3,slots=3,daily=2,top=1,buy=1',
+                   help="Workload weights, name=weight[,...] from: " + ', '.join(LOAD_HANDLERS))
+    p.add_argument('--concurrency', type=int, default=1,
+                   help="Updates in flight at once (CONCURRENT_UPDATES)")
+    p.add_argument('--storage', default=bot.STORAGE_MODE, choices=('json', 'journal', 'sqlite', 'sharded'))
+    p.add_argument('--flush-interval', type=float, default=bot.FLUSH_INTERVAL)
+    p.add_argument('--cache-size', type=int, default=bot.USER_CACHE_SIZE,
+                   help="Users kept in memory with --storage sqlite (0 = all)")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--dir', default='.', help="Where the temporary data directory is created")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser('duel', help="Duel simulator throughput and rarity balance")
+    p.add_argument('--duels', type=int, default=100000)
+    p.add_argument('--team-size', type=int, default=bot.DUEL_TEAM_SIZE)
+    p.add_argument('--tier-duels', type=int, default=2000,
+                   help="Duels per adjacent-rarity matchup")
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_duel)
+
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    args = parser.parse_args()
+    results = {'bench': args.bench, 'results': args.func(args)}
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,33 @@ import os
 import asyncio
 import random
 import json
+import sqlite3
+import sys
+import copy
+import zlib
+import re
+import math
+import unicodedata
+import itertools
+import uuid
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+import bisect
+import heapq
+import functools
+import time
+from contextlib import asynccontextmanager, contextmanager
+import gc
+import marshal
+import struct
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -13,7 +37,16 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from telegram.constants import ChatType
+from telegram.request import HTTPXRequest
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    TimedOut,
+)
 import logging
 
 # Setup logging
@@ -30,9 +63,118 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 OWNER_ID = int(os.getenv('OWNER_ID'))
 
+# Update delivery: 'polling', 'webhook' or 'cluster' (webhook front process
+# plus worker processes; both need python-telegram-bot[webhooks])
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Public base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# Updates processed in parallel (0 = one at a time)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 0))
+
+# Cluster mode: worker processes, seconds to wait for another worker's reply
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', os.cpu_count() or 2))
+CLUSTER_TIMEOUT = float(os.getenv('CLUSTER_TIMEOUT', 10))
+# Seconds between resends of unconfirmed cross-worker credits and trade
+# offers, and how long a worker remembers the request ids it has applied
+CREDIT_RETRY_INTERVAL = float(os.getenv('CREDIT_RETRY_INTERVAL', 30))
+CREDIT_KEEP_HOURS = float(os.getenv('CREDIT_KEEP_HOURS', 168))
+# Sections every cluster worker keeps a full copy of
+REPLICATED_SECTIONS = ('cards', 'sudo_users', 'drop_settings')
+
+# Only update types the registered handlers consume
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 # Data storage
-DATA_FILE = 'bot_data.json'
+# Every file the bot keeps lives under DATA_DIR (a Docker volume)
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+DATA_FILE = os.getenv('DATA_FILE', os.path.join(DATA_DIR, 'bot_data.json'))
 BACKUP_FILE = 'bot_backup.json'
+JOURNAL_FILE = os.getenv('JOURNAL_FILE', os.path.join(DATA_DIR, 'bot_data.journal'))
+BINARY_FILE = os.getenv('BINARY_FILE', os.path.join(DATA_DIR, 'bot_data.bin'))
+SHARD_DIR = os.getenv('SHARD_DIR', os.path.join(DATA_DIR, 'bot_data_shards'))
+SQLITE_FILE = os.getenv('SQLITE_FILE', os.path.join(DATA_DIR, 'bot_data.db'))
+
+# Persistence mode: 'json' rewrites DATA_FILE on every save,
+# 'journal' appends changed records to JOURNAL_FILE and snapshots periodically,
+# 'sqlite' upserts changed rows into SQLITE_FILE,
+# 'sharded' rewrites only the touched files under SHARD_DIR
+STORAGE_MODE = os.getenv('STORAGE_MODE', 'json')
+JOURNAL_COMPACT_RECORDS = int(os.getenv('JOURNAL_COMPACT_RECORDS', 10000))
+
+# Number of user shard files in 'sharded' mode
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 16))
+
+# Users kept in memory in 'sqlite' mode; the rest are read from the database
+# when first needed (0 = load every user at startup)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 0))
+
+# Coin ledger database, used in every storage mode; entries between
+# balance checkpoints; seconds between reconciliation runs (0 = off)
+LEDGER_FILE = os.getenv('LEDGER_FILE', os.path.join(DATA_DIR, 'coin_ledger.db'))
+LEDGER_CHECKPOINT_ENTRIES = int(os.getenv('LEDGER_CHECKPOINT_ENTRIES', 100000))
+LEDGER_RECONCILE_INTERVAL = float(os.getenv('LEDGER_RECONCILE_INTERVAL', 3600))
+
+# Snapshot format for json/journal/sharded modes: 'json' (DATA_FILE) or 'binary' (BINARY_FILE)
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'json')
+
+# Seconds between background flushes; 0 writes on every save_data() call
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', 1.0))
+
+# Broadcast limits: messages per second overall (Telegram allows ~30),
+# concurrent senders, seconds between progress updates
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 8))
+BROADCAST_STATUS_INTERVAL = float(os.getenv('BROADCAST_STATUS_INTERVAL', 5))
+BROADCAST_MAX_ATTEMPTS = 3
+
+# Seconds between syncing cached group message counters into bot_data
+GROUP_SYNC_INTERVAL = float(os.getenv('GROUP_SYNC_INTERVAL', 60))
+
+# Seconds a drop can be caught; open drops are expired by a timer wheel
+# that advances every DROP_TICK seconds
+DROP_TIMEOUT = float(os.getenv('DROP_TIMEOUT', 30))
+DROP_TICK = float(os.getenv('DROP_TICK', 1.0))
+DROP_WHEEL_SLOTS = 64
+# Trade offers: hours an open offer stays listed, open offers per user,
+# seconds between expiry sweeps
+TRADE_OFFER_HOURS = float(os.getenv('TRADE_OFFER_HOURS', 24))
+TRADE_MAX_OFFERS = int(os.getenv('TRADE_MAX_OFFERS', 10))
+TRADE_SWEEP_INTERVAL = float(os.getenv('TRADE_SWEEP_INTERVAL', 60))
+
+# Cards of one rarity /fusion combines into one card of the next rarity
+FUSION_COST = int(os.getenv('FUSION_COST', 3))
+
+# Duels: cards per team, turns per side before HP decides, seconds a
+# challenge or battle may sit idle, coins for the winner, seconds between
+# sweeps for idle duels
+DUEL_TEAM_SIZE = int(os.getenv('DUEL_TEAM_SIZE', 3))
+DUEL_MAX_TURNS = int(os.getenv('DUEL_MAX_TURNS', 50))
+DUEL_TIMEOUT = float(os.getenv('DUEL_TIMEOUT', 300))
+DUEL_REWARD = int(os.getenv('DUEL_REWARD', 100))
+DUEL_SWEEP_INTERVAL = float(os.getenv('DUEL_SWEEP_INTERVAL', 60))
+
+# Most spins one /slots, /basket or /wheel command may batch (x<spins>)
+GAME_MAX_SPINS = {
+    'slots': int(os.getenv('SLOTS_MAX_SPINS', 100)),
+    'basket': int(os.getenv('BASKET_MAX_SPINS', 100)),
+    'wheel': int(os.getenv('WHEEL_MAX_SPINS', 100))
+}
+
+# Caption edits per second marking drops as expired
+DROP_EDIT_RATE = float(os.getenv('DROP_EDIT_RATE', 10))
+
+# Typos /catch forgives in long card names (names under 4 characters must
+# match exactly, under 8 may have one typo)
+CATCH_MAX_EDITS = int(os.getenv('CATCH_MAX_EDITS', 2))
+
+# Prometheus metrics endpoint (0 = disabled); cluster workers use port + index
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
 
 # Rarity system
 RARITIES = {
@@ -48,17 +190,24 @@ RARITIES = {
 }
 
 # Global data structure
-bot_data = {
-    'cards': {},
-    'users': {},
-    'groups': {},
-    'sudo_users': [],
-    'drop_settings': {},
-    'pending_uploads': {},
-    'pending_trades': {},
-    'pending_duels': {},
-    'pending_fusions': {}
-}
+def empty_data() -> dict:
+    return {
+        'cards': {},
+        'users': {},
+        'groups': {},
+        'sudo_users': [],
+        'drop_settings': {},
+        'pending_uploads': {},
+        'pending_trades': {},
+        'pending_duels': {},
+        'pending_fusions': {},
+        'pending_credits': {},
+        'applied_credits': {},
+        'pending_offers': {},
+        'placed_trades': {}
+    }
+
+bot_data = empty_data()
 
 # Shop items
 SHOP_ITEMS = {
@@ -76,30 +225,1639 @@ MISSIONS = {
     'champion': {'name': 'Champion', 'requirement': 500, 'reward': 10000, 'title': '👑 Champion'}
 }
 
+# Metrics
+# Latency histograms for handlers, storage and Bot API calls, exposed in
+# Prometheus text format on METRICS_PORT and summarised by /perf
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# family -> (metric name, label name, help text)
+METRIC_FAMILIES = {
+    'handler': ('bot_handler_seconds', 'handler', 'Update handler latency'),
+    'storage': ('bot_storage_seconds', 'op', 'Persistence call latency'),
+    'api': ('bot_api_seconds', 'method', 'Outgoing Bot API request latency'),
+}
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'sum', 'errors')
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False):
+        self.buckets[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    # Upper bucket bound below which a fraction q of observations fall
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(METRIC_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    def __init__(self):
+        self.series = {family: {} for family in METRIC_FAMILIES}
+        # Functions returning extra exposition lines (counters, gauges)
+        self.collectors = []
+
+    def observe(self, family: str, label: str, seconds: float, error: bool = False):
+        series = self.series[family]
+        histogram = series.get(label)
+        if histogram is None:
+            histogram = series[label] = Histogram()
+        histogram.observe(seconds, error)
+
+    @contextmanager
+    def timer(self, family: str, label: str):
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(family, label, time.perf_counter() - start, error)
+
+    def render(self) -> str:
+        lines = []
+        for family, (name, label_name, help_text) in METRIC_FAMILIES.items():
+            series = sorted(self.series[family].items())
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for label, h in series:
+                label = label.replace('\\', '\\\\').replace('"', '\\"')
+                cumulative = 0
+                for bound, n in zip(METRIC_BUCKETS + ('+Inf',), h.buckets):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {h.sum:.6f}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {h.count}')
+            errors = name.replace('_seconds', '_errors_total')
+            lines.append(f"# HELP {errors} {help_text} failures")
+            lines.append(f"# TYPE {errors} counter")
+            for label, h in series:
+                label = label.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{errors}{{{label_name}="{label}"}} {h.errors}')
+        for collect in self.collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Times every request the bot makes; getUpdates long polls use their own
+# request object and are not counted
+class TimedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        start = time.perf_counter()
+        code = 0
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            return code, payload
+        finally:
+            metrics.observe('api', url.rsplit('/', 1)[-1], time.perf_counter() - start,
+                            error=not 200 <= code < 300)
+
+# Minimal HTTP responder for Prometheus scrapes of /metrics
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = (await reader.readline()).split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if len(request) > 1 and request[1] == b'/metrics':
+            status, body = b'200 OK', metrics.render().encode('utf-8')
+        else:
+            status, body = b'404 Not Found', b'not found\n'
+        writer.write(
+            b'HTTP/1.1 ' + status + b'\r\n'
+            b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+            b'Connection: close\r\n\r\n' + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+# Wrap every registered handler callback so each update is timed under
+# its command name (or the callback name for message/button handlers)
+def instrument_handlers(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                label = '/' + sorted(handler.commands)[0]
+            else:
+                label = handler.callback.__name__
+            handler.callback = timed_handler(label, handler.callback)
+
+def timed_handler(label: str, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with metrics.timer('handler', label):
+            return await callback(update, context)
+    return wrapper
+
+# Compact user records
+# Hundreds of thousands of users as plain dicts cost far more in per-dict
+# overhead than in data. In memory a user is a __slots__ record and its card
+# collection two parallel array('I') columns of integer card id and count,
+# sorted by id; empty lists and dicts are not allocated until first used.
+# Both behave like the dicts they replace (same keys, string card ids),
+# and convert back to the same JSON shape when saved.
+class CardInventory(MutableMapping):
+    __slots__ = ('ids', 'counts')
+
+    def __init__(self, cards: Optional[dict] = None):
+        pairs = sorted(zip(map(int, cards), cards.values())) if cards else ()
+        self.ids = array('I', [card_id for card_id, _ in pairs])
+        self.counts = array('I', [count for _, count in pairs])
+
+    # Whether the arrays can store this card id and count
+    @staticmethod
+    def fits(card_id, count: int) -> bool:
+        return is_card_id(card_id) and int(card_id) < 2 ** 32 and 0 <= count < 2 ** 32
+
+    # Like the dict keys, only canonical ids match: '01' is not card 1
+    def find(self, card_id) -> tuple:
+        if isinstance(card_id, str):
+            if not is_card_id(card_id):
+                return -1, None
+            key = int(card_id)
+        elif isinstance(card_id, int) and card_id >= 0:
+            key = card_id
+        else:
+            return -1, None
+        i = bisect.bisect_left(self.ids, key)
+        return i, key
+
+    def __getitem__(self, card_id) -> int:
+        i, key = self.find(card_id)
+        if key is None or i == len(self.ids) or self.ids[i] != key:
+            raise KeyError(card_id)
+        return self.counts[i]
+
+    def __setitem__(self, card_id, count: int):
+        i, key = self.find(card_id)
+        if key is None:
+            raise KeyError(card_id)
+        if i < len(self.ids) and self.ids[i] == key:
+            self.counts[i] = count
+        else:
+            self.ids.insert(i, key)
+            self.counts.insert(i, count)
+
+    def __delitem__(self, card_id):
+        i, key = self.find(card_id)
+        if key is None or i == len(self.ids) or self.ids[i] != key:
+            raise KeyError(card_id)
+        del self.ids[i]
+        del self.counts[i]
+
+    def __iter__(self):
+        return (str(card_id) for card_id in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def values(self):
+        return list(self.counts)
+
+    def items(self):
+        return [(str(card_id), count) for card_id, count in zip(self.ids, self.counts)]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __deepcopy__(self, memo):
+        copied = CardInventory.__new__(CardInventory)
+        copied.ids = array('I', self.ids)
+        copied.counts = array('I', self.counts)
+        return copied
+
+    # Both columns as little-endian bytes, for binary snapshots
+    def to_bytes(self) -> tuple:
+        ids, counts = self.ids, self.counts
+        if sys.byteorder == 'big':
+            ids, counts = array('I', ids), array('I', counts)
+            ids.byteswap()
+            counts.byteswap()
+        return ids.tobytes(), counts.tobytes()
+
+    @staticmethod
+    def from_bytes(ids: bytes, counts: bytes) -> 'CardInventory':
+        cards = CardInventory.__new__(CardInventory)
+        cards.ids = array('I')
+        cards.ids.frombytes(ids)
+        cards.counts = array('I')
+        cards.counts.frombytes(counts)
+        if sys.byteorder == 'big':
+            cards.ids.byteswap()
+            cards.counts.byteswap()
+        return cards
+
+    def __reduce__(self):
+        return CardInventory, (self.to_dict(),)
+
+class UserRecord(MutableMapping):
+    FIELDS = ('username', 'cards', 'balance', 'last_daily', 'favorite_cards', 'titles',
+              'married_to', 'inventory', 'completed_missions', 'total_cards', 'rarity_counts')
+    __slots__ = FIELDS + ('extra',)
+    FIELD_SET = frozenset(FIELDS)
+    # Stored as () while empty
+    CONTAINERS = {'favorite_cards': list, 'titles': list, 'completed_missions': list,
+                  'inventory': dict, 'rarity_counts': dict}
+
+    def __init__(self, user: dict):
+        self.extra = None
+        containers = UserRecord.CONTAINERS
+        fields = UserRecord.FIELD_SET
+        for key, value in user.items():
+            if key in containers:
+                if not value:
+                    value = ()
+            elif key == 'cards':
+                value = pack_cards(value)
+            if key in fields:
+                setattr(self, key, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    def __getitem__(self, key):
+        if key in UserRecord.FIELD_SET:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+            if type(value) is tuple:
+                value = UserRecord.CONTAINERS[key]()
+                setattr(self, key, value)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'cards' and not isinstance(value, CardInventory):
+            value = pack_cards(value)
+        elif key in UserRecord.CONTAINERS and not value:
+            value = ()
+        if key in UserRecord.FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in UserRecord.FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key in UserRecord.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> dict:
+        user = {}
+        for key in UserRecord.FIELDS:
+            if hasattr(self, key):
+                value = getattr(self, key)
+                if type(value) is tuple:
+                    value = UserRecord.CONTAINERS[key]()
+                elif isinstance(value, CardInventory):
+                    value = value.to_dict()
+                user[key] = value
+        if self.extra:
+            user.update(self.extra)
+        return user
+
+    def __deepcopy__(self, memo):
+        return UserRecord(copy.deepcopy(self.to_dict(), memo))
+
+    # Flat form for binary snapshots, rebuilt without going through a dict:
+    # (bitmask of set FIELDS, extra, cards, values of the other set fields).
+    # cards is the two column byte strings, or a dict for non-canonical ids
+    def to_row(self) -> tuple:
+        mask = 0
+        cards = None
+        values = []
+        for i, key in enumerate(UserRecord.FIELDS):
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                continue
+            mask |= 1 << i
+            if key == 'cards':
+                cards = value.to_bytes() if isinstance(value, CardInventory) else value
+            else:
+                values.append(value)
+        return (mask, self.extra, cards, *values)
+
+    @staticmethod
+    def from_row(row: tuple) -> 'UserRecord':
+        user = UserRecord.__new__(UserRecord)
+        mask, user.extra, cards = row[:3]
+        values = iter(row[3:])
+        for i, key in enumerate(UserRecord.FIELDS):
+            if mask >> i & 1:
+                if key == 'cards':
+                    user.cards = CardInventory.from_bytes(*cards) if type(cards) is tuple else cards
+                else:
+                    setattr(user, key, next(values))
+        return user
+
+    def __reduce__(self):
+        return UserRecord, (self.to_dict(),)
+
+# Card ids are decimal strings without leading zeros
+def is_card_id(key) -> bool:
+    return isinstance(key, str) and key.isascii() and key.isdigit() and key == str(int(key))
+
+# Other card ids (hand-edited data) keep a plain dict
+def pack_cards(cards: dict):
+    if isinstance(cards, CardInventory):
+        return cards
+    # Checked in bulk rather than with is_card_id() per key: this runs for
+    # every user on load. Keys that don't print back the same are not
+    # canonical, and array('I') refuses negative or oversized values
+    keys = list(cards)
+    try:
+        ids = list(map(int, keys))
+        if list(map(str, ids)) == keys:
+            pairs = sorted(zip(ids, cards.values()))
+            packed = CardInventory.__new__(CardInventory)
+            packed.ids = array('I', [card_id for card_id, _ in pairs])
+            packed.counts = array('I', [count for _, count in pairs])
+            return packed
+    except (ValueError, TypeError, OverflowError):
+        pass
+    return dict(cards)
+
+def pack_users(users: dict):
+    if isinstance(users, UserCache):
+        return
+    for user_id, user in users.items():
+        if not isinstance(user, UserRecord):
+            users[user_id] = UserRecord(user)
+
+# json default= hook for the compact records
+def json_default(value):
+    if isinstance(value, (UserRecord, CardInventory, UserCache)):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Change records
+# {'s': section, 'k': id, 'v': value} sets a record, 'd': 1 deletes it;
+# without 'k' the whole section is replaced, or with 'd': 1 removed
+def make_record(data: dict, key: tuple) -> dict:
+    section, *rest = key
+    record = {'s': section}
+    if rest:
+        record['k'] = rest[0]
+        if rest[0] in data.get(section, {}):
+            record['v'] = data[section][rest[0]]
+        else:
+            record['d'] = 1
+    elif section in data:
+        record['v'] = data[section]
+    else:
+        record['d'] = 1
+    return record
+
+def apply_record(data: dict, record: dict):
+    section = record['s']
+    key = record.get('k')
+    if key is None:
+        if record.get('d'):
+            data.pop(section, None)
+        else:
+            data[section] = record['v']
+    elif record.get('d'):
+        data.setdefault(section, {}).pop(key, None)
+    else:
+        data.setdefault(section, {})[key] = record['v']
+
+# Binary snapshot format
+# header: magic, format version, marshal version, section count
+# section: name, then one length-prefixed marshal blob with its value.
+# Since v2 'users' is split over several sections of BINARY_USER_CHUNK
+# users each, so a load never holds every user as plain dicts at once.
+# Since v3 each user is stored as UserRecord.to_row(), which decodes
+# straight into a record; v1/v2 files (user dicts) still load
+BINARY_MAGIC = b'CBSN'
+BINARY_VERSION = 3
+BINARY_HEADER = struct.Struct('<4sHHI')
+BINARY_SECTION = struct.Struct('<HQ')
+BINARY_USER_CHUNK = 10000
+
+def dump_binary(data: dict, f):
+    parts = []
+    for section, value in data.items():
+        if section == 'users':
+            users = list(value.items())
+            for i in range(0, max(len(users), 1), BINARY_USER_CHUNK):
+                parts.append((section, users[i:i + BINARY_USER_CHUNK]))
+        else:
+            parts.append((section, value))
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, marshal.version, len(parts)))
+    for section, value in parts:
+        name = section.encode('utf-8')
+        if section == 'users':
+            value = {uid: (u if isinstance(u, UserRecord) else UserRecord(u)).to_row() for uid, u in value}
+        blob = marshal.dumps(value)
+        f.write(BINARY_SECTION.pack(len(name), len(blob)) + name)
+        f.write(blob)
+
+def load_binary(f) -> dict:
+    buf = f.read()
+    magic, version, marshal_version, sections = BINARY_HEADER.unpack_from(buf, 0)
+    if magic != BINARY_MAGIC or version not in (1, 2, BINARY_VERSION):
+        raise ValueError(f"Unsupported snapshot header: {magic!r} v{version}")
+    if marshal_version > marshal.version:
+        raise ValueError(f"Snapshot needs marshal v{marshal_version}")
+    view = memoryview(buf)
+    pos = BINARY_HEADER.size
+    data = {}
+    for _ in range(sections):
+        name_len, size = BINARY_SECTION.unpack_from(buf, pos)
+        pos += BINARY_SECTION.size
+        section = str(view[pos:pos + name_len], 'utf-8')
+        pos += name_len
+        value = marshal.loads(view[pos:pos + size])
+        pos += size
+        if section == 'users':
+            if version >= 3:
+                from_row = UserRecord.from_row
+                value = {user_id: from_row(row) for user_id, row in value.items()}
+            else:
+                pack_users(value)
+            data.setdefault('users', {}).update(value)
+        else:
+            data[section] = value
+    return data
+
+# Read a snapshot file, picking the format from its extension
+def read_snapshot_file(path: str) -> dict:
+    # Building millions of small dicts triggers constant GC passes that
+    # find nothing to collect; pause the collector while parsing
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if path.endswith('.bin'):
+            with open(path, 'rb') as f:
+                return load_binary(f)
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # Packing after the parse keeps json's C fast path; an object_hook
+        # call per parsed object made loads several times slower
+        if isinstance(data.get('users'), dict):
+            pack_users(data['users'])
+        return data
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+# Write a snapshot file atomically, picking the format from its extension.
+# The temp file is swapped in with os.replace, so a crash mid-write
+# never leaves a truncated snapshot behind
+def write_snapshot_file(path: str, data: dict, indent: Optional[int] = 2):
+    tmp_file = path + '.tmp'
+    if path.endswith('.bin'):
+        with open(tmp_file, 'wb') as f:
+            dump_binary(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent,
+                      separators=None if indent else (',', ':'), default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+# Convert between JSON and binary snapshots (python bot.py convert SRC DST)
+def convert_snapshot(src: str, dst: str):
+    write_snapshot_file(dst, read_snapshot_file(src))
+
+# Storage backends
+# load() returns the full bot_data dict (or None if nothing is stored yet);
+# save(data, keys) persists the (section, id) records named in keys,
+# or everything when keys is empty. Backends that can apply change records
+# on their own implement write_records(records); the others need the full
+# data on every write (needs_mirror)
+class JsonStorage:
+    needs_mirror = True
+
+    def __init__(self, data_file: str = DATA_FILE, binary_file: str = BINARY_FILE,
+                 journal_file: str = JOURNAL_FILE):
+        self.data_file = data_file
+        self.binary_file = binary_file
+        self.journal_file = journal_file
+
+    def load(self) -> Optional[dict]:
+        data = None
+        # Load the newest snapshot of either format, so switching
+        # SNAPSHOT_FORMAT keeps the data
+        paths = [p for p in (self.data_file, self.binary_file) if os.path.exists(p)]
+        if paths:
+            data = read_snapshot_file(max(paths, key=os.path.getmtime))
+        if os.path.exists(self.journal_file):
+            data = data if data is not None else empty_data()
+            replayed = self.replay_journal(data)
+            logger.info(f"Replayed {replayed} journal records")
+            if replayed:
+                # Fold the journal into a fresh snapshot
+                self.write_snapshot(data)
+        return data
+
+    def save(self, data: dict, keys: tuple):
+        self.write_snapshot(data)
+
+    # Write full snapshot and reset the journal
+    def write_snapshot(self, data: dict):
+        write_snapshot_file(self.binary_file if SNAPSHOT_FORMAT == 'binary' else self.data_file, data)
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    # Replay journal on top of the loaded snapshot
+    def replay_journal(self, data: dict) -> int:
+        replayed = 0
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last write from a crash
+                    logger.warning(f"Journal truncated after {replayed} records")
+                    break
+                if record['s'] == 'users' and isinstance(record.get('v'), dict):
+                    if 'k' in record:
+                        record['v'] = UserRecord(record['v'])
+                    else:
+                        pack_users(record['v'])
+                apply_record(data, record)
+                replayed += 1
+        return replayed
+
+
+class JournalStorage(JsonStorage):
+    needs_mirror = False
+
+    def __init__(self, *paths):
+        super().__init__(*paths)
+        self.journal = None
+        self.records = 0
+
+    def save(self, data: dict, keys: tuple):
+        if keys:
+            self.append_journal(data, keys)
+            if self.records < JOURNAL_COMPACT_RECORDS:
+                return
+        self.write_snapshot(data)
+
+    def write_records(self, records: list):
+        self.append_records(records)
+        if self.records >= JOURNAL_COMPACT_RECORDS:
+            # Fold the journal into a new snapshot read back from disk
+            self.close_journal()
+            self.load()
+
+    def write_snapshot(self, data: dict):
+        self.close_journal()
+        super().write_snapshot(data)
+        self.records = 0
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    # Append changed records to the journal
+    def append_journal(self, data: dict, keys: tuple):
+        self.append_records([make_record(data, key) for key in keys])
+
+    def append_records(self, records: list):
+        if self.journal is None:
+            self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        for record in records:
+            self.journal.write(json.dumps(record, ensure_ascii=False, separators=(',', ':'),
+                                          default=json_default) + '\n')
+            self.records += 1
+        self.journal.flush()
+
+
+class SqliteStorage:
+    needs_mirror = False
+
+    # Scalar user fields get their own columns, the rest go to the data column
+    USER_COLUMNS = ('username', 'balance', 'last_daily', 'married_to')
+    CARD_COLUMNS = ('name', 'movie', 'rarity', 'file_id', 'type', 'created_at')
+    GROUP_COLUMNS = ('title', 'message_count', 'last_drop')
+
+    def __init__(self, path: str = SQLITE_FILE, cache_size: int = 0):
+        self.cache_size = cache_size
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # User cache misses read on their own connection: with WAL they see
+        # the last commit without waiting for the writer thread
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute("PRAGMA query_only=ON")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                username TEXT,
+                balance INTEGER NOT NULL DEFAULT 0,
+                last_daily TEXT,
+                married_to TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS user_cards (
+                user_id TEXT NOT NULL,
+                card_id TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, card_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS cards (
+                card_id TEXT PRIMARY KEY,
+                name TEXT, movie TEXT, rarity TEXT,
+                file_id TEXT, type TEXT, created_at TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS groups (
+                chat_id TEXT PRIMARY KEY,
+                title TEXT,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                last_drop TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                section TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                PRIMARY KEY (section, key)
+            );
+        """)
+
+    @staticmethod
+    def split_record(record: dict, columns: tuple, skip: tuple = ()) -> tuple:
+        extra = {k: v for k, v in record.items() if k not in columns and k not in skip}
+        return tuple(record.get(c) for c in columns) + (json.dumps(extra, ensure_ascii=False),)
+
+    def load(self) -> Optional[dict]:
+        tables = ('users', 'cards', 'groups', 'settings')
+        if not any(self.db.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone() for t in tables):
+            return None
+        data = empty_data()
+        data['users'] = UserCache(self, self.cache_size) if self.cache_size else self.load_users()
+        for row in self.db.execute(f"SELECT card_id, {', '.join(self.CARD_COLUMNS)}, data FROM cards"):
+            card = json.loads(row[-1])
+            card.update(zip(self.CARD_COLUMNS, row[1:-1]))
+            data['cards'][row[0]] = card
+        for row in self.db.execute(f"SELECT chat_id, {', '.join(self.GROUP_COLUMNS)}, data FROM groups"):
+            group = json.loads(row[-1])
+            group.update(zip(self.GROUP_COLUMNS, row[1:-1]))
+            data['groups'][row[0]] = group
+        for section, key, value in self.db.execute("SELECT section, key, value FROM settings"):
+            if key == '':
+                data[section] = json.loads(value)
+            else:
+                data.setdefault(section, {})[key] = json.loads(value)
+        return data
+
+    @staticmethod
+    def make_user(row: tuple, cards: dict) -> UserRecord:
+        user = json.loads(row[5])
+        user.update(zip(SqliteStorage.USER_COLUMNS, row[1:5]))
+        user['cards'] = cards
+        return UserRecord(user)
+
+    def load_users(self) -> dict:
+        cards = {}
+        for user_id, card_id, count in self.db.execute("SELECT user_id, card_id, count FROM user_cards"):
+            cards.setdefault(user_id, {})[card_id] = count
+        return {row[0]: self.make_user(row, cards.pop(row[0], {}))
+                for row in self.db.execute("SELECT user_id, username, balance, last_daily, married_to, data FROM users")}
+
+    # Single-user reads for the user cache, on the reader connection
+    def load_user(self, user_id: str) -> Optional[UserRecord]:
+        with self.reader:
+            # One read transaction, so the user and their cards match
+            self.reader.execute("BEGIN")
+            row = self.reader.execute(
+                "SELECT user_id, username, balance, last_daily, married_to, data FROM users WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            return self.make_user(row, dict(self.reader.execute(
+                "SELECT card_id, count FROM user_cards WHERE user_id = ?", (user_id,)
+            )))
+
+    def has_user(self, user_id: str) -> bool:
+        return self.reader.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def count_users(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def user_ids(self) -> list:
+        return [row[0] for row in self.db.execute("SELECT user_id FROM users")]
+
+    def user_balances(self) -> dict:
+        return dict(self.db.execute("SELECT user_id, balance FROM users"))
+
+    # Card totals of every user that owns cards, for the leaderboard
+    def user_totals(self) -> dict:
+        return dict(self.db.execute("SELECT user_id, SUM(count) FROM user_cards GROUP BY user_id"))
+
+    def save(self, data: dict, keys: tuple):
+        with self.db:
+            if not keys:
+                for table in ('users', 'user_cards', 'cards', 'groups', 'settings'):
+                    self.db.execute(f"DELETE FROM {table}")
+                keys = [(section, key) for section, value in data.items() if isinstance(value, dict)
+                        for key in value] + \
+                       [(section,) for section, value in data.items() if not isinstance(value, dict)]
+            for section, *rest in keys:
+                key = rest[0] if rest else None
+                self.write_record(data, section, key)
+
+    def write_records(self, records: list):
+        with self.db:
+            for record in records:
+                data = {}
+                apply_record(data, record)
+                self.write_record(data, record['s'], record.get('k'))
+
+    def write_record(self, data: dict, section: str, key: Optional[str]):
+        value = data.get(section, {}).get(key) if key is not None else data.get(section)
+        if section == 'users':
+            self.write_user(key, value)
+        elif section == 'cards':
+            if value is None:
+                self.db.execute("DELETE FROM cards WHERE card_id = ?", (key,))
+            else:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key,) + self.split_record(value, self.CARD_COLUMNS)
+                )
+        elif section == 'groups':
+            if value is None:
+                self.db.execute("DELETE FROM groups WHERE chat_id = ?", (key,))
+            else:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO groups VALUES (?, ?, ?, ?, ?)",
+                    (key,) + self.split_record(value, self.GROUP_COLUMNS)
+                )
+        elif value is None and key is not None:
+            self.db.execute("DELETE FROM settings WHERE section = ? AND key = ?", (section, key))
+        elif key is None and section not in data:
+            self.db.execute("DELETE FROM settings WHERE section = ?", (section,))
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?, ?)",
+                (section, key if key is not None else '', json.dumps(value, ensure_ascii=False))
+            )
+
+    def write_user(self, user_id: str, user: Optional[dict]):
+        if user is None:
+            self.db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            self.db.execute("DELETE FROM user_cards WHERE user_id = ?", (user_id,))
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id,) + self.split_record(user, self.USER_COLUMNS, skip=('cards',))
+        )
+        # Only touch inventory rows that actually changed
+        stored = dict(self.db.execute(
+            "SELECT card_id, count FROM user_cards WHERE user_id = ?", (user_id,)
+        ))
+        cards = user.get('cards', {})
+        changed = [(user_id, cid, n) for cid, n in cards.items() if stored.get(cid) != n]
+        removed = [(user_id, cid) for cid in stored if cid not in cards]
+        if changed:
+            self.db.executemany("INSERT OR REPLACE INTO user_cards VALUES (?, ?, ?)", changed)
+        if removed:
+            self.db.executemany("DELETE FROM user_cards WHERE user_id = ? AND card_id = ?", removed)
+
+
+class ShardedStorage:
+    # Users are spread over SHARD_COUNT files by a stable hash of their id;
+    # cards, groups and everything else get one file each. Only files that
+    # contain a changed record are rewritten.
+    needs_mirror = False
+
+    def __init__(self, directory: str = SHARD_DIR, shard_count: int = SHARD_COUNT,
+                 fallback: Optional[JsonStorage] = None):
+        self.directory = directory
+        self.shard_count = shard_count
+        self.fallback = fallback
+        self.ext = '.bin' if SNAPSHOT_FORMAT == 'binary' else '.json'
+        # Shard index -> user ids stored in it, so a shard write never scans all users
+        self.shards = [set() for _ in range(shard_count)]
+        os.makedirs(directory, exist_ok=True)
+
+    def shard_of(self, user_id: str) -> int:
+        return zlib.crc32(user_id.encode('utf-8')) % self.shard_count
+
+    def path(self, name) -> str:
+        if isinstance(name, int):
+            name = f'users_{name:03d}'
+        return os.path.join(self.directory, name + self.ext)
+
+    def load(self) -> Optional[dict]:
+        names = list(range(self.shard_count)) + ['cards', 'groups', 'settings']
+        paths = [self.path(name) for name in names if os.path.exists(self.path(name))]
+        if not paths:
+            # First start in sharded mode: import the regular snapshot
+            data = self.fallback.load() if self.fallback is not None else None
+            if data is not None:
+                self.save(data, ())
+            return data
+        data = empty_data()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with ThreadPoolExecutor(max_workers=min(8, len(paths))) as pool:
+                for part in pool.map(read_snapshot_file, paths):
+                    for section, value in part.items():
+                        if section == 'users':
+                            data['users'].update(value)
+                        else:
+                            data[section] = value
+        finally:
+            if gc_enabled:
+                gc.enable()
+        for user_id in data['users']:
+            self.shards[self.shard_of(user_id)].add(user_id)
+        return data
+
+    def save(self, data: dict, keys: tuple):
+        if not keys:
+            self.shards = [set() for _ in range(self.shard_count)]
+            for user_id in data['users']:
+                self.shards[self.shard_of(user_id)].add(user_id)
+            dirty = set(range(self.shard_count)) | {'cards', 'groups', 'settings'}
+        else:
+            dirty = set()
+            for section, *rest in keys:
+                if section == 'users':
+                    shard = self.shard_of(rest[0])
+                    if rest[0] in data['users']:
+                        self.shards[shard].add(rest[0])
+                    else:
+                        self.shards[shard].discard(rest[0])
+                    dirty.add(shard)
+                elif section in ('cards', 'groups'):
+                    dirty.add(section)
+                else:
+                    dirty.add('settings')
+        for name in dirty:
+            self.write_file(data, name)
+
+    # Read back each touched file and apply its records to it
+    def write_records(self, records: list):
+        files = {}
+        for record in records:
+            section = record['s']
+            if section == 'users':
+                name = self.shard_of(record['k'])
+                if record.get('d'):
+                    self.shards[name].discard(record['k'])
+                else:
+                    self.shards[name].add(record['k'])
+            elif section in ('cards', 'groups'):
+                name = section
+            else:
+                name = 'settings'
+            files.setdefault(name, []).append(record)
+        for name, changes in files.items():
+            path = self.path(name)
+            content = read_snapshot_file(path) if os.path.exists(path) else {}
+            for record in changes:
+                apply_record(content, record)
+            write_snapshot_file(path, content, indent=None)
+
+    def write_file(self, data: dict, name):
+        if isinstance(name, int):
+            users = data['users']
+            content = {'users': {uid: users[uid] for uid in self.shards[name]}}
+        elif name == 'settings':
+            content = {k: v for k, v in data.items() if k not in ('users', 'cards', 'groups')}
+        else:
+            content = {name: data.get(name, {})}
+        write_snapshot_file(self.path(name), content, indent=None)
+
+
+# Data files of older versions sat in the working directory; move any
+# (including cluster workers' .w<n> files) the configured location doesn't
+# have yet into it
+def move_legacy_files():
+    legacy = (('bot_data.json', DATA_FILE), ('bot_data.bin', BINARY_FILE),
+              ('bot_data.journal', JOURNAL_FILE), ('bot_data.db', SQLITE_FILE),
+              ('bot_data_shards', SHARD_DIR), ('coin_ledger.db', LEDGER_FILE))
+    for old, new in legacy:
+        root, ext = os.path.splitext(old)
+        new_root, new_ext = os.path.splitext(new)
+        for name in os.listdir('.'):
+            match = re.fullmatch(re.escape(root) + r'(\.w\d+)?' + re.escape(ext) + r'(-wal|-shm)?', name)
+            if match is None:
+                continue
+            target = new_root + (match.group(1) or '') + new_ext + (match.group(2) or '')
+            if os.path.exists(target) or os.path.abspath(name) == os.path.abspath(target):
+                continue
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            os.replace(name, target)
+            logger.info(f"Moved {name} to {target}")
+
+# suffix names a separate set of files (one per cluster worker)
+def create_storage(mode: str = STORAGE_MODE, suffix: str = ''):
+    def path(name: str) -> str:
+        root, ext = os.path.splitext(name)
+        return root + suffix + ext
+    paths = (path(DATA_FILE), path(BINARY_FILE), path(JOURNAL_FILE))
+    for name in paths + (path(SQLITE_FILE),):
+        os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+    if mode == 'journal':
+        return JournalStorage(*paths)
+    if mode == 'sqlite':
+        return SqliteStorage(path(SQLITE_FILE), USER_CACHE_SIZE)
+    if mode == 'sharded':
+        return ShardedStorage(SHARD_DIR + suffix, SHARD_COUNT,
+                              fallback=None if suffix else JsonStorage())
+    return JsonStorage(*paths)
+
+# Opened by init_storage(), not at import, so importing the module
+# (tests, benchmark.py, cluster children) leaves data files alone
+storage = None
+
+# Move legacy files and open the configured backend, once; load_data()
+# and the first write call it
+def init_storage():
+    global storage
+    if storage is None:
+        move_legacy_files()
+        storage = create_storage()
+    return storage
+
+# True when users are read from storage on demand instead of all loaded
+def lazy_users() -> bool:
+    return isinstance(storage, SqliteStorage) and storage.cache_size > 0
+
+# Coin ledger
+# Append-only record of every balance change, kept in its own SQLite file
+# whatever STORAGE_MODE is. Each change is double-entry: one row for the
+# user's account and one with the opposite sign for the system account
+# the coins came from or went to, so a ledger always sums to zero.
+# Accounts are user ids as integers; system accounts are 0 and below.
+# Reasons are stored as small integer codes.
+# Checkpoints fold every account's entries into checkpoint_balances, so a
+# balance is its checkpoint plus the short tail written after it.
+LEDGER_MINT, LEDGER_HOUSE, LEDGER_TRANSFER, LEDGER_ESCROW = 0, -1, -2, -3
+
+# reason: (code, counter account)
+LEDGER_REASONS = {
+    'opening': (0, LEDGER_MINT),
+    'signup': (1, LEDGER_MINT),
+    'daily': (2, LEDGER_MINT),
+    'catch': (3, LEDGER_MINT),
+    'mission': (4, LEDGER_MINT),
+    'shop': (5, LEDGER_HOUSE),
+    'slots': (6, LEDGER_HOUSE),
+    'basket': (7, LEDGER_HOUSE),
+    'wheel': (8, LEDGER_HOUSE),
+    'transfer': (9, LEDGER_TRANSFER),
+    'trade': (10, LEDGER_ESCROW),
+    'duel': (11, LEDGER_MINT),
+    'adjust': (12, LEDGER_MINT),
+}
+LEDGER_REASON_NAMES = {code: reason for reason, (code, _) in LEDGER_REASONS.items()}
+
+class CoinLedger:
+    def __init__(self, path: str = LEDGER_FILE):
+        self.path = path
+        self.db = None
+        # Entries posted on the event loop, written with the next flush
+        self.pending = []
+        # Entries written since the last checkpoint
+        self.unchecked = 0
+
+    # Opened on first use, on the writer thread once the flusher runs
+    def connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS ledger (
+                    entry_id INTEGER PRIMARY KEY,
+                    account INTEGER NOT NULL,
+                    delta INTEGER NOT NULL,
+                    reason INTEGER NOT NULL,
+                    ref TEXT,
+                    created INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ledger_account ON ledger (account, entry_id);
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    checkpoint_id INTEGER PRIMARY KEY,
+                    entry_id INTEGER NOT NULL,
+                    created INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS checkpoint_balances (
+                    account INTEGER PRIMARY KEY,
+                    balance INTEGER NOT NULL,
+                    entry_id INTEGER NOT NULL
+                ) WITHOUT ROWID;
+            """)
+            self.unchecked = self.db.execute(
+                "SELECT COUNT(*) FROM ledger WHERE entry_id > ?", (self.checkpoint_id(),)
+            ).fetchone()[0]
+        return self.db
+
+    def post(self, user_id: str, delta: int, reason: str, ref: Optional[str] = None):
+        code, counter = LEDGER_REASONS[reason]
+        now = int(time.time())
+        self.pending.append((int(user_id), delta, code, ref, now))
+        self.pending.append((counter, -delta, code, ref, now))
+
+    def take(self) -> list:
+        entries, self.pending = self.pending, []
+        return entries
+
+    # The methods below run on the writer thread
+    def write(self, entries: list):
+        if not entries:
+            return
+        db = self.connect()
+        with db:
+            db.executemany(
+                "INSERT INTO ledger (account, delta, reason, ref, created) VALUES (?, ?, ?, ?, ?)", entries
+            )
+        self.unchecked += len(entries)
+        if self.unchecked >= LEDGER_CHECKPOINT_ENTRIES:
+            self.checkpoint()
+
+    # Last entry folded into checkpoint_balances
+    def checkpoint_id(self) -> int:
+        return self.connect().execute("SELECT COALESCE(MAX(entry_id), 0) FROM checkpoints").fetchone()[0]
+
+    def checkpoint(self):
+        db = self.connect()
+        last = self.checkpoint_id()
+        top = db.execute("SELECT COALESCE(MAX(entry_id), 0) FROM ledger").fetchone()[0]
+        if top > last:
+            with db:
+                db.execute("""
+                    INSERT INTO checkpoint_balances (account, balance, entry_id)
+                    SELECT l.account, COALESCE(c.balance, 0) + SUM(l.delta), MAX(l.entry_id)
+                    FROM ledger l LEFT JOIN checkpoint_balances c ON c.account = l.account
+                    WHERE l.entry_id > ? AND l.entry_id <= ?
+                    GROUP BY l.account
+                    ON CONFLICT (account) DO UPDATE SET balance = excluded.balance, entry_id = excluded.entry_id
+                """, (last, top))
+                db.execute("INSERT INTO checkpoints (entry_id, created) VALUES (?, ?)", (top, int(time.time())))
+        self.unchecked = 0
+
+    def balance(self, user_id: str) -> int:
+        db = self.connect()
+        account = int(user_id)
+        balance, entry_id = db.execute(
+            "SELECT balance, entry_id FROM checkpoint_balances WHERE account = ?", (account,)
+        ).fetchone() or (0, 0)
+        return balance + db.execute(
+            "SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE account = ? AND entry_id > ?", (account, entry_id)
+        ).fetchone()[0]
+
+    # Newest entries first: (entry_id, delta, reason, ref, created)
+    def history(self, user_id: str, limit: int = 10) -> list:
+        return [
+            (entry_id, delta, LEDGER_REASON_NAMES.get(code, str(code)), ref, created)
+            for entry_id, delta, code, ref, created in self.connect().execute(
+                "SELECT entry_id, delta, reason, ref, created FROM ledger "
+                "WHERE account = ? ORDER BY entry_id DESC LIMIT ?", (int(user_id), limit)
+            )
+        ]
+
+    # Every account's balance: checkpoints plus one range scan of the tail
+    def balances(self) -> dict:
+        db = self.connect()
+        balances = dict(db.execute("SELECT account, balance FROM checkpoint_balances"))
+        for account, delta in db.execute(
+            "SELECT account, SUM(delta) FROM ledger WHERE entry_id > ? GROUP BY account", (self.checkpoint_id(),)
+        ):
+            balances[account] = balances.get(account, 0) + delta
+        return balances
+
+    # Compare stored user balances with the ledger
+    def reconcile(self, stored: dict) -> dict:
+        start = time.perf_counter()
+        balances = self.balances()
+        total = sum(balances.values())
+        mismatches = {}
+        for user_id, balance in stored.items():
+            expected = balances.pop(int(user_id), 0)
+            if expected != balance:
+                mismatches[user_id] = (expected, balance)
+        return {
+            'entries': self.connect().execute("SELECT COALESCE(MAX(entry_id), 0) FROM ledger").fetchone()[0],
+            'users': len(stored),
+            # Double-entry: every ledger sums to zero
+            'total': total,
+            'mismatches': mismatches,
+            # Users with coins in the ledger but no stored record
+            'missing': sum(1 for account, balance in balances.items() if account > 0 and balance),
+            'seconds': round(time.perf_counter() - start, 3)
+        }
+
+    # Post 'adjust' entries so the ledger agrees with the stored balances;
+    # a new ledger posts every user's balance as 'opening' instead.
+    # Returns how many users needed an entry
+    def sync(self, stored: dict) -> int:
+        self.write(self.take())
+        balances = self.balances()
+        reason = 'adjust' if balances else 'opening'
+        changed = 0
+        for user_id, balance in stored.items():
+            delta = balance - balances.pop(int(user_id), 0)
+            if delta:
+                self.post(user_id, delta, reason)
+                changed += 1
+        # Users no longer stored (e.g. after /allclear)
+        for account, balance in balances.items():
+            if account > 0 and balance:
+                self.post(str(account), -balance, reason)
+                changed += 1
+        self.write(self.take())
+        return changed
+
+ledger = CoinLedger()
+
+# Change a user's balance and post it to the ledger
+def add_coins(user_id: str, delta: int, reason: str, ref: Optional[str] = None):
+    bot_data['users'][user_id]['balance'] += delta
+    ledger.post(user_id, delta, reason, ref)
+    flusher.touch(('users', user_id))
+
+# Stored balance of every local user. Lazy mode reads the database, so it
+# runs on the writer thread after a flush
+def stored_balances() -> dict:
+    if lazy_users():
+        return storage.user_balances()
+    return {user_id: user['balance'] for user_id, user in bot_data['users'].items()}
+
+# Bring the ledger in line with stored balances after a load or restore
+def sync_ledger() -> int:
+    if lazy_users():
+        if flusher.executor is not None:
+            flusher.flush()
+        return flusher.call(lambda: ledger.sync(stored_balances()))
+    return flusher.call(ledger.sync, stored_balances())
+
+async def reconcile_ledger() -> dict:
+    if flusher.executor is not None:
+        flusher.flush()
+    if lazy_users():
+        return await flusher.submit(lambda: ledger.reconcile(stored_balances()))
+    return await flusher.submit(ledger.reconcile, stored_balances())
+
+async def ledger_history(user_id: str, limit: int = 10) -> tuple:
+    if flusher.executor is not None:
+        flusher.flush()
+    return await flusher.submit(lambda: (ledger.history(user_id, limit), ledger.balance(user_id)))
+
+async def run_ledger_reconcile():
+    while True:
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+        report = await reconcile_ledger()
+        if report['mismatches'] or report['total'] or report['missing']:
+            logger.warning(
+                f"Ledger reconcile: {len(report['mismatches'])} balance mismatches, "
+                f"{report['missing']} users missing, total {report['total']}"
+            )
+        else:
+            logger.info(f"Ledger reconcile: {report['users']} users OK in {report['seconds']}s")
+
 # Load data
 def load_data():
     global bot_data
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                bot_data = json.load(f)
+        with metrics.timer('storage', 'load_data'):
+            data = init_storage().load()
+        if data is not None:
+            pack_users(data['users'])
+            bot_data = data
             logger.info("Data loaded successfully")
+        elif lazy_users():
+            bot_data['users'] = UserCache(storage, storage.cache_size)
+        if rebuild_indexes():
+            save_data()
     except Exception as e:
         logger.error(f"Error loading data: {e}")
+    synced = sync_ledger()
+    if synced:
+        logger.info(f"Coin ledger: posted entries for {synced} users")
 
-# Save data
-def save_data():
+# Write changed records through the storage backend
+def write_data(keys: tuple, data: dict = None):
+    try:
+        with metrics.timer('storage', 'write_data'):
+            init_storage().save(bot_data if data is None else data, keys)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving data: {e}")
+        return False
+
+# Apply change records through the storage backend
+def write_records(records: list) -> bool:
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(bot_data, f, ensure_ascii=False, indent=2)
+        with metrics.timer('storage', 'write_data'):
+            init_storage().write_records(records)
+        return True
     except Exception as e:
         logger.error(f"Error saving data: {e}")
+        return False
+
+# Coalesces save_data() calls into at most one write per FLUSH_INTERVAL.
+# Writes run on a dedicated thread; the event loop only hands it deep
+# copies of the changed records. Backends that write the whole dataset
+# (json mode) get a copy of bot_data kept up to date on that thread.
+class Flusher:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.dirty = set()
+        self.full = False
+        self.requests = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.task = None
+        self.executor = None
+        # Writer thread state: the full copy (json mode, or a full snapshot
+        # not written yet) and the records still to write
+        self.mirror = None
+        self.failed = {}
+        self.failed_full = False
+        # Every record received since the last successful write
+        self.received = []
+        # Changed records evicted from the user cache since the last flush
+        self.evicted = {}
+        # User records handed to the writer thread and not written yet, so
+        # user cache misses don't read an older copy from the database
+        self.unwritten = {}
+        self.unwritten_lock = threading.Lock()
+
+    def mark(self, keys: tuple):
+        if keys:
+            self.dirty.update(keys)
+        else:
+            self.full = True
+        self.requests += 1
+        # Evicted users wait in memory, so don't let more pile up than the cache holds
+        if self.interval <= 0 or (self.evicted and len(self.evicted) >= storage.cache_size):
+            self.flush()
+
+    def flush(self):
+        # Touched or evicted records count as changes without a save_data()
+        if not self.requests and not self.dirty and not self.evicted:
+            if ledger.pending:
+                self.executor.submit(self.write_ledger, ledger.take())
+            return
+        with metrics.timer('storage', 'flush'):
+            if self.full:
+                snapshot, records = copy.deepcopy(bot_data), None
+            else:
+                snapshot, records = None, []
+                for key in self.dirty:
+                    # One bad record must not keep every other change off disk
+                    try:
+                        records.append(copy.deepcopy(make_record(bot_data, key)))
+                    except Exception as e:
+                        logger.error(f"Skipping unsaveable record {key}: {e!r}")
+                records += [{'s': section, 'k': key, 'v': copy.deepcopy(value)}
+                            for (section, key), value in self.evicted.items()]
+                with self.unwritten_lock:
+                    for record in records:
+                        if record['s'] == 'users' and 'k' in record:
+                            self.unwritten[('users', record['k'])] = record
+        self.coalesced += max(self.requests - 1, 0)
+        self.dirty = set()
+        self.evicted = {}
+        self.full = False
+        self.requests = 0
+        self.executor.submit(self.write, snapshot, records, ledger.take())
+
+    # Runs on the writer thread
+    def write(self, snapshot: Optional[dict], records: Optional[list], entries: list = ()):
+        self.write_ledger(entries)
+        self.received += records or ()
+        if snapshot is not None:
+            self.mirror = snapshot
+            self.failed = {}
+            self.failed_full = True
+        else:
+            for record in records:
+                if self.mirror is not None:
+                    try:
+                        apply_record(self.mirror, record)
+                    except Exception as e:
+                        logger.error(f"Skipping unsaveable record {record.get('s')}: {e!r}")
+                        continue
+                self.failed[(record['s'], record['k']) if 'k' in record else (record['s'],)] = record
+        if self.mirror is not None:
+            written = write_data(() if self.failed_full else tuple(self.failed), self.mirror)
+        else:
+            written = write_records(list(self.failed.values()))
+        if written:
+            self.writes += 1
+            with self.unwritten_lock:
+                for record in self.received:
+                    key = ('users', record.get('k'))
+                    if self.unwritten.get(key) is record:
+                        del self.unwritten[key]
+            self.received = []
+            self.failed = {}
+            self.failed_full = False
+            if not storage.needs_mirror:
+                self.mirror = None
+
+    # Runs on the writer thread
+    def write_ledger(self, entries: list):
+        try:
+            ledger.write(entries)
+        except Exception as e:
+            logger.error(f"Error writing coin ledger: {e}")
+
+    # Mark a record changed before its save_data() call, which may come
+    # after an await; the user cache then keeps it if it drops the user.
+    # The next flush writes it even if no save_data() follows. Without the
+    # writer thread saves go straight to storage and nothing is tracked
+    def touch(self, key: tuple):
+        if self.executor is None:
+            return
+        self.dirty.add(key)
+        if self.interval <= 0:
+            self.flush()
+
+    # Latest change record of a user still on its way to the database
+    def unwritten_user(self, user_id: str) -> Optional[dict]:
+        with self.unwritten_lock:
+            return self.unwritten.get(('users', user_id))
+
+    # Keep a record dropped from the user cache for the next flush;
+    # returns False if it had no unflushed changes
+    def write_back(self, key: tuple, value) -> bool:
+        if key not in self.dirty:
+            return False
+        self.dirty.discard(key)
+        self.evicted[key] = value
+        return True
+
+    # Run fn on the writer thread once queued writes are done
+    def call(self, fn, *args):
+        if self.executor is None:
+            return fn(*args)
+        return self.executor.submit(fn, *args).result()
+
+    # Like call(), without blocking the event loop
+    async def submit(self, fn, *args):
+        if self.executor is None:
+            return fn(*args)
+        return await asyncio.wrap_future(self.executor.submit(fn, *args))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flush failed: {e!r}")
+
+    # Call before updates are handled: the copy is taken off the event loop
+    async def start(self):
+        if self.task is not None or self.executor is not None:
+            return
+        if init_storage().needs_mirror:
+            self.mirror = await asyncio.to_thread(copy.deepcopy, bot_data)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-writer')
+        if self.interval > 0:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.executor is not None:
+            self.flush()
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+            self.executor = None
+        logger.info(f"Flusher stopped: {self.writes} writes, {self.coalesced} saves coalesced")
+
+flusher = Flusher(FLUSH_INTERVAL)
+
+# User cache
+# With USER_CACHE_SIZE set in 'sqlite' mode, bot_data['users'] is an LRU
+# cache: a user is read from the database on first access and the least
+# recently used one is dropped once the cache is full; if it has unflushed
+# changes it is written with the next flush. Balance and card changes
+# (add_coins, add_card) count as changes at once, before the handler's
+# save_data(). Misses read on the storage's reader connection instead of
+# waiting behind queued writes; a user whose changes are still queued is
+# copied from the flusher, so a read never sees an older copy. A handler
+# must not keep a user across an await while more than USER_CACHE_SIZE
+# other users are used.
+class UserCache(MutableMapping):
+    def __init__(self, storage: SqliteStorage, capacity: int):
+        self.storage = storage
+        self.capacity = capacity
+        self.records = OrderedDict()
+        # Deleted ids that may still be in the database
+        self.deleted = set()
+        self.count = flusher.call(storage.count_users)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+
+    def __getitem__(self, user_id):
+        user = self.records.get(user_id)
+        if user is not None:
+            self.records.move_to_end(user_id)
+            self.hits += 1
+            return user
+        self.misses += 1
+        if user_id in self.deleted:
+            raise KeyError(user_id)
+        user = flusher.evicted.pop(('users', user_id), None)
+        if user is not None:
+            # Evicted with changes that are not written yet
+            flusher.dirty.add(('users', user_id))
+            self.insert(user_id, user)
+            return user
+        record = flusher.unwritten_user(user_id)
+        if record is not None:
+            if record.get('d'):
+                raise KeyError(user_id)
+            # The writer thread may still be reading that copy
+            user = copy.deepcopy(record['v'])
+        else:
+            user = self.storage.load_user(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        # Corrected counters are stored with the user's next change
+        fix_user_totals(user, bot_data['cards'])
+        self.insert(user_id, user)
+        return user
+
+    def __setitem__(self, user_id, user):
+        if user_id not in self.records:
+            if flusher.evicted.pop(('users', user_id), None) is None and (
+                    user_id in self.deleted or not self.stored(user_id)):
+                self.count += 1
+            self.deleted.discard(user_id)
+        self.insert(user_id, user)
+
+    # Whether the database has the user, or will once queued writes are done
+    def stored(self, user_id: str) -> bool:
+        record = flusher.unwritten_user(user_id)
+        if record is not None:
+            return not record.get('d')
+        return self.storage.has_user(user_id)
+
+    def __delitem__(self, user_id):
+        self[user_id]
+        del self.records[user_id]
+        self.deleted.add(user_id)
+        self.count -= 1
+
+    def insert(self, user_id: str, user):
+        self.records[user_id] = user
+        self.records.move_to_end(user_id)
+        if len(self.records) > self.capacity:
+            old_id, old = self.records.popitem(last=False)
+            self.evictions += 1
+            if flusher.write_back(('users', old_id), old):
+                self.write_backs += 1
+
+    def __iter__(self):
+        stored = flusher.call(self.storage.user_ids)
+        new = set(self.records).difference(stored)
+        return itertools.chain((uid for uid in stored if uid not in self.deleted), new)
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Every user as a plain dict (backup, cluster snapshot); cached users
+    # come from memory, the rest straight from the database
+    def to_dict(self) -> dict:
+        users = flusher.call(self.storage.load_users)
+        users.update(self.records)
+        for user_id in self.deleted:
+            users.pop(user_id, None)
+        return users
+
+    # Card totals of every user for the leaderboard
+    def totals(self) -> dict:
+        totals = flusher.call(self.storage.user_totals)
+        for user_id, user in self.records.items():
+            totals[user_id] = user.get('total_cards', 0)
+        for user_id in self.deleted:
+            totals.pop(user_id, None)
+        return totals
+
+    def __reduce__(self):
+        return dict, (self.to_dict(),)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.records), 'capacity': self.capacity,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'write_backs': self.write_backs,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+def user_cache_metrics() -> list:
+    users = bot_data['users']
+    if not isinstance(users, UserCache):
+        return []
+    lines = [
+        "# HELP bot_user_cache_total User cache lookups, evictions and write-backs",
+        "# TYPE bot_user_cache_total counter"
+    ]
+    for event, count in (('hit', users.hits), ('miss', users.misses),
+                         ('eviction', users.evictions), ('write_back', users.write_backs)):
+        lines.append(f'bot_user_cache_total{{event="{event}"}} {count}')
+    lines += [
+        "# HELP bot_user_cache_size Users held in the user cache",
+        "# TYPE bot_user_cache_size gauge",
+        f"bot_user_cache_size {len(users.records)}"
+    ]
+    return lines
+
+metrics.collectors.append(user_cache_metrics)
+
+# Save data
+# keys: (section, id) or (section,) tuples naming what changed;
+# no keys means a full snapshot (restore, allclear).
+# In cluster mode changes to replicated sections are sent to the other workers
+def save_data(*keys, replicate: bool = True):
+    with metrics.timer('storage', 'save_data'):
+        if replicate and cluster is not None:
+            cluster.replicate(keys)
+        users = bot_data['users']
+        if not keys and isinstance(users, UserCache):
+            # Users outside the cache are stored already, so a full save
+            # rewrites the cached ones and every other record
+            keys = [('users', user_id) for user_id in users.records]
+            for section, value in bot_data.items():
+                if isinstance(value, dict):
+                    keys += [(section, key) for key in value]
+                elif value is not users:
+                    keys.append((section,))
+        if flusher.executor is not None:
+            flusher.mark(keys)
+            return
+        ledger.write(ledger.take())
+        write_data(keys)
+
+# Import a JSON data file into the SQLite database
+def migrate_to_sqlite(json_file: str = DATA_FILE, db_file: str = SQLITE_FILE) -> dict:
+    with open(json_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    SqliteStorage(db_file).save(data, ())
+    return {section: len(value) for section, value in data.items()}
 
 # Initialize user
 def init_user(user_id: int, username: str = None):
     user_id = str(user_id)
     if user_id not in bot_data['users']:
-        bot_data['users'][user_id] = {
+        bot_data['users'][user_id] = UserRecord({
             'username': username,
             'cards': {},
             'balance': 1000,
@@ -108,9 +1866,12 @@ def init_user(user_id: int, username: str = None):
             'titles': [],
             'married_to': None,
             'inventory': {},
-            'completed_missions': []
-        }
-        save_data()
+            'completed_missions': [],
+            'total_cards': 0,
+            'rarity_counts': {}
+        })
+        ledger.post(user_id, 1000, 'signup')
+        save_data(('users', user_id))
 
 # Initialize group
 def init_group(chat_id: int, chat_title: str):
@@ -121,17 +1882,1478 @@ def init_group(chat_id: int, chat_title: str):
             'message_count': 0,
             'last_drop': None
         }
-        save_data()
+        save_data(('groups', chat_id))
+
+# Group message counters
+# Cached per chat so counting a message is one increment and compare;
+# counts are written back to bot_data['groups'] by sync_group_counters()
+class GroupCounter:
+    __slots__ = ('count', 'threshold', 'last_drop', 'synced')
+
+    def __init__(self, count: int, threshold: int, last_drop: Optional[str]):
+        self.count = count
+        self.threshold = threshold
+        self.last_drop = last_drop
+        self.synced = count
+
+group_counters = {}
+
+def get_group_counter(chat_id: int, chat_title: str) -> GroupCounter:
+    init_group(chat_id, chat_title)
+    key = str(chat_id)
+    group = bot_data['groups'][key]
+    counter = GroupCounter(
+        group.get('message_count', 0),
+        bot_data['drop_settings'].get(key, 50),
+        group.get('last_drop')
+    )
+    group_counters[chat_id] = counter
+    return counter
+
+def sync_group_counters():
+    for chat_id, counter in group_counters.items():
+        if counter.count == counter.synced:
+            continue
+        key = str(chat_id)
+        if key in bot_data['groups']:
+            bot_data['groups'][key]['message_count'] = counter.count
+            save_data(('groups', key))
+        counter.synced = counter.count
+
+async def run_group_sync():
+    while True:
+        await asyncio.sleep(GROUP_SYNC_INTERVAL)
+        sync_group_counters()
+
+# Broadcast engine
+# Sends run on BROADCAST_WORKERS concurrent workers behind one token bucket
+# sized under Telegram's global limit (~30 msg/s); each group gets a single
+# message, which keeps every chat within its own per-chat limit. Outcomes are
+# recorded in bot_data['broadcast'] so an interrupted run can be resumed.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = None
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+broadcast_task = None
+
+# Forget a group the bot can no longer post to
+def prune_group(group_id: str):
+    bot_data['groups'].pop(group_id, None)
+    bot_data['drop_settings'].pop(group_id, None)
+    group_counters.pop(int(group_id), None)
+    save_data(('groups', group_id), ('drop_settings', group_id))
+
+# A group upgraded to a supergroup lives on under its new id: move its
+# record, counter and drop setting there (in cluster mode the record goes
+# to the worker that owns the new id)
+def migrate_group(old_id: str, new_id: str):
+    group = bot_data['groups'].pop(old_id, None)
+    counter = group_counters.pop(int(old_id), None)
+    keys = [('groups', old_id)]
+    if old_id in bot_data['drop_settings']:
+        bot_data['drop_settings'][new_id] = bot_data['drop_settings'].pop(old_id)
+        keys += [('drop_settings', old_id), ('drop_settings', new_id)]
+    if group is not None:
+        if counter is not None:
+            group['message_count'] = counter.count
+        if is_local(new_id):
+            adopt_group(new_id, group)
+            keys.append(('groups', new_id))
+        else:
+            cluster.cast(cluster.owner(new_id), 'adopt_group', new_id, group)
+    save_data(*keys)
+    logger.info(f"Group {old_id} migrated to {new_id}")
+
+def adopt_group(group_id: str, group: dict):
+    bot_data['groups'][group_id] = group
+    # Rebuilt from the record on the next message
+    group_counters.pop(int(group_id), None)
+
+# Send one broadcast message; returns the outcome ('ok', 'failed',
+# 'pruned', 'retry', or 'wait' after a flood wait) and the group id it
+# belongs to, which changes when the group has migrated
+async def send_broadcast(bot, group_id: str, message: str, bucket: TokenBucket) -> tuple:
+    chat_id = int(group_id)
+    try:
+        await bot.send_message(chat_id=chat_id, text=message)
+        return 'ok', group_id
+    except RetryAfter as e:
+        bucket.pause(e.retry_after)
+        return 'wait', group_id
+    except ChatMigrated as e:
+        new_id = str(e.new_chat_id)
+        migrate_group(group_id, new_id)
+        try:
+            await bot.send_message(chat_id=e.new_chat_id, text=message)
+            return 'ok', new_id
+        except TelegramError:
+            return 'failed', new_id
+    except Forbidden:
+        # Bot was kicked or blocked
+        return 'pruned', group_id
+    except BadRequest as e:
+        if 'chat not found' in str(e).lower():
+            return 'pruned', group_id
+        return 'failed', group_id
+    except (TimedOut, NetworkError):
+        return 'retry', group_id
+    except TelegramError as e:
+        logger.warning(f"Broadcast to {group_id} failed: {e}")
+        return 'failed', group_id
+
+def broadcast_summary(results: dict, total: int) -> str:
+    counts = {'ok': 0, 'failed': 0, 'pruned': 0}
+    for outcome in results.values():
+        counts[outcome] += 1
+    return (
+        f"✅ အောင်မြင်: {counts['ok']}\n"
+        f"❌ မအောင်မြင်: {counts['failed']}\n"
+        f"🧹 ဖယ်ရှား: {counts['pruned']}\n"
+        f"📊 {len(results)}/{total}"
+    )
+
+async def edit_status(status_msg, text: str):
+    try:
+        await status_msg.edit_text(text)
+    except TelegramError:
+        pass
+
+async def run_broadcast(bot, status_msg):
+    global broadcast_task
+    state = bot_data['broadcast']
+    results = state['results']
+    total = len(results) + sum(1 for gid in bot_data['groups'] if gid not in results)
+    queue = asyncio.Queue()
+    for group_id in list(bot_data['groups']):
+        if group_id not in results:
+            queue.put_nowait((group_id, 0))
+    bucket = TokenBucket(BROADCAST_RATE)
+    
+    async def worker():
+        while not queue.empty():
+            group_id, attempts = queue.get_nowait()
+            await bucket.acquire()
+            outcome, group_id = await send_broadcast(bot, group_id, state['message'], bucket)
+            if outcome == 'wait':
+                # A flood wait says nothing about the group: try again
+                # after the pause without using up an attempt
+                queue.put_nowait((group_id, attempts))
+                continue
+            if outcome == 'retry':
+                if attempts + 1 < BROADCAST_MAX_ATTEMPTS:
+                    queue.put_nowait((group_id, attempts + 1))
+                    continue
+                outcome = 'failed'
+            if outcome == 'pruned':
+                prune_group(group_id)
+            results[group_id] = outcome
+    
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_STATUS_INTERVAL)
+            save_data(('broadcast',))
+            await edit_status(status_msg, "📢 Broadcasting...\n\n" + broadcast_summary(results, total))
+    
+    reporter = asyncio.get_running_loop().create_task(report())
+    try:
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_WORKERS)))
+    finally:
+        reporter.cancel()
+        if broadcast_task is asyncio.current_task():
+            broadcast_task = None
+        save_data(('broadcast',))
+    
+    summary = broadcast_summary(results, total)
+    del bot_data['broadcast']
+    save_data(('broadcast',))
+    await edit_status(status_msg, "📢 Broadcast ပြီးပါပြီ!\n\n" + summary)
+
+# Leaderboard index
+# Sorted (-total, user_id) entries plus each user's cached card total,
+# so /top is a slice instead of a sort over every user. Entries are kept
+# in sorted buckets of up to 2 * BUCKET_SIZE, with each bucket's last
+# entry in maxes: an update bisects maxes and shifts one short bucket,
+# O(log U + BUCKET_SIZE), where one flat list would shift O(U) entries
+class Leaderboard:
+    BUCKET_SIZE = 512
+
+    def __init__(self):
+        self.buckets = []
+        self.maxes = []
+        self.size = 0
+        self.totals = {}
+
+    # totals: user id -> card total
+    def rebuild(self, totals: dict):
+        self.totals = totals
+        entries = sorted((-total, uid) for uid, total in self.totals.items() if total > 0)
+        n = self.BUCKET_SIZE
+        self.buckets = [entries[i:i + n] for i in range(0, len(entries), n)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.size = len(entries)
+
+    def insert(self, entry: tuple):
+        if not self.buckets:
+            self.buckets.append([entry])
+            self.maxes.append(entry)
+            self.size += 1
+            return
+        i = min(bisect.bisect_left(self.maxes, entry), len(self.maxes) - 1)
+        bucket = self.buckets[i]
+        bisect.insort(bucket, entry)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            half = len(bucket) // 2
+            self.buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self.maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+        self.size += 1
+
+    def remove(self, entry: tuple):
+        i = bisect.bisect_left(self.maxes, entry)
+        bucket = self.buckets[i]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+        self.size -= 1
+
+    def update(self, user_id: str, total: int):
+        old = self.totals.get(user_id, 0)
+        if old == total:
+            return
+        if old > 0:
+            self.remove((-old, user_id))
+        if total > 0:
+            self.insert((-total, user_id))
+        self.totals[user_id] = total
+
+    def __len__(self) -> int:
+        return self.size
+
+    # Entries start..stop-1 in rank order; walks the buckets before them
+    def entries(self, start: int, stop: int) -> list:
+        found = []
+        for bucket in self.buckets:
+            if stop <= 0:
+                break
+            if start < len(bucket):
+                found += bucket[max(start, 0):stop]
+            start -= len(bucket)
+            stop -= len(bucket)
+        return found
+
+    def page(self, page: int, size: int = 10) -> list:
+        start = (page - 1) * size
+        return [(uid, -neg) for neg, uid in self.entries(start, start + size)]
+
+    def pages(self, size: int = 10) -> int:
+        return max(1, (self.size + size - 1) // size)
+
+leaderboard = Leaderboard()
+
+# Consistency checker for the cached per-user counters
+# ('total_cards' and per-rarity 'rarity_counts'); returns how many users were fixed
+# With the user cache only cached users are checked here; the others are
+# checked as they are read
+def check_user_totals() -> int:
+    users = bot_data['users']
+    if isinstance(users, UserCache):
+        users = users.records
+    return sum(fix_user_totals(user, bot_data['cards']) for user in users.values())
+
+def fix_user_totals(user, cards: dict) -> bool:
+    owned = user.get('cards', {})
+    total = sum(owned.values())
+    rarity_counts = {}
+    for card_id, count in owned.items():
+        if card_id in cards:
+            rarity = cards[card_id]['rarity']
+            rarity_counts[rarity] = rarity_counts.get(rarity, 0) + count
+    if user.get('total_cards') != total or user.get('rarity_counts') != rarity_counts:
+        user['total_cards'] = total
+        user['rarity_counts'] = rarity_counts
+        return True
+    return False
+
+# Rebuild in-memory indexes after bot_data is loaded or replaced;
+# returns how many user records needed their counters fixed
+def rebuild_indexes() -> int:
+    group_counters.clear()
+    fixed = check_user_totals()
+    if fixed:
+        logger.info(f"Fixed card counters for {fixed} users")
+    users = bot_data['users']
+    if isinstance(users, UserCache):
+        leaderboard.rebuild(users.totals())
+    else:
+        leaderboard.rebuild({uid: u.get('total_cards', 0) for uid, u in users.items()})
+    drop_engine.rebuild(bot_data['cards'])
+    card_keys.clear()
+    for card_id in bot_data['cards']:
+        index_card_name(card_id)
+    trade_book.rebuild(bot_data.setdefault('pending_trades', {}))
+    index_duels(bot_data.setdefault('pending_duels', {}))
+    bot_data.setdefault('pending_credits', {})
+    bot_data.setdefault('applied_credits', {})
+    bot_data.setdefault('pending_offers', {})
+    bot_data.setdefault('placed_trades', {})
+    return fixed
+
+# Add (or with a negative count, remove) cards in a user's inventory,
+# keeping the cached counters and indexes in sync
+def add_card(user_id: str, card_id: str, count: int = 1):
+    user = bot_data['users'][user_id]
+    cards = user['cards']
+    old = cards.get(card_id, 0)
+    new = max(old + count, 0)
+    count = new - old
+    if not new:
+        cards.pop(card_id, None)
+        # A favorite must be a card the user still owns
+        favorites = user.get('favorite_cards')
+        if favorites and card_id in favorites:
+            favorites.remove(card_id)
+    else:
+        if isinstance(cards, CardInventory) and not CardInventory.fits(card_id, new):
+            # Ids or counts the arrays can't hold: keep a plain dict, as pack_cards() does
+            cards = cards.to_dict()
+            cards[card_id] = new
+            user['cards'] = cards
+        else:
+            cards[card_id] = new
+    user['total_cards'] = user.get('total_cards', 0) + count
+    card = bot_data['cards'].get(card_id)
+    if card:
+        rarity_counts = user.setdefault('rarity_counts', {})
+        rarity_counts[card['rarity']] = rarity_counts.get(card['rarity'], 0) + count
+        if rarity_counts[card['rarity']] <= 0:
+            del rarity_counts[card['rarity']]
+    leaderboard.update(user_id, user['total_cards'])
+    flusher.touch(('users', user_id))
+
+# Drop engine
+# Rarity is sampled in O(1) from a Walker/Vose alias table built from
+# RARITIES drop chances (only rarities that have cards), then a card is
+# picked from that rarity's id array. Card ids keep their array position
+# so catalogue changes are O(1) swap-removes.
+class DropEngine:
+    def __init__(self):
+        self.ids = {rarity: [] for rarity in RARITIES}
+        self.all_ids = []
+        self.position = {}
+        self.rarities = []
+        self.prob = []
+        self.alias = []
+
+    def rebuild(self, cards: dict):
+        self.ids = {rarity: [] for rarity in RARITIES}
+        self.all_ids = []
+        self.position = {}
+        for card_id, card in cards.items():
+            self.insert(card_id, card['rarity'])
+        self.build_alias()
+
+    def build_alias(self):
+        self.rarities = [r for r in RARITIES if self.ids[r]]
+        n = len(self.rarities)
+        total = sum(RARITIES[r]['drop_chance'] for r in self.rarities)
+        scaled = [RARITIES[r]['drop_chance'] * n / total for r in self.rarities] if total else []
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def insert(self, card_id: str, rarity: str):
+        ids = self.ids[rarity]
+        self.position[card_id] = (rarity, len(ids), len(self.all_ids))
+        ids.append(card_id)
+        self.all_ids.append(card_id)
+
+    def add(self, card_id: str, rarity: str):
+        if card_id in self.position:
+            self.remove(card_id)
+        was_empty = not self.ids[rarity]
+        self.insert(card_id, rarity)
+        if was_empty:
+            self.build_alias()
+
+    def remove(self, card_id: str):
+        if card_id not in self.position:
+            return
+        rarity, i, j = self.position.pop(card_id)
+        ids = self.ids[rarity]
+        last = ids.pop()
+        if last != card_id:
+            ids[i] = last
+            self.position[last] = (rarity, i, self.position[last][2])
+        last = self.all_ids.pop()
+        if last != card_id:
+            self.all_ids[j] = last
+            self.position[last] = self.position[last][:2] + (j,)
+        if not ids:
+            self.build_alias()
+
+    # Rarity-weighted card for group drops
+    def pick(self) -> Optional[str]:
+        if not self.rarities:
+            return None
+        i = random.randrange(len(self.rarities))
+        if random.random() >= self.prob[i]:
+            i = self.alias[i]
+        ids = self.ids[self.rarities[i]]
+        return ids[random.randrange(len(ids))]
+
+    # Uniformly random card (shop packs)
+    def pick_any(self) -> Optional[str]:
+        if not self.all_ids:
+            return None
+        return self.all_ids[random.randrange(len(self.all_ids))]
+
+drop_engine = DropEngine()
+
+# Drop timers
+# Every open drop sits in one slot of a hashed timer wheel, keyed by chat id;
+# the wheel advances one slot per DROP_TICK, so scheduling and cancelling a
+# drop are O(1) and each tick only touches the drops due in it. An expired
+# drop is removed from chat_data at once; its message is edited to show it
+# expired by run_drop_edits, behind a token bucket.
+class TimerWheel:
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        # slot -> {key: [rounds left, value]}
+        self.slots = [{} for _ in range(slots)]
+        self.where = {}
+        self.current = 0
+
+    def schedule(self, key, delay: float, value):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][key] = [(ticks - 1) // len(self.slots), value]
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    # Move one tick forward; returns the values that are due
+    def advance(self) -> list:
+        self.current = (self.current + 1) % len(self.slots)
+        slot = self.slots[self.current]
+        due = []
+        for key, entry in list(slot.items()):
+            if entry[0]:
+                entry[0] -= 1
+            else:
+                del slot[key]
+                del self.where[key]
+                due.append(entry[1])
+        return due
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+# Card name matching
+# /catch guesses and card names are compared as normalised keys: NFC,
+# casefolded, invisible format characters (zero-width spaces are common in
+# Burmese text) removed and whitespace collapsed. Card keys are computed when
+# a card is uploaded or edited; a guess is checked only against the chat's
+# active drop, within a small edit distance, in O(len(name)).
+def normalize_name(text: str) -> str:
+    text = unicodedata.normalize('NFC', unicodedata.normalize('NFC', text).casefold())
+    if not text.isascii():
+        text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Cf')
+    return ' '.join(text.split())
+
+# Whether a and b are at most max_edits insertions, deletions or
+# substitutions apart; only a band of 2 * max_edits + 1 cells per row is
+# filled, so the cost is O(len * max_edits)
+def within_edits(a: str, b: str, max_edits: int) -> bool:
+    n, m = len(a), len(b)
+    if abs(n - m) > max_edits:
+        return False
+    if max_edits == 0 or a == b:
+        return a == b
+    # Typos are usually local, so only the part between the common prefix
+    # and suffix goes through the table
+    start = 0
+    while start < n and start < m and a[start] == b[start]:
+        start += 1
+    while n > start and m > start and a[n - 1] == b[m - 1]:
+        n -= 1
+        m -= 1
+    a, b = a[start:n], b[start:m]
+    n, m = len(a), len(b)
+    k = max_edits
+    over = k + 1
+    width = 2 * k + 1
+    # Row i holds distances to b[:j] for j = i - k .. i + k
+    prev = [d - k if d >= k else over for d in range(width)]
+    for i in range(1, n + 1):
+        cur = [over] * width
+        ch = a[i - 1]
+        row_min = over
+        for d in range(width):
+            j = i + d - k
+            if j < 0 or j > m:
+                continue
+            if j == 0:
+                v = i
+            else:
+                v = prev[d] + (ch != b[j - 1])
+                if d + 1 < width and prev[d + 1] + 1 < v:
+                    v = prev[d + 1] + 1
+                if d > 0 and cur[d - 1] + 1 < v:
+                    v = cur[d - 1] + 1
+            cur[d] = min(v, over)
+            row_min = min(row_min, cur[d])
+        if row_min > k:
+            return False
+        prev = cur
+    return prev[m - n + k] <= k
+
+def names_match(guess: str, key: str) -> bool:
+    return within_edits(guess, key, min(CATCH_MAX_EDITS, len(key) // 4))
+
+# card id -> normalised name
+card_keys = {}
+
+def index_card_name(card_id: str):
+    card_keys[card_id] = normalize_name(bot_data['cards'][card_id]['name'])
+
+drop_timers = TimerWheel(DROP_TICK, DROP_WHEEL_SLOTS)
+expired_drops = asyncio.Queue()
+drop_edit_bucket = TokenBucket(DROP_EDIT_RATE)
+
+def drop_caption(card: dict, expired: bool = False) -> str:
+    text = (
+        f"🎴 ကဒ်ကျလာပြီ!\n\n"
+        f"{RARITIES[card['rarity']]['emoji']} {card['name']}\n"
+        f"🎬 {card['movie']}\n\n"
+    )
+    if expired:
+        return text + "⏰ Time Out! ဖမ်းချိန် ကုန်သွားပါပြီ"
+    return text + f"📝 /catch {card['name']} ဖြင့် ဖမ်းပါ!"
+
+# Take a drop out of its chat and queue the message edit
+def expire_drop(chat_data: Optional[dict], drop: dict):
+    if chat_data is not None and chat_data.get('last_drop') is drop:
+        del chat_data['last_drop']
+    expired_drops.put_nowait(drop)
+
+async def run_drop_timers(application: Application):
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time() + drop_timers.tick
+    while True:
+        await asyncio.sleep(max(0.0, next_tick - loop.time()))
+        # Catch up on ticks missed while the loop was busy
+        while next_tick <= loop.time():
+            for drop in drop_timers.advance():
+                expire_drop(application.chat_data.get(drop['chat_id']), drop)
+            next_tick += drop_timers.tick
+
+async def run_drop_edits(bot):
+    while True:
+        drop = await expired_drops.get()
+        card = bot_data['cards'].get(drop['card_id'])
+        if card is None or drop.get('message_id') is None:
+            continue
+        await drop_edit_bucket.acquire()
+        try:
+            await bot.edit_message_caption(
+                chat_id=drop['chat_id'],
+                message_id=drop['message_id'],
+                caption=drop_caption(card, expired=True)
+            )
+        except RetryAfter as e:
+            drop_edit_bucket.pause(e.retry_after)
+        except TelegramError as e:
+            # Message deleted, bot removed from the chat...
+            logger.debug(f"Drop expiry edit in {drop['chat_id']} failed: {e}")
+
+# Lock registry
+# Handlers that read and then modify user state across an await hold
+# per-user locks, so concurrent updates for unrelated users run in
+# parallel while updates touching the same user are serialised. Chats
+# need no lock: a drop is taken by claim_drop() in one step without
+# awaiting, which alone gives it a single winner. Keys are
+# always acquired in sorted order, so handlers of one process can't deadlock
+# each other. In cluster mode a process only locks the users it owns, and
+# ops called by other workers never wait for a lock: a handler that holds a
+# lock while it awaits another worker can't deadlock with one awaiting it.
+class LockRegistry:
+    def __init__(self):
+        self.locks = {}
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        keys = sorted({key for key in keys if key[0] != 'user' or is_local(key[1])})
+        for key in keys:
+            entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+        acquired = []
+        try:
+            for key in keys:
+                await self.locks[key][0].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self.locks[key][0].release()
+            for key in keys:
+                entry = self.locks[key]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+locks = LockRegistry()
+
+def user_key(update: Update):
+    return ('user', str(update.effective_user.id))
+
+def reply_user_key(update: Update):
+    reply = update.message.reply_to_message if update.message else None
+    return ('user', str(reply.from_user.id)) if reply else None
+
+# Run a handler while holding the locks for the keys its update names
+def locked(*key_funcs):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            keys = [key for key in (f(update) for f in key_funcs) if key is not None]
+            async with locks.hold(*keys):
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+# Cluster mode
+# BOT_MODE=cluster runs a webhook front process plus CLUSTER_WORKERS worker
+# processes. Every group and every user belongs to one worker (crc32 of the
+# id), which keeps that slice of bot_data in its own storage files; cards,
+# sudo list and drop settings are replicated to all workers. Processes talk
+# over one multiprocessing queue per worker, no broker needed:
+#   ('update', update_json)                front -> worker
+#   ('call', call_id, sender, op, args)    worker -> worker, answered with
+#   ('reply', call_id, ok, result)         worker -> caller
+#   ('cast', op, args)                     worker -> worker, no answer
+#   ('stop',)                              front -> worker
+class ClusterError(Exception):
+    pass
+
+def cluster_owner(entity_id, workers: int) -> int:
+    return zlib.crc32(str(entity_id).encode('utf-8')) % workers
+
+# Worker that handles an update: group chatter goes to the group's owner
+# (drop counters), everything else to the sending user's owner
+def route_update(data: dict, workers: int) -> int:
+    message = data.get('message')
+    if message is not None:
+        chat = message.get('chat', {})
+        is_command = any(
+            e.get('type') == 'bot_command' and e.get('offset') == 0
+            for e in message.get('entities', [])
+        )
+        if chat.get('type') in ('group', 'supergroup') and 'text' in message and not is_command:
+            return cluster_owner(chat['id'], workers)
+        return cluster_owner((message.get('from') or chat).get('id'), workers)
+    query = data.get('callback_query')
+    if query is not None:
+        return cluster_owner(query['from']['id'], workers)
+    return 0
+
+class ClusterNode:
+    def __init__(self, index: int, inboxes: list):
+        self.index = index
+        self.inboxes = inboxes
+        self.pending = {}
+        self.next_id = 0
+        self.application = None
+        self.loop = None
+        self.stopped = None
+
+    def owner(self, entity_id) -> int:
+        return cluster_owner(entity_id, len(self.inboxes))
+
+    def owns(self, entity_id) -> bool:
+        return self.owner(entity_id) == self.index
+
+    # Run op on a worker and wait for its result
+    async def call(self, worker: int, op: str, *args):
+        if worker == self.index:
+            return await CLUSTER_OPS[op](*args)
+        self.next_id += 1
+        call_id = self.next_id
+        future = self.loop.create_future()
+        self.pending[call_id] = future
+        self.inboxes[worker].put(('call', call_id, self.index, op, args))
+        try:
+            return await asyncio.wait_for(future, CLUSTER_TIMEOUT)
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def call_all(self, op: str, *args) -> list:
+        return await asyncio.gather(*(self.call(w, op, *args) for w in range(len(self.inboxes))))
+
+    # Fire-and-forget op on every other worker. Queues pickle on a feeder
+    # thread, so args must not be mutated after the call
+    def cast_others(self, op: str, *args):
+        for worker, inbox in enumerate(self.inboxes):
+            if worker != self.index:
+                inbox.put(('cast', op, args))
+
+    def cast(self, worker: int, op: str, *args):
+        self.inboxes[worker].put(('cast', op, args))
+
+    def replicate(self, keys: tuple):
+        records = [copy.deepcopy(make_record(bot_data, key)) for key in keys
+                   if key[0] in REPLICATED_SECTIONS]
+        if records:
+            self.cast_others('apply_records', records)
+
+    # Runs on the reader thread: blocks on this worker's inbox
+    def read_inbox(self):
+        while True:
+            message = self.inboxes[self.index].get()
+            self.loop.call_soon_threadsafe(self.dispatch, message)
+            if message[0] == 'stop':
+                return
+
+    def dispatch(self, message: tuple):
+        kind = message[0]
+        if kind == 'update':
+            update = Update.de_json(json.loads(message[1]), self.application.bot)
+            self.application.update_queue.put_nowait(update)
+        elif kind == 'call':
+            self.loop.create_task(self.serve(*message[1:]))
+        elif kind == 'reply':
+            _, call_id, ok, result = message
+            future = self.pending.get(call_id)
+            if future is not None and not future.done():
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ClusterError(result))
+        elif kind == 'cast':
+            self.loop.create_task(self.serve(None, None, message[1], message[2]))
+        elif kind == 'stop':
+            self.stopped.set()
+
+    async def serve(self, call_id: Optional[int], sender: Optional[int], op: str, args: tuple):
+        try:
+            reply = ('reply', call_id, True, await CLUSTER_OPS[op](*args))
+        except Exception as e:
+            logger.error(f"Cluster op {op} failed: {e}")
+            reply = ('reply', call_id, False, f"{op}: {e}")
+        if sender is not None:
+            self.inboxes[sender].put(reply)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGTERM, self.stopped.set)
+        self.application = build_application()
+        async with self.application:
+            await post_init(self.application)
+            # Other workers' calls wait in the inbox until the flusher is up
+            threading.Thread(target=self.read_inbox, name='cluster-inbox', daemon=True).start()
+            await self.application.start()
+            logger.info(f"Worker {self.index} started")
+            await self.stopped.wait()
+            await self.application.stop()
+            await post_shutdown(self.application)
+
+cluster = None
+
+# True when this process owns the user or chat (always outside cluster mode)
+def is_local(entity_id) -> bool:
+    return cluster is None or cluster.owns(entity_id)
+
+# Keep only the users and groups this worker owns
+def shard_slice(data: dict) -> dict:
+    if cluster is None:
+        return data
+    return dict(
+        data,
+        users={uid: u for uid, u in data.get('users', {}).items() if cluster.owns(uid)},
+        groups={gid: g for gid, g in data.get('groups', {}).items() if cluster.owns(gid)}
+    )
+
+# Cross-shard user operations; the local branch changes the user without
+# awaiting, so it is safe with or without the caller's locks.
+# A credit for another worker's user is first saved in pending_credits
+# under a new id. The owner records the ids it applied in applied_credits,
+# so a credit whose reply timed out is resent by run_credit_retry() until
+# confirmed and never lands twice. Returns 'ok', 'pending' (unconfirmed,
+# still being retried) or 'failed' (not credited; refund, if given, got
+# the coins back)
+async def credit_user(user_id: str, username: Optional[str], amount: int,
+                      reason: str = 'transfer', ref: Optional[str] = None,
+                      refund: Optional[str] = None) -> str:
+    if is_local(user_id):
+        init_user(int(user_id), username)
+        add_coins(user_id, amount, reason, ref)
+        save_data(('users', user_id))
+        return 'ok'
+    credit_id = new_credit(user_id, username, amount, reason, ref, refund)
+    save_data(('pending_credits', credit_id))
+    return await send_credit(credit_id)
+
+# Add a pending credit (coins and optionally a card) for the caller to
+# save; returns its id
+def new_credit(user_id: str, username: Optional[str], amount: int, reason: str,
+               ref: Optional[str] = None, refund: Optional[str] = None,
+               card_id: Optional[str] = None) -> str:
+    credit_id = uuid.uuid4().hex
+    bot_data['pending_credits'][credit_id] = {
+        'user': user_id, 'username': username, 'amount': amount, 'reason': reason,
+        'ref': ref, 'refund': refund, 'card': card_id, 'created': time.time()
+    }
+    return credit_id
+
+# Pending credit ids with a call under way
+credits_in_flight = set()
+
+async def send_credit(credit_id: str) -> str:
+    credit = bot_data['pending_credits'][credit_id]
+    credits_in_flight.add(credit_id)
+    try:
+        await cluster.call(cluster.owner(credit['user']), 'credit_user', credit_id, credit['user'],
+                           credit['username'], credit['amount'], credit['reason'], credit['ref'],
+                           credit.get('card'))
+        status = 'ok'
+    except ClusterError:
+        logger.error(f"Credit {credit_id} to {credit['user']} refused: {credit!r}")
+        status = 'failed'
+    except asyncio.TimeoutError:
+        logger.warning(f"Credit {credit_id} of {credit['amount']} to {credit['user']} unconfirmed, will retry")
+        return 'pending'
+    finally:
+        credits_in_flight.discard(credit_id)
+    if bot_data['pending_credits'].pop(credit_id, None) is None:
+        return status
+    keys = [('pending_credits', credit_id)]
+    if status == 'failed' and credit['refund'] is not None:
+        add_coins(credit['refund'], credit['amount'], credit['reason'], credit['user'])
+        keys.append(('users', credit['refund']))
+    save_data(*keys)
+    return status
+
+# Resend unconfirmed credits and forget applied ids older than CREDIT_KEEP_HOURS
+async def retry_credits():
+    cutoff = time.time() - CREDIT_KEEP_HOURS * 3600
+    applied = bot_data['applied_credits']
+    # Ids are added in time order
+    old = [cid for cid, _ in itertools.takewhile(lambda item: item[1] < cutoff, applied.items())]
+    for credit_id in old:
+        del applied[credit_id]
+    if old:
+        save_data(*(('applied_credits', credit_id) for credit_id in old))
+    pending = [cid for cid in bot_data['pending_credits'] if cid not in credits_in_flight]
+    await asyncio.gather(*(send_credit(credit_id) for credit_id in pending))
+
+async def run_cluster_retry(bot):
+    while True:
+        await asyncio.sleep(CREDIT_RETRY_INTERVAL)
+        try:
+            await retry_credits()
+            await retry_offers(bot)
+        except Exception as e:
+            logger.error(f"Cluster retry failed: {e!r}")
+
+async def get_married_to(user_id: str, username: Optional[str]) -> Optional[str]:
+    if is_local(user_id):
+        init_user(int(user_id), username)
+        return bot_data['users'][user_id]['married_to']
+    return await cluster.call(cluster.owner(user_id), 'get_married_to', user_id, username)
+
+# Set married_to only if it currently equals expected
+async def set_married_to(user_id: str, partner_id: Optional[str], expected: Optional[str]) -> bool:
+    if is_local(user_id):
+        init_user(int(user_id))
+        user = bot_data['users'][user_id]
+        if user['married_to'] != expected:
+            return False
+        user['married_to'] = partner_id
+        save_data(('users', user_id))
+        return True
+    return await cluster.call(cluster.owner(user_id), 'set_married_to', user_id, partner_id, expected)
+
+# Trade engine
+# Open offers live in bot_data['pending_trades'] and hold what they offer in
+# escrow (the card for 'sell' and 'swap', the coins for 'buy') until they
+# fill, are cancelled or expire. TradeBook indexes them so matching and
+# listing never look at user inventories:
+#   asks / bids    card id -> heap of (price, offer no.) / (-price, offer no.)
+#   by_card        (given card, wanted) -> swap offers, oldest first
+#   by_rarity      (given card's rarity, wanted) -> swap offers, oldest first
+# where wanted is ('c', card id) or ('r', rarity). Stale heap entries are
+# skipped when reached and compacted away once they outnumber live offers.
+# A fill pays both sides and removes the offers in one
+# save_data() call. In cluster mode the book lives on worker 0; users of
+# other workers are paid out as pending credits, saved with the fill and
+# retried like any other credit until their worker confirms them.
+# Like credits, a new offer is saved in the placing worker's pending_offers
+# under a request id until worker 0 answers; worker 0 keeps the answer in
+# placed_trades, so an offer resent after a timeout is placed only once.
+class TradeBook:
+    def __init__(self):
+        self.offers = {}
+        self.asks = {}
+        self.bids = {}
+        self.by_card = {}
+        self.by_rarity = {}
+        self.giving = {}
+        self.by_user = {}
+        # (expires, offer id) in expiry order
+        self.expiry = deque()
+        self.stale = 0
+        self.next_id = 1
+
+    def rebuild(self, offers: dict):
+        self.__init__()
+        self.offers = offers
+        for offer_id, offer in sorted(offers.items(), key=lambda x: x[1]['expires']):
+            self.index(offer_id, offer)
+            self.expiry.append((offer['expires'], offer_id))
+        self.next_id = max(map(int, offers), default=0) + 1
+
+    def index(self, offer_id: str, offer: dict):
+        seq = int(offer_id)
+        if offer['kind'] == 'sell':
+            heapq.heappush(self.asks.setdefault(offer['card'], []), (offer['price'], seq, offer_id))
+        elif offer['kind'] == 'buy':
+            heapq.heappush(self.bids.setdefault(offer['card'], []), (-offer['price'], seq, offer_id))
+        else:
+            want = tuple(offer['want'])
+            self.by_card.setdefault((offer['card'], want), {})[offer_id] = None
+            self.by_rarity.setdefault((offer['rarity'], want), {})[offer_id] = None
+            self.giving.setdefault(offer['card'], {})[offer_id] = None
+        self.by_user.setdefault(offer['user'], {})[offer_id] = None
+
+    # Take an offer out of the book; heap entries are dropped lazily
+    def remove(self, offer_id: str) -> dict:
+        offer = self.offers.pop(offer_id)
+        if offer['kind'] != 'swap':
+            self.stale += 1
+            if self.stale > len(self.offers) + 64:
+                self.compact()
+        else:
+            want = tuple(offer['want'])
+            for index, key in ((self.by_card, (offer['card'], want)),
+                               (self.by_rarity, (offer['rarity'], want)),
+                               (self.giving, offer['card'])):
+                bucket = index[key]
+                del bucket[offer_id]
+                if not bucket:
+                    del index[key]
+        user_offers = self.by_user[offer['user']]
+        del user_offers[offer_id]
+        if not user_offers:
+            del self.by_user[offer['user']]
+        return offer
+
+    def compact(self):
+        for heaps in (self.asks, self.bids):
+            for card_id, heap in list(heaps.items()):
+                heap[:] = [entry for entry in heap if entry[2] in self.offers]
+                if heap:
+                    heapq.heapify(heap)
+                else:
+                    del heaps[card_id]
+        self.stale = 0
+
+    def count(self, user_id: str) -> int:
+        return len(self.by_user.get(user_id, ()))
+
+    # Best live heap entry not placed by user_id, or None
+    def best(self, heap: list, user_id: str) -> Optional[str]:
+        own = []
+        found = None
+        while heap:
+            offer_id = heap[0][2]
+            if offer_id not in self.offers:
+                heapq.heappop(heap)
+            elif self.offers[offer_id]['user'] == user_id:
+                own.append(heapq.heappop(heap))
+            else:
+                found = offer_id
+                break
+        for entry in own:
+            heapq.heappush(heap, entry)
+        return found
+
+    # Oldest swap offer in buckets not placed by user_id, or None
+    def oldest(self, buckets: list, user_id: str) -> Optional[str]:
+        found = None
+        for bucket in buckets:
+            for offer_id in bucket:
+                if self.offers[offer_id]['user'] != user_id:
+                    if found is None or int(offer_id) < int(found):
+                        found = offer_id
+                    break
+        return found
+
+    # Resting offer the new one trades against, or None
+    def match(self, offer: dict) -> Optional[str]:
+        user_id, card = offer['user'], offer['card']
+        if offer['kind'] == 'sell':
+            offer_id = self.best(self.bids.get(card, []), user_id)
+            if offer_id is not None and self.offers[offer_id]['price'] >= offer['price']:
+                return offer_id
+        elif offer['kind'] == 'buy':
+            offer_id = self.best(self.asks.get(card, []), user_id)
+            if offer_id is not None and self.offers[offer_id]['price'] <= offer['price']:
+                return offer_id
+        else:
+            # The other side must give what this one wants and want what it gives
+            theirs = (('c', card), ('r', offer['rarity']))
+            kind, wanted = offer['want']
+            index = self.by_card if kind == 'c' else self.by_rarity
+            return self.oldest([index[(wanted, w)] for w in theirs if (wanted, w) in index], user_id)
+        return None
+
+    # Fill the offer against the book or list it; returns (offer id if
+    # listed, fill if traded). A fill names what each user receives
+    def place(self, offer: dict) -> tuple:
+        other_id = self.match(offer)
+        if other_id is None:
+            offer_id = str(self.next_id)
+            self.next_id += 1
+            self.offers[offer_id] = offer
+            self.index(offer_id, offer)
+            self.expiry.append((offer['expires'], offer_id))
+            return offer_id, None
+        other = self.remove(other_id)
+        if offer['kind'] == 'swap':
+            deliveries = [(offer['user'], other['card'], 0), (other['user'], offer['card'], 0)]
+            price = 0
+        else:
+            # Resting offers set the price; a buyer who bid more gets the rest back
+            seller, buyer = (offer, other) if offer['kind'] == 'sell' else (other, offer)
+            price = other['price']
+            deliveries = [(seller['user'], None, price), (buyer['user'], offer['card'], buyer['price'] - price)]
+        return None, {'offer': other_id, 'other': other, 'price': price, 'deliveries': deliveries}
+
+    # Remove offers past their expiry time; returns them
+    def expire(self, now: float) -> list:
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            _, offer_id = self.expiry.popleft()
+            if offer_id in self.offers:
+                expired.append((offer_id, self.remove(offer_id)))
+        return expired
+
+    def listing(self, card_id: str, limit: int = 5) -> dict:
+        def live(heap):
+            return heapq.nsmallest(limit, (e for e in heap if e[2] in self.offers))
+        return {
+            'asks': [(e[0], self.offers[e[2]]['username']) for e in live(self.asks.get(card_id, []))],
+            'bids': [(-e[0], self.offers[e[2]]['username']) for e in live(self.bids.get(card_id, []))],
+            'swaps': [(self.offers[oid]['want'], self.offers[oid]['username'])
+                      for oid in itertools.islice(self.giving.get(card_id, {}), limit)]
+        }
+
+trade_book = TradeBook()
+
+# What an offer holds in escrow, as a (user, card, coins) delivery
+def trade_refund(offer: dict) -> tuple:
+    if offer['kind'] == 'buy':
+        return offer['user'], None, offer['price']
+    return offer['user'], offer['card'], 0
+
+# Give a user the cards/coins a trade delivers to them
+def apply_delivery(user_id: str, card_id: Optional[str], coins: int):
+    init_user(int(user_id))
+    if card_id is not None:
+        add_card(user_id, card_id)
+    if coins:
+        add_coins(user_id, coins, 'trade')
+
+# Credits sent right after a remote delivery is saved
+delivery_tasks = set()
+
+# Deliver locally or as a pending credit to the owning worker; returns
+# the keys to save
+def deliver(user_id: str, card_id: Optional[str], coins: int) -> list:
+    if is_local(user_id):
+        apply_delivery(user_id, card_id, coins)
+        return [('users', user_id)]
+    credit_id = new_credit(user_id, None, coins, 'trade', card_id=card_id)
+    # Runs after the caller has saved the pending credit
+    task = asyncio.get_running_loop().create_task(send_credit(credit_id))
+    delivery_tasks.add(task)
+    task.add_done_callback(delivery_tasks.discard)
+    return [('pending_credits', credit_id)]
+
+# Run an op where the trade book and duels live
+async def central_call(op: str, *args):
+    if cluster is None:
+        return await CLUSTER_OPS[op](*args)
+    return await cluster.call(0, op, *args)
+
+# Offer requests with a call under way
+offers_in_flight = set()
+
+# Send a pending offer to the book; returns (status, offer id, fill) like
+# op_trade_place, or 'pending' when unconfirmed. Refunds the escrow if the
+# offer was refused
+async def place_offer(request: str) -> tuple:
+    offer = bot_data['pending_offers'][request]
+    offers_in_flight.add(request)
+    try:
+        status, offer_id, fill = await central_call('trade_place', offer)
+    except ClusterError:
+        status, offer_id, fill = 'error', None, None
+    except asyncio.TimeoutError:
+        logger.warning(f"Trade offer {request} from {offer['user']} unconfirmed, will retry")
+        return 'pending', None, None
+    finally:
+        offers_in_flight.discard(request)
+    if bot_data['pending_offers'].pop(request, None) is None:
+        return status, offer_id, fill
+    keys = [('pending_offers', request)]
+    if status in ('limit', 'error'):
+        apply_delivery(*trade_refund(offer))
+        keys.append(('users', offer['user']))
+    save_data(*keys)
+    return status, offer_id, fill
+
+async def retry_offers(bot):
+    for request in [r for r in bot_data['pending_offers'] if r not in offers_in_flight]:
+        status, _, fill = await place_offer(request)
+        if status == 'filled':
+            await notify_trade(bot, fill)
+
+# Refund expired offers and forget answers older than CREDIT_KEEP_HOURS
+def expire_trades(now: float):
+    keys = []
+    for offer_id, offer in trade_book.expire(now):
+        keys.append(('pending_trades', offer_id))
+        keys += deliver(*trade_refund(offer))
+    placed = bot_data['placed_trades']
+    cutoff = now - CREDIT_KEEP_HOURS * 3600
+    # Requests are added in time order
+    old = list(itertools.takewhile(lambda request: placed[request]['time'] < cutoff, placed))
+    for request in old:
+        del placed[request]
+        keys.append(('placed_trades', request))
+    if keys:
+        save_data(*keys)
+
+async def run_trade_expiry():
+    while True:
+        await asyncio.sleep(TRADE_SWEEP_INTERVAL)
+        expire_trades(time.time())
+
+# Fusion engine
+# FUSION_COST cards of one rarity fuse into a random card of the next
+# rarity in RARITIES. Recipes are fixed by that order, so what a user can
+# fuse comes from their cached rarity_counts plus the drop engine's
+# per-rarity card ids, without looking at the catalogue.
+FUSION_RECIPES = dict(zip(RARITIES, list(RARITIES)[1:]))
+
+# Rarity -> how many fusions the user's cards allow
+def fusible(user) -> dict:
+    counts = user.get('rarity_counts', {})
+    return {
+        rarity: counts.get(rarity, 0) // FUSION_COST
+        for rarity, target in FUSION_RECIPES.items()
+        if counts.get(rarity, 0) >= FUSION_COST and drop_engine.ids[target]
+    }
+
+# Card ids of one rarity to use up, one entry per copy: spare copies
+# first, then (unless spare_only) single copies with favorites last
+def fusion_inputs(user, rarity: str, spare_only: bool = False) -> list:
+    cards = bot_data['cards']
+    spare, single = [], []
+    for card_id, count in user['cards'].items():
+        card = cards.get(card_id)
+        if card and card['rarity'] == rarity:
+            spare += [card_id] * (count - 1)
+            single.append(card_id)
+    if spare_only:
+        return spare
+    favorites = set(user.get('favorite_cards', ()))
+    single.sort(key=lambda card_id: card_id in favorites)
+    return spare + single
+
+# Fuse up to times batches of inputs; returns the new card ids.
+# The caller saves the user once
+def fuse(user_id: str, rarity: str, inputs: list, times: int) -> list:
+    targets = drop_engine.ids[FUSION_RECIPES[rarity]]
+    times = min(times, len(inputs) // FUSION_COST)
+    for card_id, count in Counter(inputs[:times * FUSION_COST]).items():
+        add_card(user_id, card_id, -count)
+    results = [random.choice(targets) for _ in range(times)]
+    for card_id, count in Counter(results).items():
+        add_card(user_id, card_id, count)
+    return results
+
+# Duel engine
+# A duel is two teams of rarities. A card's attack grows with log2 of its
+# RARITIES value and its HP is 3x attack. Sides take turns moving with
+# their first standing card:
+#   attack    0.85-1.15x attack, 10% chance of a 1.5x critical
+#   special   2x attack on a coin flip, otherwise a miss
+#   guard     heal 10% of max HP and halve the next hit taken
+# A side wins when the other has no cards left; after DUEL_MAX_TURNS each
+# the side with more HP left (as a share of its total) wins. Duel only
+# depends on the teams, the seed and the moves, so a battle replays
+# exactly from those three and runs without Telegram. Seeding the Random
+# costs more than a whole turn, so each battle seeds exactly one.
+DUEL_MOVES = ('attack', 'special', 'guard')
+
+def card_power(rarity: str) -> tuple:
+    attack = int(10 * math.log2(RARITIES[rarity]['value']))
+    return 3 * attack, attack
+
+CARD_HP = {rarity: card_power(rarity)[0] for rarity in RARITIES}
+CARD_ATTACK = {rarity: card_power(rarity)[1] for rarity in RARITIES}
+
+class Duel:
+    __slots__ = ('rng', 'max_hp', 'hp', 'attack', 'active', 'guard', 'turn', 'moves', 'winner')
+
+    def __init__(self, teams: list, seed: int):
+        self.rng = random.Random(seed)
+        self.max_hp = [list(map(CARD_HP.__getitem__, team)) for team in teams]
+        self.hp = [list(side) for side in self.max_hp]
+        self.attack = [list(map(CARD_ATTACK.__getitem__, team)) for team in teams]
+        self.active = [0, 0]
+        self.guard = [False, False]
+        self.turn = 0
+        self.moves = []
+        # 0 or 1 once over; None while running or after a draw
+        self.winner = None
+
+    @property
+    def side(self) -> int:
+        return self.turn & 1
+
+    @property
+    def over(self) -> bool:
+        return self.winner is not None or self.turn >= 2 * DUEL_MAX_TURNS
+
+    # Play the moving side's turn; returns (damage, critical, knocked out)
+    def play(self, move: str) -> tuple:
+        side = self.turn & 1
+        foe = side ^ 1
+        rng = self.rng
+        hp, guard = self.hp, self.guard
+        me, target = self.active[side], self.active[foe]
+        damage, critical, knocked_out = 0, False, False
+        if move == 'guard':
+            top = self.max_hp[side][me]
+            hp[side][me] = min(top, hp[side][me] + top // 10)
+            guard[side] = True
+        else:
+            if move == 'attack':
+                damage = self.attack[side][me] * (0.85 + 0.3 * rng.random())
+                if rng.random() < 0.1:
+                    damage *= 1.5
+                    critical = True
+            elif rng.random() < 0.5:
+                damage = self.attack[side][me] * (1.7 + 0.6 * rng.random())
+            if damage and guard[foe]:
+                damage /= 2
+                guard[foe] = False
+            damage = int(damage)
+            left = hp[foe][target] - damage
+            if left > 0:
+                hp[foe][target] = left
+            else:
+                hp[foe][target] = 0
+                knocked_out = True
+                self.active[foe] = target + 1
+                guard[foe] = False
+                if target + 1 == len(hp[foe]):
+                    self.winner = side
+        self.moves.append(move)
+        self.turn += 1
+        if self.turn >= 2 * DUEL_MAX_TURNS and self.winner is None:
+            left = [sum(hp[i]) / sum(self.max_hp[i]) for i in (0, 1)]
+            if left[0] != left[1]:
+                self.winner = 0 if left[0] > left[1] else 1
+        return damage, critical, knocked_out
+
+# Rebuild a duel from its record
+def replay_duel(teams: list, seed: int, moves: list) -> Duel:
+    duel = Duel(teams, seed)
+    for move in moves:
+        duel.play(move)
+    return duel
+
+# Play a whole duel with both sides picking moves at random by DUEL_MOVES
+# weight. Picks come from the duel's own stream, so the same teams and
+# seed replay the same battle
+def simulate_duel(teams: list, seed: int, weights: tuple = (70, 15, 15)) -> Duel:
+    duel = Duel(teams, seed)
+    rng = duel.rng
+    total = sum(weights)
+    attack, special = weights[0] / total, (weights[0] + weights[1]) / total
+    turns = 2 * DUEL_MAX_TURNS
+    while duel.winner is None and duel.turn < turns:
+        pick = rng.random()
+        duel.play('attack' if pick < attack else 'special' if pick < special else 'guard')
+    return duel
+
+# Run many duels between two teams; returns wins per side and draws
+def simulate_duels(teams: list, count: int, seed: int = 0) -> dict:
+    wins = [0, 0]
+    turns = 0
+    for i in range(count):
+        duel = simulate_duel(teams, seed + i)
+        if duel.winner is not None:
+            wins[duel.winner] += 1
+        turns += duel.turn
+    return {'wins': wins, 'draws': count - sum(wins), 'avg_turns': turns / count if count else 0}
+
+# A user's strongest DUEL_TEAM_SIZE cards as rarities, read from the
+# cached per-rarity tallies
+def duel_team(user) -> list:
+    counts = user.get('rarity_counts', {})
+    team = []
+    for rarity in reversed(RARITIES):
+        team += [rarity] * min(counts.get(rarity, 0), DUEL_TEAM_SIZE - len(team))
+        if len(team) == DUEL_TEAM_SIZE:
+            break
+    return team
+
+async def get_duel_team(user_id: str, username: Optional[str]) -> list:
+    if is_local(user_id):
+        init_user(int(user_id), username)
+        return duel_team(bot_data['users'][user_id])
+    return await cluster.call(cluster.owner(user_id), 'duel_team', user_id, username)
+
+# Duels and the matchmaking queue live where central_call() runs them.
+# Records in bot_data['pending_duels'] hold players, names, teams, seed,
+# moves, chat and expiry; duels caches their replayed Duel objects and
+# duel_queues holds, per chat, users waiting for an opponent.
+# Every expiry set is also appended to duel_deadlines / queue_deadlines;
+# DUEL_TIMEOUT is fixed, so they stay in expiry order and a sweep only
+# looks at entries that are due. An entry whose record was pushed back or
+# removed since is skipped when reached
+duels = {}
+duel_queues = {}
+duel_deadlines = deque()
+queue_deadlines = deque()
+next_duel_id = 1
+
+def index_duels(pending: dict):
+    global next_duel_id
+    duels.clear()
+    duel_deadlines.clear()
+    duel_deadlines.extend(sorted((record['expires'], duel_id) for duel_id, record in pending.items()))
+    next_duel_id = max(map(int, pending), default=0) + 1
+
+def duel_state(duel_id: str) -> Optional[Duel]:
+    record = bot_data['pending_duels'].get(duel_id)
+    if record is None or record['status'] != 'live':
+        return None
+    if duel_id not in duels:
+        duels[duel_id] = replay_duel(record['teams'], record['seed'], record['moves'])
+    return duels[duel_id]
+
+def duel_text(record: dict, duel: Duel, event: str = '') -> str:
+    lines = [f"⚔️ {record['names'][0]} vs {record['names'][1]}\n"]
+    for side in (0, 1):
+        cards = ' '.join(
+            f"{RARITIES[rarity]['emoji']}{hp}" if hp else '💀'
+            for rarity, hp in zip(record['teams'][side], duel.hp[side])
+        )
+        lines.append(f"{record['names'][side]}: {cards}")
+    if event:
+        lines.append(f"\n{event}")
+    if duel.over:
+        if duel.winner is None:
+            lines.append("\n🤝 သရေ!")
+        else:
+            lines.append(f"\n🏆 {record['names'][duel.winner]} အနိုင်ရ! +{DUEL_REWARD:,} Coins")
+    else:
+        lines.append(f"\n👉 {record['names'][duel.side]} ၏ အလှည့်")
+    return '\n'.join(lines)
+
+# Drop duels and queue entries nobody touched for DUEL_TIMEOUT; returns
+# the keys to save
+def expire_duels(now: float) -> list:
+    pending = bot_data['pending_duels']
+    keys = []
+    while duel_deadlines and duel_deadlines[0][0] <= now:
+        _, duel_id = duel_deadlines.popleft()
+        record = pending.get(duel_id)
+        if record is not None and record['expires'] <= now:
+            del pending[duel_id]
+            duels.pop(duel_id, None)
+            keys.append(('pending_duels', duel_id))
+    while queue_deadlines and queue_deadlines[0][0] <= now:
+        _, chat_id, user_id = queue_deadlines.popleft()
+        queue = duel_queues.get(chat_id, {})
+        entry = queue.get(user_id)
+        if entry is not None and entry['expires'] <= now:
+            del queue[user_id]
+            if not queue:
+                del duel_queues[chat_id]
+    return keys
+
+# Set a duel's expiry DUEL_TIMEOUT from now
+def extend_duel(duel_id: str, now: float):
+    bot_data['pending_duels'][duel_id]['expires'] = now + DUEL_TIMEOUT
+    duel_deadlines.append((now + DUEL_TIMEOUT, duel_id))
 
-# Get rarity by chance
-def get_random_rarity():
-    rand = random.uniform(0, 100)
-    cumulative = 0
-    for rarity, data in RARITIES.items():
-        cumulative += data['drop_chance']
-        if rand <= cumulative:
-            return rarity
-    return 'Common'
+async def run_duel_expiry():
+    while True:
+        await asyncio.sleep(DUEL_SWEEP_INTERVAL)
+        keys = expire_duels(time.time())
+        if keys:
+            save_data(*keys)
+
+def new_duel(chat_id: str, players: list, names: list, teams: list, status: str) -> str:
+    global next_duel_id
+    duel_id = str(next_duel_id)
+    next_duel_id += 1
+    bot_data['pending_duels'][duel_id] = {
+        'players': players,
+        'names': names,
+        'teams': teams,
+        'seed': random.getrandbits(32),
+        'moves': [],
+        'chat': chat_id,
+        'status': status
+    }
+    extend_duel(duel_id, time.time())
+    return duel_id
 
 # Check if user is sudo
 def is_sudo(user_id: int) -> bool:
@@ -150,7 +3372,7 @@ async def upload_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "ဥပမာ: Naruto | Naruto Shippuden | Legendary"
     )
     bot_data['pending_uploads'][str(update.effective_user.id)] = 'waiting'
-    save_data()
+    save_data(('pending_uploads', str(update.effective_user.id)))
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -187,8 +3409,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'created_at': datetime.now().isoformat()
             }
             
+            drop_engine.add(card_id, bot_data['cards'][card_id]['rarity'])
+            index_card_name(card_id)
             del bot_data['pending_uploads'][user_id]
-            save_data()
+            save_data(('cards', card_id), ('pending_uploads', user_id))
             
             emoji = RARITIES[rarity]['emoji']
             await update.message.reply_text(
@@ -214,7 +3438,7 @@ async def upload_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "(Rarity သည် Animated အဖြစ် အလိုအလျောက်သတ်မှတ်ပါမည်)"
     )
     bot_data['pending_uploads'][str(update.effective_user.id)] = 'video'
-    save_data()
+    save_data(('pending_uploads', str(update.effective_user.id)))
 
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -247,8 +3471,10 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'created_at': datetime.now().isoformat()
             }
             
+            drop_engine.add(card_id, bot_data['cards'][card_id]['rarity'])
+            index_card_name(card_id)
             del bot_data['pending_uploads'][user_id]
-            save_data()
+            save_data(('cards', card_id), ('pending_uploads', user_id))
             
             await update.message.reply_text(
                 f"✅ Video ကဒ်ထည့်ပြီး!\n\n"
@@ -280,7 +3506,8 @@ async def edit_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     bot_data['cards'][card_id]['name'] = name
     bot_data['cards'][card_id]['movie'] = movie
-    save_data()
+    index_card_name(card_id)
+    save_data(('cards', card_id))
     
     await update.message.reply_text(f"✅ ကဒ် {card_id} ကို ပြင်ဆင်ပြီး!")
 
@@ -300,7 +3527,9 @@ async def delete_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     del bot_data['cards'][card_id]
-    save_data()
+    drop_engine.remove(card_id)
+    card_keys.pop(card_id, None)
+    save_data(('cards', card_id))
     
     await update.message.reply_text(f"✅ ကဒ် {card_id} ကို ဖျက်ပြီး!")
 
@@ -317,48 +3546,180 @@ async def set_drop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         drop_count = int(context.args[0])
         chat_id = str(update.effective_chat.id)
         bot_data['drop_settings'][chat_id] = drop_count
-        save_data()
+        if update.effective_chat.id in group_counters:
+            group_counters[update.effective_chat.id].threshold = drop_count
+        save_data(('drop_settings', chat_id))
         
         await update.message.reply_text(f"✅ Drop time ကို {drop_count} messages အဖြစ်သတ်မှတ်ပြီး!")
     except ValueError:
         await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
 
+# Counters for /stats from this process
+def local_stats() -> dict:
+    sync_group_counters()
+    top_groups = sorted(
+        bot_data['groups'].values(),
+        key=lambda g: g.get('message_count', 0),
+        reverse=True
+    )[:5]
+    return {
+        'users': len(bot_data['users']),
+        'groups': len(bot_data['groups']),
+        'top_groups': [(g.get('title', 'Unknown'), g.get('message_count', 0)) for g in top_groups],
+        'writes': flusher.writes,
+        'coalesced': flusher.coalesced
+    }
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_sudo(update.effective_user.id):
         await update.message.reply_text("⛔ သင်သည် Admin မဟုတ်ပါ။")
         return
     
-    total_users = len(bot_data['users'])
-    total_groups = len(bot_data['groups'])
+    parts = [local_stats()] if cluster is None else await cluster.call_all('stats')
+    total_users = sum(part['users'] for part in parts)
+    total_groups = sum(part['groups'] for part in parts)
     total_cards = len(bot_data['cards'])
     
     stats_text = (
         f"📊 Bot Statistics\n\n"
         f"👥 Total Users: {total_users}\n"
         f"💬 Total Groups: {total_groups}\n"
-        f"🎴 Total Cards: {total_cards}\n\n"
+        f"🎴 Total Cards: {total_cards}\n"
+        f"💾 Saves: {sum(part['writes'] for part in parts):,} writes, "
+        f"{sum(part['coalesced'] for part in parts):,} coalesced\n\n"
         f"🔝 Top 5 Groups:\n"
     )
     
     sorted_groups = sorted(
-        bot_data['groups'].items(),
-        key=lambda x: x[1].get('message_count', 0),
+        (group for part in parts for group in part['top_groups']),
+        key=lambda x: x[1],
         reverse=True
     )[:5]
     
-    for i, (gid, gdata) in enumerate(sorted_groups, 1):
-        stats_text += f"{i}. {gdata.get('title', 'Unknown')} - {gdata.get('message_count', 0)} msgs\n"
+    for i, (title, message_count) in enumerate(sorted_groups, 1):
+        stats_text += f"{i}. {title} - {message_count} msgs\n"
     
     await update.message.reply_text(stats_text)
 
+async def check_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_sudo(update.effective_user.id):
+        await update.message.reply_text("⛔ သင်သည် Admin မဟုတ်ပါ။")
+        return
+    
+    fixed = rebuild_indexes()
+    if fixed:
+        save_data()
+    
+    await update.message.reply_text(
+        f"🔍 Data Check ပြီးပါပြီ!\n\n"
+        f"👥 Users: {len(bot_data['users']):,}\n"
+        f"🛠 Fixed: {fixed:,}"
+    )
+
+# Whole bot_data assembled from every cluster worker's users and groups
+async def cluster_snapshot() -> dict:
+    parts = await cluster.call_all('snapshot')
+    data = dict(bot_data, users={}, groups={})
+    for part in parts:
+        data['users'].update(part['users'])
+        data['groups'].update(part['groups'])
+    return data
+
+# /perf lines for one metrics family, slowest total time first
+def perf_lines(family: str, limit: int) -> str:
+    series = sorted(metrics.series[family].items(), key=lambda x: x[1].sum, reverse=True)[:limit]
+    if not series:
+        return "-\n"
+    text = ""
+    for label, h in series:
+        p99 = h.quantile(0.99)
+        p99_text = f"≤{p99 * 1000:g}ms" if p99 != float('inf') else f">{METRIC_BUCKETS[-1]:g}s"
+        text += (
+            f"{label} - {h.count:,} calls, {h.errors:,} err\n"
+            f"   avg {h.sum / h.count * 1000:.2f}ms, p99 {p99_text}\n"
+        )
+    return text
+
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_sudo(update.effective_user.id):
+        await update.message.reply_text("⛔ သင်သည် Admin မဟုတ်ပါ။")
+        return
+    
+    title = "📈 Performance" if cluster is None else f"📈 Performance (worker {cluster.index})"
+    cache_text = ""
+    if isinstance(bot_data['users'], UserCache):
+        c = bot_data['users'].stats()
+        cache_text = (
+            f"\n🗃 User cache: {c['size']:,}/{c['capacity']:,}\n"
+            f"   hit {c['hit_rate']:.1%} ({c['hits']:,}/{c['misses']:,} miss)\n"
+            f"   evicted {c['evictions']:,}, written back {c['write_backs']:,}\n"
+        )
+    await update.message.reply_text(
+        f"{title}\n\n"
+        f"🔝 Handlers:\n{perf_lines('handler', 10)}\n"
+        f"💾 Storage:\n{perf_lines('storage', 5)}\n"
+        f"🌐 Bot API:\n{perf_lines('api', 5)}"
+        f"{cache_text}"
+    )
+
+def ledger_lines(entries: list) -> str:
+    return '\n'.join(
+        f"{datetime.fromtimestamp(created).strftime('%m-%d %H:%M')} {delta:+,} {reason}"
+        + (f" ({ref})" if ref else "")
+        for _, delta, reason, ref, created in entries
+    )
+
+# /ledger <user_id> shows a user's coin entries; /ledger check compares
+# every stored balance with the ledger
+async def ledger_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_sudo(update.effective_user.id):
+        await update.message.reply_text("⛔ သင်သည် Admin မဟုတ်ပါ။")
+        return
+    
+    args = context.args
+    if len(args) == 1 and args[0].lower() == 'check':
+        reports = [await reconcile_ledger()] if cluster is None else await cluster.call_all('ledger_reconcile')
+        mismatches = {}
+        for report in reports:
+            mismatches.update(report['mismatches'])
+        text = (
+            f"📒 Ledger Check\n\n"
+            f"🧾 Entries: {sum(r['entries'] for r in reports):,}\n"
+            f"👥 Users: {sum(r['users'] for r in reports):,}\n"
+            f"⚖️ Total: {sum(r['total'] for r in reports):,}\n"
+            f"❓ Missing users: {sum(r['missing'] for r in reports):,}\n"
+            f"❌ Mismatches: {len(mismatches):,}\n"
+            f"⏱ {max(r['seconds'] for r in reports)}s"
+        )
+        for user_id, (expected, stored) in itertools.islice(mismatches.items(), 10):
+            text += f"\n{user_id}: ledger {expected:,} / stored {stored:,}"
+        await update.message.reply_text(text)
+        return
+    
+    if len(args) != 1 or not args[0].isdigit():
+        await update.message.reply_text("❌ Format: /ledger <user_id|check>")
+        return
+    
+    user_id = args[0]
+    if is_local(user_id):
+        entries, balance = await ledger_history(user_id)
+    else:
+        entries, balance = await cluster.call(cluster.owner(user_id), 'ledger_history', user_id)
+    await update.message.reply_text(
+        f"📒 Ledger: {user_id}\n"
+        f"💵 Balance: {balance:,} Coins\n\n"
+        f"{ledger_lines(entries) or '-'}"
+    )
+
 async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_sudo(update.effective_user.id):
         await update.message.reply_text("⛔ သင်သည် Admin မဟုတ်ပါ။")
         return
     
     try:
+        data = bot_data if cluster is None else await cluster_snapshot()
         with open(BACKUP_FILE, 'w', encoding='utf-8') as f:
-            json.dump(bot_data, f, ensure_ascii=False, indent=2)
+            json.dump(data, f, ensure_ascii=False, indent=2, default=json_default)
         
         await update.message.reply_document(
             document=open(BACKUP_FILE, 'rb'),
@@ -368,6 +3729,21 @@ async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Backup Error: {str(e)}")
 
+# Swap in new bot_data (restore, allclear)
+def replace_data(data: dict):
+    global bot_data
+    bot_data = shard_slice(data)
+    pack_users(bot_data['users'])
+    rebuild_indexes()
+    save_data()
+    if lazy_users():
+        # Written out in full above; from here on users are read on demand
+        if flusher.executor is not None:
+            flusher.flush()
+        bot_data['users'] = UserCache(storage, storage.cache_size)
+    # Restored balances didn't go through the ledger
+    sync_ledger()
+
 async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_sudo(update.effective_user.id):
         await update.message.reply_text("⛔ သင်သည် Admin မဟုတ်ပါ။")
@@ -375,29 +3751,28 @@ async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("📥 Backup file ပို့ပါ")
     bot_data['pending_uploads'][str(update.effective_user.id)] = 'restore'
-    save_data()
+    save_data(('pending_uploads', str(update.effective_user.id)))
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ၁။ global declaration ကို function ရဲ့ ထိပ်ဆုံးမှာ ထားပါ
-    global bot_data
-    
     user_id = str(update.effective_user.id)
     
-    # ယခု bot_data ကို အသုံးပြု၍ ရပါပြီ (အပေါ်မှာ global ကြေညာခဲ့လို့ပါ)
     if user_id in bot_data['pending_uploads'] and bot_data['pending_uploads'][user_id] == 'restore':
         try:
             file = await context.bot.get_file(update.message.document.file_id)
             await file.download_to_drive('temp_restore.json')
             
             with open('temp_restore.json', 'r', encoding='utf-8') as f:
-                # ဤနေရာမှ 'global bot_data' ကို ဖယ်ထုတ်လိုက်ပါ (အပေါ်မှာ ထားခဲ့ပြီးသားဖြစ်လို့)
-                bot_data = json.load(f)
+                data = json.load(f)
             
-            save_data()
+            # Every cluster worker keeps its own share of the backup
+            if cluster is not None:
+                cluster.cast_others('restore', data)
+            # bot_data ကို replace_data() က အစားထိုးပါသည်
+            replace_data(data)
             os.remove('temp_restore.json')
             
             del bot_data['pending_uploads'][user_id]
-            save_data()
+            save_data(('pending_uploads', user_id))
             
             await update.message.reply_text("✅ Data ပြန်ယူပြီး!")
         except Exception as e:
@@ -437,7 +3812,7 @@ async def add_sudo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if new_sudo not in bot_data['sudo_users']:
         bot_data['sudo_users'].append(new_sudo)
-        save_data()
+        save_data(('sudo_users',))
         await update.message.reply_text(f"✅ {update.message.reply_to_message.from_user.first_name} ကို Admin ခန့်ပြီး!")
     else:
         await update.message.reply_text("❌ ဤ user သည် Admin ဖြစ်နေပြီးဖြစ်သည်")
@@ -467,28 +3842,54 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if len(context.args) == 0:
-        await update.message.reply_text("❌ Format: /broadcast <message>")
+        await update.message.reply_text("❌ Format: /broadcast <message>\n/broadcast resume\n/broadcast cancel")
         return
     
-    message = ' '.join(context.args)
-    success = 0
-    failed = 0
+    # Each cluster worker broadcasts to the groups it owns and reports on its own
+    if cluster is not None:
+        cluster.cast_others('broadcast', list(context.args), update.effective_chat.id)
+    await start_broadcast(context.application, list(context.args), update.message.reply_text)
+
+# Start, resume or cancel this process's broadcast; reply sends a status text
+async def start_broadcast(application: Application, args: list, reply):
+    global broadcast_task
+    command = args[0].lower() if len(args) == 1 else None
+    state = bot_data.get('broadcast')
     
-    status_msg = await update.message.reply_text("📢 Broadcasting...")
+    if command == 'cancel':
+        if broadcast_task is not None:
+            broadcast_task.cancel()
+            broadcast_task = None
+        if state:
+            del bot_data['broadcast']
+            save_data(('broadcast',))
+        await reply("🛑 Broadcast ကို ပယ်ဖျက်ပြီး")
+        return
     
-    for group_id in bot_data['groups'].keys():
-        try:
-            await context.bot.send_message(chat_id=int(group_id), text=message)
-            success += 1
-        except:
-            failed += 1
-        await asyncio.sleep(0.05)  # Avoid flood limits
+    if broadcast_task is not None:
+        await reply("⏳ Broadcast လုပ်နေဆဲဖြစ်သည်")
+        return
+    
+    if command == 'resume':
+        if not state:
+            await reply("❌ ပြန်စရန် Broadcast မရှိပါ")
+            return
+    elif state:
+        await reply(
+            "⚠️ မပြီးသေးသော Broadcast ရှိနေသည်\n"
+            "/broadcast resume သို့မဟုတ် /broadcast cancel ကိုသုံးပါ"
+        )
+        return
+    else:
+        bot_data['broadcast'] = {
+            'message': ' '.join(args),
+            'started_at': datetime.now().isoformat(),
+            'results': {}
+        }
+        save_data(('broadcast',))
     
-    await status_msg.edit_text(
-        f"📢 Broadcast ပြီးပါပြီ!\n\n"
-        f"✅ အောင်မြင်: {success}\n"
-        f"❌ မအောင်မြင်: {failed}"
-    )
+    status_msg = await reply("📢 Broadcasting...")
+    broadcast_task = application.create_task(run_broadcast(application.bot, status_msg))
 
 # User Commands
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -504,6 +3905,18 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🎴 Cards: {card_count}"
     )
 
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    init_user(update.effective_user.id, update.effective_user.username)
+    
+    entries, _ = await ledger_history(user_id)
+    if not entries:
+        await update.message.reply_text("📭 Coin မှတ်တမ်း မရှိပါ")
+        return
+    
+    await update.message.reply_text(f"📒 Coin History\n\n{ledger_lines(entries)}")
+
+@locked(user_key)
 async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
@@ -520,9 +3933,9 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     reward = random.randint(500, 1000)
-    bot_data['users'][user_id]['balance'] += reward
+    add_coins(user_id, reward, 'daily')
     bot_data['users'][user_id]['last_daily'] = datetime.now().isoformat()
-    save_data()
+    save_data(('users', user_id))
     
     await update.message.reply_text(f"🎁 Daily Bonus: +{reward:,} Coins!")
 
@@ -536,6 +3949,7 @@ async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(shop_text)
 
+@locked(user_key)
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
@@ -558,22 +3972,20 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Coins မလုံလောက်ပါ")
             return
         
-        bot_data['users'][user_id]['balance'] -= item_data['price']
+        add_coins(user_id, -item_data['price'], 'shop', item_name)
         
         if item_data['type'] == 'pack':
             cards_won = []
             for _ in range(5):
-                if bot_data['cards']:
-                    card_id = random.choice(list(bot_data['cards'].keys()))
+                card_id = drop_engine.pick_any()
+                if card_id:
                     card = bot_data['cards'][card_id]
                     
-                    if card_id not in bot_data['users'][user_id]['cards']:
-                        bot_data['users'][user_id]['cards'][card_id] = 0
-                    bot_data['users'][user_id]['cards'][card_id] += 1
+                    add_card(user_id, card_id)
                     
                     cards_won.append(f"{RARITIES[card['rarity']]['emoji']} {card['name']}")
             
-            save_data()
+            save_data(('users', user_id))
             await update.message.reply_text(
                 f"🎁 Pack ဖွင့်ပြီး!\n\n" + "\n".join(cards_won)
             )
@@ -581,7 +3993,7 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if item_data['type'] not in bot_data['users'][user_id]['inventory']:
                 bot_data['users'][user_id]['inventory'][item_data['type']] = 0
             bot_data['users'][user_id]['inventory'][item_data['type']] += 1
-            save_data()
+            save_data(('users', user_id))
             
             await update.message.reply_text(f"✅ {item_name} ဝယ်ပြီး!")
             
@@ -589,16 +4001,72 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ နံပါတ် ထည့်ပါ")
 
 # Games
+SLOT_SYMBOLS = ['🍒', '🍋', '🍊', '🍇', '7️⃣']
+WHEEL_MULTIPLIERS = [0, 0.5, 1, 1.5, 2, 3, 5, 10]
+
+# Batched spins: /slots|/basket|/wheel <bet> x<spins> draws every spin's
+# randomness in one random.choices() call, pays each spin exactly what a
+# single command would, and applies the net result once
+def parse_spins(arg: str) -> Optional[int]:
+    if arg[:1].lower() == 'x' and arg[1:].isdigit():
+        return int(arg[1:])
+    return None
+
+# Balance change of each spin
+def spin_deltas(game: str, bet: int, spins: int) -> list:
+    if game == 'slots':
+        draws = random.choices(SLOT_SYMBOLS, k=3 * spins)
+        return [
+            (bet * 10 if a == '7️⃣' else bet * 3) if a == b == c else -bet
+            for a, b, c in zip(draws[0::3], draws[1::3], draws[2::3])
+        ]
+    if game == 'basket':
+        return [bet * 2 if roll < 50 else -bet for roll in random.choices(range(101), k=spins)]
+    return [int(bet * m) - bet for m in random.choices(WHEEL_MULTIPLIERS, k=spins)]
+
+async def play_spins(update: Update, game: str, bet: int, spins: int):
+    user_id = str(update.effective_user.id)
+    if not 1 <= spins <= GAME_MAX_SPINS[game]:
+        await update.message.reply_text(f"❌ Spin 1 - {GAME_MAX_SPINS[game]} ကြိမ်သာ ရပါသည်")
+        return
+    
+    # Every spin's bet must be covered up front
+    if bet <= 0 or bot_data['users'][user_id]['balance'] < bet * spins:
+        await update.message.reply_text("❌ ပမာဏ/Coins မှားနေပါသည်")
+        return
+    
+    deltas = spin_deltas(game, bet, spins)
+    net = sum(deltas)
+    add_coins(user_id, net, game, f"x{spins}")
+    save_data(('users', user_id))
+    
+    emoji = {'slots': '🎰', 'basket': '🏀', 'wheel': '🎡'}[game]
+    await update.message.reply_text(
+        f"{emoji} {spins} ကြိမ် x {bet:,} Coins\n\n"
+        f"✅ နိုင်: {sum(d > 0 for d in deltas)}/{spins}\n"
+        f"🏆 အများဆုံး: {max(deltas):+,} Coins\n"
+        f"{'🎉' if net >= 0 else '😢'} စုစုပေါင်း: {net:+,} Coins\n"
+        f"💵 Balance: {bot_data['users'][user_id]['balance']:,} Coins"
+    )
+
+@locked(user_key)
 async def slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    if len(context.args) != 1:
-        await update.message.reply_text("❌ Format: /slots <amount>")
+    if len(context.args) not in (1, 2):
+        await update.message.reply_text("❌ Format: /slots <amount> [x<spins>]")
         return
     
     try:
         bet = int(context.args[0])
+        if len(context.args) == 2:
+            spins = parse_spins(context.args[1])
+            if spins is None:
+                await update.message.reply_text("❌ Format: /slots <amount> [x<spins>]")
+                return
+            await play_spins(update, 'slots', bet, spins)
+            return
         if bet <= 0:
             await update.message.reply_text("❌ ပမာဏ မှားနေပါသည်")
             return
@@ -607,23 +4075,22 @@ async def slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Coins မလုံလောက်ပါ")
             return
         
-        symbols = ['🍒', '🍋', '🍊', '🍇', '7️⃣']
-        result = [random.choice(symbols) for _ in range(3)]
+        result = [random.choice(SLOT_SYMBOLS) for _ in range(3)]
         
         if result[0] == result[1] == result[2]:
             if result[0] == '7️⃣':
                 win = bet * 10
             else:
                 win = bet * 3
-            bot_data['users'][user_id]['balance'] += win
-            save_data()
+            add_coins(user_id, win, 'slots')
+            save_data(('users', user_id))
             await update.message.reply_text(
                 f"🎰 {' '.join(result)}\n\n"
                 f"🎉 သင်နိုင်ပြီ! +{win:,} Coins!"
             )
         else:
-            bot_data['users'][user_id]['balance'] -= bet
-            save_data()
+            add_coins(user_id, -bet, 'slots')
+            save_data(('users', user_id))
             await update.message.reply_text(
                 f"🎰 {' '.join(result)}\n\n"
                 f"😢 ရှုံးပါသည်! -{bet:,} Coins"
@@ -631,16 +4098,24 @@ async def slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
 
+@locked(user_key)
 async def basket(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    if len(context.args) != 1:
-        await update.message.reply_text("❌ Format: /basket <amount>")
+    if len(context.args) not in (1, 2):
+        await update.message.reply_text("❌ Format: /basket <amount> [x<spins>]")
         return
     
     try:
         bet = int(context.args[0])
+        if len(context.args) == 2:
+            spins = parse_spins(context.args[1])
+            if spins is None:
+                await update.message.reply_text("❌ Format: /basket <amount> [x<spins>]")
+                return
+            await play_spins(update, 'basket', bet, spins)
+            return
         if bet <= 0 or bot_data['users'][user_id]['balance'] < bet:
             await update.message.reply_text("❌ ပမာဏ/Coins မှားနေပါသည်")
             return
@@ -649,134 +4124,169 @@ async def basket(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if success:
             win = bet * 2
-            bot_data['users'][user_id]['balance'] += win
-            save_data()
+            add_coins(user_id, win, 'basket')
+            save_data(('users', user_id))
             await update.message.reply_text(f"🏀 သွင်းပြီး! +{win:,} Coins!")
         else:
-            bot_data['users'][user_id]['balance'] -= bet
-            save_data()
+            add_coins(user_id, -bet, 'basket')
+            save_data(('users', user_id))
             await update.message.reply_text(f"🏀 လွဲသွားပြီ! -{bet:,} Coins")
     except ValueError:
         await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
 
+@locked(user_key)
 async def wheel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    if len(context.args) != 1:
-        await update.message.reply_text("❌ Format: /wheel <amount>")
+    if len(context.args) not in (1, 2):
+        await update.message.reply_text("❌ Format: /wheel <amount> [x<spins>]")
         return
     
     try:
         bet = int(context.args[0])
+        if len(context.args) == 2:
+            spins = parse_spins(context.args[1])
+            if spins is None:
+                await update.message.reply_text("❌ Format: /wheel <amount> [x<spins>]")
+                return
+            await play_spins(update, 'wheel', bet, spins)
+            return
         if bet <= 0 or bot_data['users'][user_id]['balance'] < bet:
             await update.message.reply_text("❌ ပမာဏ/Coins မှားနေပါသည်")
             return
         
-        multipliers = [0, 0.5, 1, 1.5, 2, 3, 5, 10]
-        multiplier = random.choice(multipliers)
+        multiplier = random.choice(WHEEL_MULTIPLIERS)
         
         if multiplier == 0:
-            bot_data['users'][user_id]['balance'] -= bet
+            add_coins(user_id, -bet, 'wheel')
             result_text = f"🎡 Wheel: 0x\n😢 ရှုံးပါသည်! -{bet:,} Coins"
         else:
             win = int(bet * multiplier)
-            bot_data['users'][user_id]['balance'] += win - bet
+            add_coins(user_id, win - bet, 'wheel')
             result_text = f"🎡 Wheel: {multiplier}x\n🎉 +{win:,} Coins!"
         
-        save_data()
+        save_data(('users', user_id))
         await update.message.reply_text(result_text)
     except ValueError:
         await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
 
 # Card Drop System
 async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-        chat_id = str(update.effective_chat.id)
-        init_group(update.effective_chat.id, update.effective_chat.title)
-        
-        bot_data['groups'][chat_id]['message_count'] += 1
-        
-        drop_threshold = bot_data['drop_settings'].get(chat_id, 50)
-        
-        if bot_data['groups'][chat_id]['message_count'] >= drop_threshold:
-            bot_data['groups'][chat_id]['message_count'] = 0
-            bot_data['groups'][chat_id]['last_drop'] = datetime.now().isoformat()
-            save_data()
-            
-            if bot_data['cards']:
-                # Random card drop
-                card_id = random.choice(list(bot_data['cards'].keys()))
-                card = bot_data['cards'][card_id]
-                rarity_emoji = RARITIES[card['rarity']]['emoji']
-                
-                drop_text = (
-                    f"🎴 ကဒ်ကျလာပြီ!\n\n"
-                    f"{rarity_emoji} {card['name']}\n"
-                    f"🎬 {card['movie']}\n\n"
-                    f"📝 /catch {card['name']} ဖြင့် ဖမ်းပါ!"
-                )
-                
-                if card['type'] == 'video':
-                    await context.bot.send_video(
-                        chat_id=update.effective_chat.id,
-                        video=card['file_id'],
-                        caption=drop_text
-                    )
-                else:
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=card['file_id'],
-                        caption=drop_text
-                    )
-                
-                # Store last drop for catching
-                context.chat_data['last_drop'] = {
-                    'card_id': card_id,
-                    'card_name': card['name'].lower(),
-                    'time': datetime.now()
-                }
+    # Hottest path in the bot: runs for every group text message (the
+    # handler filter already limits it to groups), so it only touches
+    # the chat's cached counter until a drop is due
+    chat = update.effective_chat
+    counter = group_counters.get(chat.id) or get_group_counter(chat.id, chat.title)
+    counter.count += 1
+    if counter.count < counter.threshold:
+        return
+    
+    chat_id = str(chat.id)
+    counter.count = counter.synced = 0
+    counter.last_drop = datetime.now().isoformat()
+    bot_data['groups'][chat_id]['message_count'] = 0
+    bot_data['groups'][chat_id]['last_drop'] = counter.last_drop
+    save_data(('groups', chat_id))
+    
+    # Rarity-weighted card drop
+    card_id = drop_engine.pick()
+    if not card_id:
+        return
+    
+    # A new drop ends the previous one
+    old_drop = context.chat_data.get('last_drop')
+    if old_drop is not None:
+        drop_timers.cancel(chat.id)
+        expire_drop(context.chat_data, old_drop)
+    
+    card = bot_data['cards'][card_id]
+    drop_text = drop_caption(card)
+    
+    if card['type'] == 'video':
+        message = await context.bot.send_video(
+            chat_id=chat.id,
+            video=card['file_id'],
+            caption=drop_text
+        )
+    else:
+        message = await context.bot.send_photo(
+            chat_id=chat.id,
+            photo=card['file_id'],
+            caption=drop_text
+        )
+    
+    # Store last drop for catching until its timer expires it
+    drop = {
+        'card_id': card_id,
+        'card_name': card_keys[card_id],
+        'chat_id': chat.id,
+        'message_id': message.message_id,
+        'expires': time.monotonic() + DROP_TIMEOUT
+    }
+    context.chat_data['last_drop'] = drop
+    drop_timers.schedule(chat.id, DROP_TIMEOUT, drop)
+
+# Claim a chat's active drop in one step, so two catchers can't both win,
+# on whichever worker they run and without a chat lock; returns ('none' | 'expired' | 'wrong' | 'ok', card_id)
+def claim_drop(chat_data: dict, guess: str) -> tuple:
+    last_drop = chat_data.get('last_drop')
+    if last_drop is None:
+        return 'none', None
+    
+    # Past its time but the timer hasn't ticked yet; the timer cleans it up
+    if time.monotonic() > last_drop['expires']:
+        return 'expired', None
+    
+    if not names_match(guess, last_drop['card_name']):
+        return 'wrong', None
+    
+    del chat_data['last_drop']
+    drop_timers.cancel(last_drop['chat_id'])
+    return 'ok', last_drop['card_id']
 
+@locked(user_key)
 async def catch_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    if 'last_drop' not in context.chat_data:
-        await update.message.reply_text("❌ ဖမ်းရန် ကဒ်မရှိပါ")
-        return
-    
     if len(context.args) == 0:
         await update.message.reply_text("❌ Format: /catch <card_name>")
         return
     
-    guess = ' '.join(context.args).lower()
-    last_drop = context.chat_data['last_drop']
+    guess = normalize_name(' '.join(context.args))
+    chat_id = str(update.effective_chat.id)
+    
+    # In cluster mode the drop lives on the worker that owns the group
+    if is_local(chat_id):
+        result, card_id = claim_drop(context.chat_data, guess)
+    else:
+        result, card_id = await cluster.call(cluster.owner(chat_id), 'claim_drop', chat_id, guess)
+    
+    if result == 'none':
+        await update.message.reply_text("❌ ဖမ်းရန် ကဒ်မရှိပါ")
+        return
     
-    # Check if drop expired (30 seconds)
-    if datetime.now() - last_drop['time'] > timedelta(seconds=30):
-        del context.chat_data['last_drop']
+    if result == 'expired':
         await update.message.reply_text("⏰ Time Out!")
         return
     
-    if guess == last_drop['card_name']:
-        card_id = last_drop['card_id']
+    if result == 'ok':
         card = bot_data['cards'][card_id]
         
-        if card_id not in bot_data['users'][user_id]['cards']:
-            bot_data['users'][user_id]['cards'][card_id] = 0
-        bot_data['users'][user_id]['cards'][card_id] += 1
+        add_card(user_id, card_id)
         
         # Bonus coins
         coin_bonus = RARITIES[card['rarity']]['value']
-        bot_data['users'][user_id]['balance'] += coin_bonus
+        add_coins(user_id, coin_bonus, 'catch', card_id)
         
         # Check missions
-        total_cards = sum(bot_data['users'][user_id]['cards'].values())
+        total_cards = bot_data['users'][user_id]['total_cards']
         for mission_id, mission in MISSIONS.items():
             if mission_id not in bot_data['users'][user_id]['completed_missions']:
                 if total_cards >= mission['requirement']:
                     bot_data['users'][user_id]['completed_missions'].append(mission_id)
-                    bot_data['users'][user_id]['balance'] += mission['reward']
+                    add_coins(user_id, mission['reward'], 'mission', mission_id)
                     bot_data['users'][user_id]['titles'].append(mission['title'])
                     await update.message.reply_text(
                         f"🏆 Mission Complete!\n\n"
@@ -784,8 +4294,7 @@ async def catch_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         f"💰 Reward: {mission['reward']:,} Coins"
                     )
         
-        save_data()
-        del context.chat_data['last_drop']
+        save_data(('users', user_id))
         
         rarity_emoji = RARITIES[card['rarity']]['emoji']
         await update.message.reply_text(
@@ -797,6 +4306,7 @@ async def catch_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ နာမည် မှားနေပါသည်")
 
 # Trading
+@locked(user_key, reply_user_key)
 async def give_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
         await update.message.reply_text("❌ User ကို Reply လုပ်ပါ")
@@ -807,11 +4317,10 @@ async def give_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     sender_id = str(update.effective_user.id)
-    receiver_id = str(update.message.reply_to_message.from_user.id)
+    receiver = update.message.reply_to_message.from_user
+    receiver_id = str(receiver.id)
     
     init_user(update.effective_user.id, update.effective_user.username)
-    init_user(update.message.reply_to_message.from_user.id, 
-              update.message.reply_to_message.from_user.username)
     
     try:
         amount = int(context.args[0])
@@ -824,9 +4333,20 @@ async def give_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Coins မလုံလောက်ပါ")
             return
         
-        bot_data['users'][sender_id]['balance'] -= amount
-        bot_data['users'][receiver_id]['balance'] += amount
-        save_data()
+        add_coins(sender_id, -amount, 'transfer', receiver_id)
+        save_data(('users', sender_id))
+        
+        # The receiver may live on another cluster worker
+        status = await credit_user(receiver_id, receiver.username, amount, 'transfer', sender_id,
+                                   refund=sender_id)
+        if status == 'failed':
+            await update.message.reply_text("❌ လွှဲ၍မရပါ၊ နောက်မှ ထပ်ကြိုးစားပါ")
+            return
+        if status == 'pending':
+            await update.message.reply_text(
+                f"⏳ {amount:,} Coins လွှဲနေဆဲ ဖြစ်ပါသည်၊ မကြာမီ အလိုအလျောက် ရောက်ရှိပါမည်"
+            )
+            return
         
         await update.message.reply_text(
             f"✅ {update.message.reply_to_message.from_user.first_name} သို့ "
@@ -835,18 +4355,284 @@ async def give_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
 
+def trade_want_text(want) -> str:
+    kind, wanted = want
+    if kind == 'r':
+        return f"{RARITIES[wanted]['emoji']} {wanted} ကဒ်တစ်ခုခု"
+    card = bot_data['cards'].get(wanted)
+    return f"#{wanted} {card['name']}" if card else f"#{wanted}"
+
+# Tell the other side of a fill what they got; they may never have
+# opened a private chat with the bot
+async def notify_trade(bot, fill: dict):
+    other = fill['other']
+    card = bot_data['cards'].get(other['card'])
+    name = card['name'] if card else other['card']
+    if other['kind'] == 'sell':
+        text = f"✅ Trade #{fill['offer']}: {name} ကို {fill['price']:,} Coins ဖြင့် ရောင်းပြီး!"
+    elif other['kind'] == 'buy':
+        text = f"✅ Trade #{fill['offer']}: {name} ကို {fill['price']:,} Coins ဖြင့် ဝယ်ပြီး!"
+    else:
+        text = f"✅ Trade #{fill['offer']}: {name} ကို လဲလှယ်ပြီး!"
+    try:
+        await bot.send_message(chat_id=int(other['user']), text=text)
+    except TelegramError:
+        pass
+
+# /trade sell <id> <price> | buy <id> <price> | swap <id> <want_id|rarity>
+#        | list <id> | my | cancel <offer_id>
+@locked(user_key)
 async def trade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("❌ User ကို Reply လုပ်ပါ")
-        return
+    user_id = str(update.effective_user.id)
+    init_user(update.effective_user.id, update.effective_user.username)
+    user = bot_data['users'][user_id]
+    args = context.args
+    action = args[0].lower() if args else None
+    
+    usage = (
+        "🔄 Trade Commands:\n"
+        "/trade sell <id> <price> - ကဒ်ရောင်းရန်\n"
+        "/trade buy <id> <price> - ကဒ်ဝယ်ရန်\n"
+        "/trade swap <id> <id|rarity> - ကဒ်လဲရန်\n"
+        "/trade list <id> - Offer များကြည့်ရန်\n"
+        "/trade my - ကိုယ့် Offer များ\n"
+        "/trade cancel <offer_id> - Offer ပယ်ဖျက်ရန်"
+    )
     
-    await update.message.reply_text("🔄 Trade system ကို မကြာမီ ထည့်သွင်းပါမည်")
+    try:
+        if action == 'list' and len(args) == 2:
+            card = bot_data['cards'].get(args[1])
+            if not card:
+                await update.message.reply_text("❌ ကဒ်မတွေ့ပါ")
+                return
+            book = await central_call('trade_list', args[1])
+            lines = [f"📋 {RARITIES[card['rarity']]['emoji']} {card['name']}"]
+            lines += [f"🏷 Sell: {price:,} Coins - @{name}" for price, name in book['asks']]
+            lines += [f"💰 Buy: {price:,} Coins - @{name}" for price, name in book['bids']]
+            lines += [f"🔄 Swap → {trade_want_text(want)} - @{name}" for want, name in book['swaps']]
+            if len(lines) == 1:
+                lines.append("Offer မရှိသေးပါ")
+            await update.message.reply_text('\n'.join(lines))
+            return
+        
+        if action == 'my' and len(args) == 1:
+            offers = await central_call('trade_mine', user_id)
+            if not offers:
+                await update.message.reply_text("📭 Offer မရှိပါ")
+                return
+            lines = ["📋 My Offers:"]
+            for offer_id, offer in offers:
+                card = bot_data['cards'].get(offer['card'])
+                name = card['name'] if card else offer['card']
+                if offer['kind'] == 'swap':
+                    lines.append(f"#{offer_id} 🔄 {name} → {trade_want_text(offer['want'])}")
+                else:
+                    icon = '🏷' if offer['kind'] == 'sell' else '💰'
+                    lines.append(f"#{offer_id} {icon} {name} - {offer['price']:,} Coins")
+            await update.message.reply_text('\n'.join(lines))
+            return
+        
+        if action == 'cancel' and len(args) == 2:
+            if await central_call('trade_cancel', user_id, args[1]) is None:
+                await update.message.reply_text("❌ Offer မတွေ့ပါ")
+                return
+            await update.message.reply_text(f"✅ Offer #{args[1]} ပယ်ဖျက်ပြီး")
+            return
+        
+        if action not in ('sell', 'buy', 'swap') or len(args) != 3:
+            await update.message.reply_text(usage)
+            return
+        
+        card_id = args[1]
+        card = bot_data['cards'].get(card_id)
+        if not card:
+            await update.message.reply_text("❌ ကဒ်မတွေ့ပါ")
+            return
+        
+        offer = {
+            'user': user_id,
+            'username': update.effective_user.username or update.effective_user.first_name,
+            'kind': action,
+            'card': card_id,
+            'rarity': card['rarity'],
+            'price': 0,
+            'want': None,
+            'expires': time.time() + TRADE_OFFER_HOURS * 3600,
+            'request': uuid.uuid4().hex
+        }
+        if action == 'swap':
+            rarity = next((r for r in RARITIES if r.lower() == args[2].lower()), None)
+            if args[2] in bot_data['cards']:
+                offer['want'] = ('c', args[2])
+            elif rarity is not None:
+                offer['want'] = ('r', rarity)
+            else:
+                await update.message.reply_text("❌ ကဒ် ID (သို့) Rarity မှားနေပါသည်")
+                return
+        else:
+            offer['price'] = int(args[2])
+            if offer['price'] <= 0:
+                await update.message.reply_text("❌ ပမာဏ မှားနေပါသည်")
+                return
+        
+        # Escrow what the offer gives until it fills, is cancelled or expires
+        if action == 'buy':
+            if user['balance'] < offer['price']:
+                await update.message.reply_text("❌ Coins မလုံလောက်ပါ")
+                return
+            add_coins(user_id, -offer['price'], 'trade')
+        else:
+            if user['cards'].get(card_id, 0) < 1:
+                await update.message.reply_text("❌ ဒီကဒ် မရှိပါ")
+                return
+            add_card(user_id, card_id, -1)
+        bot_data['pending_offers'][offer['request']] = offer
+        save_data(('users', user_id), ('pending_offers', offer['request']))
+        
+        status, offer_id, fill = await place_offer(offer['request'])
+        
+        if status == 'pending':
+            await update.message.reply_text(
+                f"⏳ Offer {offer['request'][:8]} တင်နေဆဲ ဖြစ်ပါသည်၊ "
+                f"မတင်နိုင်ပါက Refund ပြန်ရပါမည်။ /trade my ဖြင့် စစ်ကြည့်ပါ"
+            )
+        elif status == 'limit':
+            await update.message.reply_text(f"❌ Offer {TRADE_MAX_OFFERS} ခုထက် မတင်နိုင်ပါ")
+        elif status == 'error':
+            await update.message.reply_text("❌ Trade မလုပ်နိုင်ပါ၊ နောက်မှ ထပ်ကြိုးစားပါ")
+        elif fill is None:
+            await update.message.reply_text(
+                f"✅ Offer #{offer_id} တင်ပြီး!\n"
+                f"⏰ {TRADE_OFFER_HOURS:g} နာရီအတွင်း မကိုက်ညီပါက Refund ပြန်ရပါမည်"
+            )
+        else:
+            await notify_trade(context.bot, fill)
+            other = bot_data['cards'].get(fill['other']['card'])
+            if action == 'swap':
+                got = f"{other['name'] if other else fill['other']['card']} ရရှိပြီး"
+            elif action == 'sell':
+                got = f"{fill['price']:,} Coins ဖြင့် ရောင်းပြီး"
+            else:
+                got = f"{fill['price']:,} Coins ဖြင့် ဝယ်ပြီး"
+            await update.message.reply_text(f"✅ Trade ပြီးပါပြီ! {card['name']} - {got}")
+    except ValueError:
+        await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
 
+# /fusion | /fusion <rarity> [count] | /fusion all
+@locked(user_key)
 async def fusion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("⚗️ Fusion system ကို မကြာမီ ထည့်သွင်းပါမည်")
+    user_id = str(update.effective_user.id)
+    init_user(update.effective_user.id, update.effective_user.username)
+    user = bot_data['users'][user_id]
+    args = context.args
+    available = fusible(user)
+    
+    if not args:
+        lines = [f"⚗️ Fusion: ကဒ် {FUSION_COST} ခု → အဆင့်မြင့်ကဒ် 1 ခု\n"]
+        for rarity, target in FUSION_RECIPES.items():
+            have = user.get('rarity_counts', {}).get(rarity, 0)
+            mark = f"✅ x{available[rarity]}" if rarity in available else "❌"
+            lines.append(
+                f"{RARITIES[rarity]['emoji']} {rarity} ({have}) → "
+                f"{RARITIES[target]['emoji']} {target} {mark}"
+            )
+        lines.append("\n/fusion <rarity> [count] - Fuse လုပ်ရန်")
+        lines.append("/fusion all - ထပ်နေသောကဒ်အားလုံး Fuse လုပ်ရန်")
+        await update.message.reply_text('\n'.join(lines))
+        return
+    
+    if args[0].lower() == 'all' and len(args) == 1:
+        # Plan every tier before fusing, so new cards aren't fused again
+        plans = [(rarity, fusion_inputs(user, rarity, spare_only=True)) for rarity in available]
+        results = []
+        for rarity, inputs in plans:
+            results += fuse(user_id, rarity, inputs, len(inputs))
+    else:
+        rarity = next((r for r in RARITIES if r.lower() == args[0].lower()), None)
+        if rarity is None or len(args) > 2:
+            await update.message.reply_text(f"❌ Rarity မှား: {', '.join(FUSION_RECIPES)}")
+            return
+        try:
+            times = int(args[1]) if len(args) == 2 else 1
+        except ValueError:
+            await update.message.reply_text("❌ ကိန်းဂဏန်းထည့်ပါ")
+            return
+        if times <= 0:
+            await update.message.reply_text("❌ ပမာဏ မှားနေပါသည်")
+            return
+        if rarity not in available:
+            await update.message.reply_text(f"❌ {rarity} ကဒ် {FUSION_COST} ခု မရှိပါ")
+            return
+        results = fuse(user_id, rarity, fusion_inputs(user, rarity), times)
+    
+    if not results:
+        await update.message.reply_text("❌ Fuse လုပ်ရန် ထပ်နေသောကဒ် မရှိပါ")
+        return
+    
+    save_data(('users', user_id))
+    
+    lines = [f"⚗️ Fusion {len(results)} ကြိမ် အောင်မြင်ပါပြီ!\n"]
+    for card_id, count in Counter(results).most_common(20):
+        card = bot_data['cards'][card_id]
+        lines.append(f"{RARITIES[card['rarity']]['emoji']} {card['name']} x{count}")
+    await update.message.reply_text('\n'.join(lines))
+
+def duel_buttons(duel_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("⚔️ Attack", callback_data=f"duel_move_{duel_id}_attack"),
+        InlineKeyboardButton("💥 Special", callback_data=f"duel_move_{duel_id}_special"),
+        InlineKeyboardButton("🛡 Guard", callback_data=f"duel_move_{duel_id}_guard")
+    ]])
 
+# /duel (reply) challenges a user, /duel alone waits for an opponent in
+# the chat, /duel cancel stops waiting
+@locked(user_key)
 async def duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("⚔️ Duel system ကို မကြာမီ ထည့်သွင်းပါမည်")
+    user_id = str(update.effective_user.id)
+    init_user(update.effective_user.id, update.effective_user.username)
+    chat_id = str(update.effective_chat.id)
+    name = update.effective_user.first_name
+    
+    if context.args and context.args[0].lower() == 'cancel':
+        if await central_call('duel_leave', chat_id, user_id):
+            await update.message.reply_text("✅ Duel စောင့်ဆိုင်းမှု ပယ်ဖျက်ပြီး")
+        else:
+            await update.message.reply_text("❌ Duel စောင့်ဆိုင်းနေခြင်း မရှိပါ")
+        return
+    
+    team = duel_team(bot_data['users'][user_id])
+    if not team:
+        await update.message.reply_text("❌ Duel ကစားရန် ကဒ်မရှိပါ")
+        return
+    
+    reply = update.message.reply_to_message
+    if reply:
+        opponent = reply.from_user
+        if opponent.id == update.effective_user.id or opponent.is_bot:
+            await update.message.reply_text("❌ ဤ user ကို စိန်ခေါ်၍မရပါ")
+            return
+        duel_id = await central_call(
+            'duel_challenge', chat_id, [user_id, str(opponent.id)], [name, opponent.first_name], team
+        )
+        keyboard = [
+            [
+                InlineKeyboardButton("⚔️ Accept", callback_data=f"duel_accept_{duel_id}"),
+                InlineKeyboardButton("❌ Decline", callback_data=f"duel_decline_{duel_id}")
+            ]
+        ]
+        await update.message.reply_text(
+            f"⚔️ {name} က {opponent.first_name} ကို Duel စိန်ခေါ်နေပါသည်!\n"
+            f"{' '.join(RARITIES[r]['emoji'] for r in team)}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    
+    started = await central_call('duel_queue', chat_id, user_id, name, team)
+    if started is None:
+        await update.message.reply_text("⏳ ပြိုင်ဘက် စောင့်နေပါသည်... (/duel cancel)")
+        return
+    duel_id, text = started
+    await update.message.reply_text(text, reply_markup=duel_buttons(duel_id))
 
 # Social
 async def marry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -855,17 +4641,16 @@ async def marry(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_id = str(update.effective_user.id)
-    partner_id = str(update.message.reply_to_message.from_user.id)
+    partner = update.message.reply_to_message.from_user
+    partner_id = str(partner.id)
     
     init_user(update.effective_user.id, update.effective_user.username)
-    init_user(update.message.reply_to_message.from_user.id,
-              update.message.reply_to_message.from_user.username)
     
     if bot_data['users'][user_id]['married_to']:
         await update.message.reply_text("❌ သင်လက်ထပ်ပြီးသားဖြစ်သည်")
         return
     
-    if bot_data['users'][partner_id]['married_to']:
+    if await get_married_to(partner_id, partner.username):
         await update.message.reply_text("❌ ဤ user လက်ထပ်ပြီးသားဖြစ်သည်")
         return
     
@@ -893,28 +4678,64 @@ async def divorce(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     partner_id = bot_data['users'][user_id]['married_to']
-    bot_data['users'][user_id]['married_to'] = None
-    bot_data['users'][partner_id]['married_to'] = None
-    save_data()
+    async with locks.hold(('user', user_id), ('user', partner_id)):
+        if bot_data['users'][user_id]['married_to'] != partner_id:
+            await update.message.reply_text("❌ သင်လက်ထပ်ထားခြင်းမရှိပါ")
+            return
+        bot_data['users'][user_id]['married_to'] = None
+        save_data(('users', user_id))
+        await set_married_to(partner_id, None, user_id)
     
     await update.message.reply_text("💔 ကွာရှင်းပြီးပါပြီ")
 
 # Rankings
+# Leaderboard rows (cards, user_id, username, titles) from this process
+def top_entries(start: int, count: int) -> list:
+    rows = []
+    for neg_total, uid in leaderboard.entries(max(0, start), max(0, start + count)):
+        udata = bot_data['users'].get(uid, {})
+        rows.append((-neg_total, uid, udata.get('username', 'Unknown'), ' '.join(udata.get('titles', []))))
+    return rows
+
+# (total pages, rows) for one /top page; in cluster mode every worker
+# sends its top entries and they are merged here
+async def top_page(page: int, size: int = 10) -> tuple:
+    start = (page - 1) * size
+    if cluster is None:
+        return leaderboard.pages(size), top_entries(start, size)
+    sizes = await cluster.call_all('leaderboard_size')
+    total_pages = max(1, (sum(sizes) + size - 1) // size)
+    if page < 1 or page > total_pages:
+        return total_pages, []
+    parts = await cluster.call_all('top_entries', 0, start + size)
+    rows = sorted((row for part in parts for row in part), key=lambda row: (-row[0], row[1]))
+    return total_pages, rows[start:start + size]
+
 async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    sorted_users = sorted(
-        bot_data['users'].items(),
-        key=lambda x: sum(x[1].get('cards', {}).values()),
-        reverse=True
-    )[:10]
+    page = 1
+    if context.args:
+        try:
+            page = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Format: /top <page>")
+            return
+    
+    total_pages, rows = await top_page(page)
+    if page < 1 or page > total_pages:
+        await update.message.reply_text(f"❌ Page 1 - {total_pages} သာရှိပါသည်")
+        return
     
-    top_text = "🏆 Top 10 Collectors\n\n"
+    if page == 1:
+        top_text = "🏆 Top 10 Collectors\n\n"
+    else:
+        top_text = f"🏆 Top Collectors ({page}/{total_pages})\n\n"
     
-    for i, (uid, udata) in enumerate(sorted_users, 1):
-        card_count = sum(udata.get('cards', {}).values())
-        username = udata.get('username', 'Unknown')
-        titles = ' '.join(udata.get('titles', []))
+    for i, (card_count, uid, username, titles) in enumerate(rows, (page - 1) * 10 + 1):
         top_text += f"{i}. {username} {titles}\n   🎴 {card_count} cards\n\n"
     
+    if total_pages > 1:
+        top_text += f"📄 Page {page}/{total_pages} - /top <page>"
+    
     await update.message.reply_text(top_text)
 
 async def titles(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -936,7 +4757,7 @@ async def missions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    total_cards = sum(bot_data['users'][user_id].get('cards', {}).values())
+    total_cards = bot_data['users'][user_id].get('total_cards', 0)
     completed = bot_data['users'][user_id].get('completed_missions', [])
     
     missions_text = "🎯 Missions\n\n"
@@ -952,6 +4773,11 @@ async def missions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(missions_text)
 
+# A card id typed by a user, in the stored form ('007' -> '7')
+def card_id_arg(text: str) -> str:
+    return str(int(text)) if text.isascii() and text.isdigit() else text
+
+@locked(user_key)
 async def set_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         await update.message.reply_text("❌ Format: /set <card_id>")
@@ -960,7 +4786,7 @@ async def set_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    card_id = context.args[0]
+    card_id = card_id_arg(context.args[0])
     
     if card_id not in bot_data['users'][user_id].get('cards', {}):
         await update.message.reply_text("❌ သင့်တွင် ဤကဒ်မရှိပါ")
@@ -972,11 +4798,12 @@ async def set_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if card_id not in bot_data['users'][user_id]['favorite_cards']:
         bot_data['users'][user_id]['favorite_cards'].append(card_id)
-        save_data()
+        save_data(('users', user_id))
         await update.message.reply_text("✅ Favorite ကဒ်အဖြစ်သတ်မှတ်ပြီး!")
     else:
         await update.message.reply_text("❌ ဤကဒ်သည် Favorite တွင်ရှိပြီးသား")
 
+@locked(user_key)
 async def remove_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         await update.message.reply_text("❌ Format: /removeset <card_id>")
@@ -985,11 +4812,11 @@ async def remove_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     init_user(update.effective_user.id, update.effective_user.username)
     
-    card_id = context.args[0]
+    card_id = card_id_arg(context.args[0])
     
     if card_id in bot_data['users'][user_id]['favorite_cards']:
         bot_data['users'][user_id]['favorite_cards'].remove(card_id)
-        save_data()
+        save_data(('users', user_id))
         await update.message.reply_text("✅ Favorite မှ ဖယ်ရှားပြီး!")
     else:
         await update.message.reply_text("❌ ဤကဒ်သည် Favorite တွင်မရှိပါ")
@@ -1002,19 +4829,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     if data == "clear_confirm":
-        global bot_data
-        bot_data = {
-            'cards': {},
-            'users': {},
-            'groups': {},
-            'sudo_users': [],
-            'drop_settings': {},
-            'pending_uploads': {},
-            'pending_trades': {},
-            'pending_duels': {},
-            'pending_fusions': {}
-        }
-        save_data()
+        if cluster is not None:
+            cluster.cast_others('restore', empty_data())
+        replace_data(empty_data())
         await query.edit_message_text("✅ Data အားလုံးဖျက်ပြီးပါပြီ!")
     
     elif data == "clear_cancel":
@@ -1024,14 +4841,51 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sender_id = data.split("_")[2]
         receiver_id = str(query.from_user.id)
         
-        bot_data['users'][sender_id]['married_to'] = receiver_id
-        bot_data['users'][receiver_id]['married_to'] = sender_id
-        save_data()
+        init_user(query.from_user.id, query.from_user.username)
+        
+        async with locks.hold(('user', sender_id), ('user', receiver_id)):
+            # The proposer may live on another cluster worker, so both sides
+            # are claimed with compare-and-set and the first undone on failure
+            married = await set_married_to(receiver_id, sender_id, None)
+            if married and not await set_married_to(sender_id, receiver_id, None):
+                await set_married_to(receiver_id, None, sender_id)
+                married = False
+            if not married:
+                await query.edit_message_text("❌ လက်ထပ်ပြီးသားဖြစ်သည်")
+                return
         
         await query.edit_message_text("💍 လက်ထပ်ပြီးပါပြီ! ဂုဏ်ယူပါတယ်!")
     
     elif data == "marry_decline":
         await query.edit_message_text("💔 လက်မထပ်ပါ")
+    
+    elif data.startswith("duel_accept_"):
+        duel_id = data.split("_")[2]
+        user_id = str(query.from_user.id)
+        init_user(query.from_user.id, query.from_user.username)
+        team = duel_team(bot_data['users'][user_id])
+        if not team:
+            if await central_call('duel_decline', duel_id, user_id):
+                await query.edit_message_text("❌ ကဒ်မရှိ၍ Duel မလုပ်နိုင်ပါ")
+            return
+        text = await central_call('duel_accept', duel_id, user_id, team)
+        if text is not None:
+            await query.edit_message_text(text, reply_markup=duel_buttons(duel_id))
+    
+    elif data.startswith("duel_decline_"):
+        if await central_call('duel_decline', data.split("_")[2], str(query.from_user.id)):
+            await query.edit_message_text("❌ Duel ကို ငြင်းပယ်ပြီး")
+    
+    elif data.startswith("duel_move_"):
+        _, _, duel_id, move = data.split("_")
+        status, text, winner_id = await central_call('duel_move', duel_id, str(query.from_user.id), move)
+        if status == 'ok':
+            await query.edit_message_text(text, reply_markup=duel_buttons(duel_id))
+        elif status == 'over':
+            if winner_id is not None:
+                async with locks.hold(('user', winner_id)):
+                    await credit_user(winner_id, None, DUEL_REWARD, 'duel', duel_id)
+            await query.edit_message_text(text)
 
 # Start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1055,14 +4909,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 👤 User Commands:
 💰 /balance - လက်ကျန်ငွေစစ်ရန်
+📒 /history - Coin မှတ်တမ်း
 🎁 /daily - နေ့စဉ် Bonus
 🏪 /shop - ဆိုင်ဖွင့်ရန်
 🛒 /buy <number> - ပစ္စည်းဝယ်ရန်
 
 🎮 Games:
-🎰 /slots <amount> - Slot ကစားရန်
-🏀 /basket <amount> - Basketball
-🎡 /wheel <amount> - Wheel ကစားရန်
+🎰 /slots <amount> [x<spins>] - Slot ကစားရန်
+🏀 /basket <amount> [x<spins>] - Basketball
+🎡 /wheel <amount> [x<spins>] - Wheel ကစားရန်
 
 🎴 Cards:
 📥 /catch <name> - ကဒ်ဖမ်းရန်
@@ -1071,11 +4926,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 👥 Social:
 💵 /givecoin <amount> - Coin လွှဲရန်
+🔄 /trade - ကဒ်ရောင်း/ဝယ်/လဲရန်
+⚗️ /fusion - ကဒ်ပေါင်းရန်
+⚔️ /duel - Duel ကစားရန် (Reply / Queue)
 💍 /marry - လက်ထပ်ရန် (Reply)
 💔 /divorce - ကွာရှင်းရန်
 
 📊 Rankings:
-🏆 /top - Top 10 ကြည့်ရန်
+🏆 /top [page] - Top Collectors ကြည့်ရန်
 👑 /titles - ဘွဲ့များ
 🎯 /missions - Mission များ
 """
@@ -1089,6 +4947,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🗑 /delete <id>
 ⚙️ /setdrop <number>
 📊 /stats
+🔍 /checkdata
+📈 /perf
+📒 /ledger <user_id|check>
 💾 /backup
 📥 /restore
 """
@@ -1098,7 +4959,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 👑 Owner Commands:
 👤 /addsudo (Reply)
 📋 /sudolist
-📢 /broadcast <message>
+📢 /broadcast <message|resume|cancel>
 🗑 /allclear
 """
     
@@ -1108,13 +4969,277 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Exception: {context.error}")
 
-# Main function
-def main():
-    # Load data on startup
-    load_data()
-    
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+# Cluster operations
+# Run on the worker that owns the data; results must be picklable.
+# credit_user and set_married_to change the user without awaiting, so
+# they take no user lock (see Lock registry)
+async def op_credit_user(credit_id: str, user_id: str, username: Optional[str], amount: int,
+                         reason: str = 'transfer', ref: Optional[str] = None,
+                         card_id: Optional[str] = None):
+    applied = bot_data['applied_credits']
+    if credit_id in applied:
+        return
+    init_user(int(user_id), username)
+    if card_id is not None:
+        add_card(user_id, card_id)
+    if amount:
+        add_coins(user_id, amount, reason, ref)
+    applied[credit_id] = time.time()
+    save_data(('users', user_id), ('applied_credits', credit_id))
+
+async def op_get_married_to(user_id: str, username: Optional[str]) -> Optional[str]:
+    return await get_married_to(user_id, username)
+
+async def op_set_married_to(user_id: str, partner_id: Optional[str], expected: Optional[str]) -> bool:
+    return await set_married_to(user_id, partner_id, expected)
+
+async def op_claim_drop(chat_id: str, guess: str) -> tuple:
+    return claim_drop(cluster.application.chat_data.get(int(chat_id), {}), guess)
+
+# Market ops run where the trade book lives (worker 0 in cluster mode).
+# A fill's offer removal and local deliveries are saved together
+async def op_trade_place(offer: dict) -> tuple:
+    placed = bot_data['placed_trades'].get(offer['request'])
+    if placed is not None:
+        return placed['status'], placed['offer'], placed['fill']
+    if trade_book.count(offer['user']) >= TRADE_MAX_OFFERS and trade_book.match(offer) is None:
+        return 'limit', None, None
+    offer_id, fill = trade_book.place(offer)
+    if fill is None:
+        status, keys = 'listed', [('pending_trades', offer_id)]
+    else:
+        status, keys = 'filled', [('pending_trades', fill['offer'])]
+        for delivery in fill['deliveries']:
+            keys += deliver(*delivery)
+    bot_data['placed_trades'][offer['request']] = {
+        'status': status, 'offer': offer_id, 'fill': fill, 'time': time.time()
+    }
+    save_data(*keys, ('placed_trades', offer['request']))
+    return status, offer_id, fill
+
+async def op_trade_cancel(user_id: str, offer_id: str) -> Optional[dict]:
+    offer = trade_book.offers.get(offer_id)
+    if offer is None or offer['user'] != user_id:
+        return None
+    trade_book.remove(offer_id)
+    save_data(('pending_trades', offer_id), *deliver(*trade_refund(offer)))
+    return offer
+
+async def op_trade_list(card_id: str) -> dict:
+    return trade_book.listing(card_id)
+
+async def op_trade_mine(user_id: str) -> list:
+    return [(offer_id, trade_book.offers[offer_id]) for offer_id in trade_book.by_user.get(user_id, ())]
+
+# Duel ops run where the duels live; each saves what it changed at once
+async def op_duel_team(user_id: str, username: Optional[str]) -> list:
+    return await get_duel_team(user_id, username)
+
+async def op_duel_challenge(chat_id: str, players: list, names: list, team: list) -> str:
+    keys = expire_duels(time.time())
+    duel_id = new_duel(chat_id, players, names, [team, []], 'open')
+    save_data(*keys, ('pending_duels', duel_id))
+    return duel_id
+
+# Start a challenge the challenged user accepted; returns the battle text
+async def op_duel_accept(duel_id: str, user_id: str, team: list) -> Optional[str]:
+    now = time.time()
+    keys = expire_duels(now)
+    record = bot_data['pending_duels'].get(duel_id)
+    if record is None or record['status'] != 'open' or record['players'][1] != user_id:
+        if keys:
+            save_data(*keys)
+        return None
+    record['teams'][1] = team
+    record['status'] = 'live'
+    extend_duel(duel_id, now)
+    save_data(*keys, ('pending_duels', duel_id))
+    return duel_text(record, duel_state(duel_id))
+
+async def op_duel_decline(duel_id: str, user_id: str) -> bool:
+    record = bot_data['pending_duels'].get(duel_id)
+    if record is None or record['status'] != 'open' or user_id not in record['players']:
+        return False
+    del bot_data['pending_duels'][duel_id]
+    save_data(('pending_duels', duel_id))
+    return True
+
+# Pair the user with the oldest waiter in the chat or queue them;
+# returns (duel id, battle text) when a duel starts
+async def op_duel_queue(chat_id: str, user_id: str, name: str, team: list) -> Optional[tuple]:
+    now = time.time()
+    keys = expire_duels(now)
+    queue = duel_queues.setdefault(chat_id, {})
+    opponent = next((waiting for waiting in queue if waiting != user_id), None)
+    if opponent is None:
+        queue[user_id] = {'name': name, 'team': team, 'expires': now + DUEL_TIMEOUT}
+        queue_deadlines.append((now + DUEL_TIMEOUT, chat_id, user_id))
+        if keys:
+            save_data(*keys)
+        return None
+    entry = queue.pop(opponent)
+    queue.pop(user_id, None)
+    duel_id = new_duel(chat_id, [opponent, user_id], [entry['name'], name], [entry['team'], team], 'live')
+    save_data(*keys, ('pending_duels', duel_id))
+    return duel_id, duel_text(bot_data['pending_duels'][duel_id], duel_state(duel_id))
+
+async def op_duel_leave(chat_id: str, user_id: str) -> bool:
+    queue = duel_queues.get(chat_id, {})
+    return queue.pop(user_id, None) is not None
+
+# Play a move; returns (status, battle text, winner id) with status
+# 'gone', 'turn' (not this user's move), 'ok' or 'over'
+async def op_duel_move(duel_id: str, user_id: str, move: str) -> tuple:
+    duel = duel_state(duel_id)
+    if duel is None or move not in DUEL_MOVES:
+        return 'gone', None, None
+    record = bot_data['pending_duels'][duel_id]
+    if record['players'][duel.side] != user_id:
+        return 'turn', None, None
+    name = record['names'][duel.side]
+    damage, critical, knocked_out = duel.play(move)
+    record['moves'].append(move)
+    if move == 'guard':
+        event = f"🛡 {name} ကာကွယ်"
+    elif not damage:
+        event = f"💫 {name} ၏ Special လွဲသွားသည်"
+    else:
+        event = f"{'💥' if move == 'special' else '⚔️'} {name} -{damage}"
+        if critical:
+            event += " (Critical!)"
+        if knocked_out:
+            event += "\n💀 Knock Out!"
+    text = duel_text(record, duel, event)
+    if not duel.over:
+        extend_duel(duel_id, time.time())
+        save_data(('pending_duels', duel_id))
+        return 'ok', text, None
+    del bot_data['pending_duels'][duel_id]
+    del duels[duel_id]
+    save_data(('pending_duels', duel_id))
+    winner = record['players'][duel.winner] if duel.winner is not None else None
+    return 'over', text, winner
+
+async def op_ledger_reconcile() -> dict:
+    return await reconcile_ledger()
+
+async def op_ledger_history(user_id: str) -> tuple:
+    return await ledger_history(user_id)
+
+# Replicated section changes from another worker
+async def op_apply_records(records: list):
+    for record in records:
+        apply_record(bot_data, record)
+        section, key = record['s'], record.get('k')
+        if section == 'cards':
+            if record.get('d'):
+                drop_engine.remove(key)
+                card_keys.pop(key, None)
+            else:
+                drop_engine.add(key, record['v']['rarity'])
+                index_card_name(key)
+        elif section == 'drop_settings' and key is not None and int(key) in group_counters:
+            group_counters[int(key)].threshold = record.get('v', 50)
+        save_data((section, key) if key is not None else (section,), replicate=False)
+
+async def op_adopt_group(group_id: str, group: dict):
+    adopt_group(group_id, group)
+    save_data(('groups', group_id))
+
+async def op_leaderboard_size() -> int:
+    return len(leaderboard)
+
+async def op_top_entries(start: int, count: int) -> list:
+    return top_entries(start, count)
+
+async def op_stats() -> dict:
+    return local_stats()
+
+async def op_snapshot() -> dict:
+    sync_group_counters()
+    users = bot_data['users']
+    return {'users': users.to_dict() if isinstance(users, UserCache) else users, 'groups': bot_data['groups']}
+
+async def op_restore(data: dict):
+    replace_data(data)
+
+async def op_broadcast(args: list, chat_id: int):
+    bot = cluster.application.bot
+    await start_broadcast(cluster.application, args, functools.partial(bot.send_message, chat_id))
+
+CLUSTER_OPS = {
+    'credit_user': op_credit_user,
+    'get_married_to': op_get_married_to,
+    'set_married_to': op_set_married_to,
+    'claim_drop': op_claim_drop,
+    'apply_records': op_apply_records,
+    'adopt_group': op_adopt_group,
+    'leaderboard_size': op_leaderboard_size,
+    'top_entries': op_top_entries,
+    'stats': op_stats,
+    'snapshot': op_snapshot,
+    'restore': op_restore,
+    'broadcast': op_broadcast,
+    'trade_place': op_trade_place,
+    'trade_cancel': op_trade_cancel,
+    'trade_list': op_trade_list,
+    'trade_mine': op_trade_mine,
+    'duel_team': op_duel_team,
+    'duel_challenge': op_duel_challenge,
+    'duel_accept': op_duel_accept,
+    'duel_decline': op_duel_decline,
+    'duel_queue': op_duel_queue,
+    'duel_leave': op_duel_leave,
+    'duel_move': op_duel_move,
+    'ledger_reconcile': op_ledger_reconcile,
+    'ledger_history': op_ledger_history,
+}
+
+# Application lifecycle
+background_tasks = []
+
+metrics_server = None
+
+async def post_init(application: Application):
+    global metrics_server
+    await flusher.start()
+    loop = asyncio.get_running_loop()
+    background_tasks.append(loop.create_task(run_group_sync()))
+    background_tasks.append(loop.create_task(run_drop_timers(application)))
+    background_tasks.append(loop.create_task(run_drop_edits(application.bot)))
+    if cluster is None or cluster.index == 0:
+        background_tasks.append(loop.create_task(run_trade_expiry()))
+        background_tasks.append(loop.create_task(run_duel_expiry()))
+    if cluster is not None:
+        background_tasks.append(loop.create_task(run_cluster_retry(application.bot)))
+    if LEDGER_RECONCILE_INTERVAL > 0:
+        background_tasks.append(loop.create_task(run_ledger_reconcile()))
+    if METRICS_PORT:
+        port = METRICS_PORT + (cluster.index if cluster is not None else 0)
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, port)
+        logger.info(f"Metrics on http://{METRICS_LISTEN}:{port}/metrics")
+
+async def post_shutdown(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    sync_group_counters()
+    # run_polling stops the application on SIGINT/SIGTERM, so pending
+    # changes are flushed here before the process exits
+    await flusher.stop()
+
+# Create application with all handlers registered
+def build_application() -> Application:
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(CONCURRENT_UPDATES or False)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -1127,6 +5252,9 @@ def main():
     application.add_handler(CommandHandler("delete", delete_card))
     application.add_handler(CommandHandler("setdrop", set_drop))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("checkdata", check_data))
+    application.add_handler(CommandHandler("perf", perf))
+    application.add_handler(CommandHandler("ledger", ledger_command))
     application.add_handler(CommandHandler("backup", backup))
     application.add_handler(CommandHandler("restore", restore))
     application.add_handler(CommandHandler("allclear", allclear))
@@ -1138,6 +5266,7 @@ def main():
     
     # User commands
     application.add_handler(CommandHandler("balance", balance))
+    application.add_handler(CommandHandler("history", history))
     application.add_handler(CommandHandler("daily", daily))
     application.add_handler(CommandHandler("shop", shop))
     application.add_handler(CommandHandler("buy", buy))
@@ -1180,9 +5309,131 @@ def main():
     # Error handler
     application.add_error_handler(error_handler)
     
+    instrument_handlers(application)
+    return application
+
+# Cluster worker process entry point
+def run_cluster_worker(index: int, inboxes: list):
+    global cluster, storage, bot_data, ledger
+    # Ctrl+C reaches the whole process group; the front process stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cluster = ClusterNode(index, inboxes)
+    storage = create_storage(suffix=f'.w{index}')
+    root, ext = os.path.splitext(LEDGER_FILE)
+    ledger = CoinLedger(f'{root}.w{index}{ext}')
+    data = storage.load()
+    if data is None:
+        # First cluster start: take this worker's share of the regular data
+        data = create_storage().load()
+        if data is not None:
+            data = shard_slice(data)
+            storage.save(data, ())
+            if lazy_users():
+                data = storage.load()
+    if data is not None:
+        pack_users(data['users'])
+        bot_data = data
+    elif lazy_users():
+        bot_data['users'] = UserCache(storage, storage.cache_size)
+    if rebuild_indexes():
+        save_data()
+    sync_ledger()
+    logger.info(f"Worker {index}: {len(bot_data['users'])} users, {len(bot_data['groups'])} groups")
+    asyncio.run(cluster.run())
+
+# Cluster front process: receives webhook posts and forwards each update to
+# the worker that owns it
+async def run_cluster_front(inboxes: list):
+    import tornado.httpserver
+    import tornado.web
+    
+    class WebhookHandler(tornado.web.RequestHandler):
+        def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                self.set_status(403)
+                return
+            body = self.request.body.decode('utf-8')
+            try:
+                data = json.loads(body)
+            except ValueError:
+                self.set_status(400)
+                return
+            inboxes[route_update(data, len(inboxes))].put(('update', body))
+    
+    if WEBHOOK_URL:
+        async with Bot(BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                allowed_updates=ALLOWED_UPDATES,
+                secret_token=WEBHOOK_SECRET
+            )
+    
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(f"/{WEBHOOK_PATH}", WebhookHandler)]))
+    server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    logger.info(f"Cluster front on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}, {len(inboxes)} workers")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    server.stop()
+
+def run_cluster():
+    move_legacy_files()
+    ctx = multiprocessing.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(CLUSTER_WORKERS)]
+    workers = [
+        ctx.Process(target=run_cluster_worker, args=(i, inboxes), name=f'worker-{i}')
+        for i in range(CLUSTER_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(run_cluster_front(inboxes))
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        for worker in workers:
+            worker.join()
+
+# Main function
+def main():
+    # python bot.py migrate [bot_data.json] imports JSON data into SQLite
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        move_legacy_files()
+        counts = migrate_to_sqlite(*sys.argv[2:3])
+        logger.info(f"Migrated to {SQLITE_FILE}: {counts}")
+        return
+    # python bot.py convert bot_data.json bot_data.bin (or the reverse)
+    if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        convert_snapshot(sys.argv[2], sys.argv[3])
+        logger.info(f"Converted {sys.argv[2]} -> {sys.argv[3]}")
+        return
+    
+    if BOT_MODE == 'cluster':
+        run_cluster()
+        return
+    
+    # Load data on startup
+    load_data()
+    
+    application = build_application()
+    
     # Start bot
-    logger.info("Bot started!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        logger.info(f"Bot started! Webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}" if WEBHOOK_URL else None,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        logger.info("Bot started!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
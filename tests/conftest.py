@@ -0,0 +1,22 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot.py reads its settings at import, so each test imports a fresh copy
+# with its own environment, working directory and data files
+@pytest.fixture
+def load_bot(tmp_path, monkeypatch):
+    def load(**env):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv('BOT_TOKEN', '1:test')
+        monkeypatch.setenv('OWNER_ID', '1')
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        sys.modules.pop('bot', None)
+        return importlib.import_module('bot')
+    yield load
+    sys.modules.pop('bot', None)
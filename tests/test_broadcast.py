@@ -0,0 +1,65 @@
+import asyncio
+
+from telegram.error import ChatMigrated, RetryAfter
+
+
+class MigratingBot:
+    def __init__(self, migrated):
+        self.migrated = migrated
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.migrated:
+            raise ChatMigrated(self.migrated[chat_id])
+        self.sent.append(chat_id)
+
+
+# Answers the first `waits` sends to each chat in flooded with a flood wait
+class FloodedBot:
+    def __init__(self, flooded, waits):
+        self.flooded = flooded
+        self.waits = waits
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.flooded and self.waits:
+            self.waits -= 1
+            raise RetryAfter(0)
+        self.sent.append(chat_id)
+
+
+class StatusMessage:
+    async def edit_text(self, text):
+        self.text = text
+
+
+# A group upgraded to a supergroup is re-keyed to its new id, so later
+# broadcasts and drops use it directly
+def test_migrated_group_is_rekeyed(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.init_group(-100, 'old')
+    bot.init_group(-200, 'other')
+    bot.bot_data['drop_settings']['-100'] = 20
+    bot.get_group_counter(-100, 'old').count = 7
+    bot.bot_data['broadcast'] = {'message': 'hi', 'started_at': '', 'results': {}}
+    sender = MigratingBot({-100: -1001})
+    asyncio.run(bot.run_broadcast(sender, StatusMessage()))
+    assert sorted(sender.sent) == [-1001, -200]
+    assert set(bot.bot_data['groups']) == {'-1001', '-200'}
+    assert bot.bot_data['groups']['-1001']['message_count'] == 7
+    assert bot.bot_data['drop_settings'] == {'-1001': 20}
+    assert -100 not in bot.group_counters
+    stored = bot.storage.load()
+    assert set(stored['groups']) == {'-1001', '-200'} and 'broadcast' not in stored
+
+
+# Flood waits pause the sender but don't use up a group's attempts
+def test_flood_waits_do_not_fail_group(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.init_group(-100, 'busy')
+    bot.bot_data['broadcast'] = {'message': 'hi', 'started_at': '', 'results': {}}
+    sender = FloodedBot({-100}, waits=5)
+    status = StatusMessage()
+    asyncio.run(bot.run_broadcast(sender, status))
+    assert sender.sent == [-100]
+    assert '✅ အောင်မြင်: 1' in status.text
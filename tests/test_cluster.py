@@ -0,0 +1,166 @@
+import asyncio
+import multiprocessing
+import time
+import types
+
+import pytest
+
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        pass
+
+
+class FakeApplication:
+    def __init__(self):
+        self.chat_data = {}
+        self.bot = FakeBot()
+        self.update_queue = asyncio.Queue()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, user, reply_to=None):
+        self.from_user = user
+        self.reply_to_message = reply_to
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def fake_user(user_id):
+    return types.SimpleNamespace(id=int(user_id), username=f'u{user_id}', first_name=f'U{user_id}')
+
+
+# First user id from 100 up that each worker owns
+def owned_ids(bot, workers):
+    return [next(str(i) for i in range(100, 1000) if bot.cluster_owner(i, workers) == w)
+            for w in range(workers)]
+
+
+def run_worker(index, inboxes, results):
+    import bot
+    bot.build_application = FakeApplication
+
+    # /givecoin from this worker's user to the other worker's user, started
+    # at the same moment on both workers
+    async def transfer(start_at, amount):
+        sender, receiver = owned_ids(bot, 2)[index], owned_ids(bot, 2)[1 - index]
+        bot.init_user(int(sender))
+        await asyncio.sleep(start_at - time.time())
+        message = FakeMessage(fake_user(sender), FakeMessage(fake_user(receiver)))
+        update = types.SimpleNamespace(effective_user=message.from_user, message=message)
+        context = types.SimpleNamespace(args=[str(amount)])
+        started = time.monotonic()
+        await bot.give_coin(update, context)
+        results.put((index, time.monotonic() - started, message.replies))
+
+    async def report():
+        results.put((index, bot.bot_data['users'][owned_ids(bot, 2)[index]]['balance']))
+
+    bot.CLUSTER_OPS.update(transfer=transfer, report=report)
+    bot.run_cluster_worker(index, inboxes)
+
+
+def test_opposite_transfers_across_workers(load_bot, monkeypatch):
+    load_bot(CLUSTER_TIMEOUT=5, CLUSTER_WORKERS=2, FLUSH_INTERVAL=0.05)
+    ctx = multiprocessing.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(2)]
+    results = ctx.Queue()
+    workers = [ctx.Process(target=run_worker, args=(i, inboxes, results)) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    try:
+        start_at = time.time() + 3
+        inboxes[0].put(('cast', 'transfer', (start_at, 100)))
+        inboxes[1].put(('cast', 'transfer', (start_at, 30)))
+        done = sorted(results.get(timeout=20) for _ in range(2))
+        for index, seconds, replies in done:
+            assert seconds < 2, f"worker {index} transfer took {seconds:.1f}s"
+            assert len(replies) == 1 and replies[0].startswith('✅'), replies
+        for inbox in inboxes:
+            inbox.put(('cast', 'report', ()))
+        assert sorted(results.get(timeout=10) for _ in range(2)) == [(0, 1000 - 100 + 30), (1, 1000 - 30 + 100)]
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        for worker in workers:
+            worker.join(10)
+            if worker.is_alive():
+                worker.kill()
+                pytest.fail("cluster worker did not stop")
+
+
+# Runs ops in this process as if user ids in remote lived on worker 1;
+# the first `lost` replies never arrive
+class LossyCluster:
+    index = 0
+
+    def __init__(self, bot, remote, lost=0, error=False):
+        self.bot, self.remote, self.lost, self.error = bot, remote, lost, error
+
+    def owner(self, entity_id):
+        return 1 if str(entity_id) in self.remote else 0
+
+    def owns(self, entity_id):
+        return self.owner(entity_id) == self.index
+
+    def replicate(self, keys):
+        pass
+
+    async def call(self, worker, op, *args):
+        if self.error:
+            raise self.bot.ClusterError(op)
+        result = await self.bot.CLUSTER_OPS[op](*args)
+        if self.lost:
+            self.lost -= 1
+            raise asyncio.TimeoutError
+        return result
+
+
+def give(bot, sender, receiver, amount):
+    message = FakeMessage(fake_user(sender), FakeMessage(fake_user(receiver)))
+    update = types.SimpleNamespace(effective_user=message.from_user, message=message)
+    asyncio.run(bot.give_coin(update, types.SimpleNamespace(args=[str(amount)])))
+    return message.replies
+
+
+# A credit whose reply is lost stays pending and is resent with the same
+# id, so it lands exactly once
+def test_unconfirmed_credit_is_retried_once(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.cluster = LossyCluster(bot, {'200'}, lost=2)
+    bot.init_user(100)
+    replies = give(bot, '100', '200', 300)
+    assert len(replies) == 1 and replies[0].startswith('⏳')
+    assert len(bot.bot_data['pending_credits']) == 1
+    asyncio.run(bot.retry_credits())
+    assert len(bot.bot_data['pending_credits']) == 1
+    asyncio.run(bot.retry_credits())
+    assert bot.bot_data['pending_credits'] == {}
+    assert bot.bot_data['users']['100']['balance'] == 700
+    assert bot.bot_data['users']['200']['balance'] == 1300
+    assert bot.storage.load()['pending_credits'] == {}
+
+
+def test_refused_credit_refunds_sender(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.cluster = LossyCluster(bot, {'200'}, error=True)
+    bot.init_user(100)
+    replies = give(bot, '100', '200', 300)
+    assert len(replies) == 1 and replies[0].startswith('❌')
+    assert bot.bot_data['pending_credits'] == {}
+    assert bot.bot_data['users']['100']['balance'] == 1000
+    assert '200' not in bot.bot_data['users']
@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+
+def alias_odds(engine):
+    n = len(engine.rarities)
+    odds = dict.fromkeys(engine.rarities, 0.0)
+    for i, rarity in enumerate(engine.rarities):
+        odds[rarity] += engine.prob[i] / n
+        odds[engine.rarities[engine.alias[i]]] += (1 - engine.prob[i]) / n
+    return odds
+
+
+def check_engine(bot, engine, cards):
+    for card_id, (rarity, i, j) in engine.position.items():
+        assert engine.ids[rarity][i] == card_id and engine.all_ids[j] == card_id
+    assert sorted(engine.all_ids) == sorted(cards)
+    for rarity in bot.RARITIES:
+        assert sorted(engine.ids[rarity]) == sorted(c for c, r in cards.items() if r == rarity)
+    assert engine.rarities == [r for r in bot.RARITIES if engine.ids[r]]
+    total = sum(bot.RARITIES[r]['drop_chance'] for r in engine.rarities)
+    for rarity, odds in alias_odds(engine).items():
+        assert odds == pytest.approx(bot.RARITIES[rarity]['drop_chance'] / total)
+
+
+# Swap-removes and re-adds keep positions, per-rarity ids and the alias
+# table the same as a rebuild from scratch
+def test_drop_engine_add_remove_consistency(load_bot):
+    bot = load_bot()
+    rng = random.Random(3)
+    rarities = list(bot.RARITIES)
+    engine = bot.DropEngine()
+    cards = {}
+    for _ in range(2000):
+        card_id = str(rng.randrange(40))
+        if card_id in cards and rng.random() < 0.5:
+            engine.remove(card_id)
+            del cards[card_id]
+        else:
+            cards[card_id] = rng.choice(rarities[:3] if rng.random() < 0.9 else rarities)
+            engine.add(card_id, cards[card_id])
+        check_engine(bot, engine, cards)
+    rebuilt = bot.DropEngine()
+    rebuilt.rebuild({card_id: {'rarity': rarity} for card_id, rarity in cards.items()})
+    assert alias_odds(rebuilt) == pytest.approx(alias_odds(engine))
+
+
+def test_drop_engine_picks_by_rarity_weight(load_bot, monkeypatch):
+    bot = load_bot()
+    engine = bot.DropEngine()
+    engine.rebuild({'1': {'rarity': 'Common'}, '2': {'rarity': 'Epic'}})
+    assert engine.pick() in ('1', '2')
+    rng = random.Random(5)
+    monkeypatch.setattr(bot.random, 'random', rng.random)
+    monkeypatch.setattr(bot.random, 'randrange', rng.randrange)
+    picks = [engine.pick() for _ in range(20000)]
+    chances = bot.RARITIES['Common']['drop_chance'], bot.RARITIES['Epic']['drop_chance']
+    assert picks.count('2') / len(picks) == pytest.approx(chances[1] / sum(chances), abs=0.02)
+    engine.remove('1')
+    engine.remove('2')
+    assert engine.pick() is None and engine.pick_any() is None
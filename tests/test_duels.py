@@ -0,0 +1,39 @@
+import asyncio
+import types
+
+
+# Challenges and queue entries nobody answers are swept without any
+# further duel activity
+def test_idle_duels_expire_in_background(load_bot):
+    bot = load_bot(DUEL_TIMEOUT=0.05, DUEL_SWEEP_INTERVAL=0.02, FLUSH_INTERVAL=0.01,
+                   LEDGER_RECONCILE_INTERVAL=0)
+
+    async def scenario():
+        application = types.SimpleNamespace(bot=None, chat_data={})
+        await bot.post_init(application)
+        duel_id = await bot.op_duel_challenge('-1', ['10', '11'], ['a', 'b'], ['Rare'])
+        await bot.op_duel_queue('-2', '12', 'c', ['Epic'])
+        assert duel_id in bot.bot_data['pending_duels'] and bot.duel_queues
+        await asyncio.sleep(0.2)
+        assert bot.bot_data['pending_duels'] == {} and bot.duel_queues == {}
+        await bot.post_shutdown(application)
+
+    asyncio.run(scenario())
+    assert bot.storage.load()['pending_duels'] == {}
+
+
+# Sweeps only pop due deadlines; a duel pushed back by a later move
+# outlives its first deadline, and ids are not reused
+def test_duel_deadlines(load_bot):
+    bot = load_bot(DUEL_TIMEOUT=10)
+    start = bot.time.time()
+    first = bot.new_duel('-1', ['10', '11'], ['a', 'b'], [['Rare'], []], 'open')
+    second = bot.new_duel('-1', ['12', '13'], ['c', 'd'], [['Rare'], []], 'open')
+    bot.extend_duel(first, start + 5)
+    asyncio.run(bot.op_duel_queue('-2', '14', 'e', ['Epic']))
+    assert bot.expire_duels(start + 10.5) == [('pending_duels', second)]
+    assert list(bot.bot_data['pending_duels']) == [first] and bot.duel_queues == {}
+    assert len(bot.duel_deadlines) == 1
+    assert bot.expire_duels(start + 16) == [('pending_duels', first)]
+    assert not bot.duel_deadlines and not bot.queue_deadlines
+    assert bot.new_duel('-1', ['10', '11'], ['a', 'b'], [['Rare'], []], 'open') == '3'
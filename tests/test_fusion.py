@@ -0,0 +1,22 @@
+CARD = {'movie': 'm', 'file_id': 'f', 'type': 'photo'}
+
+
+# Favorites are fused last, and one whose last copy is fused is no
+# longer listed as a favorite
+def test_fusion_drops_used_up_favorites(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0, FUSION_COST=3)
+    cards = bot.bot_data['cards']
+    for card_id, rarity in (('1', 'Common'), ('2', 'Common'), ('3', 'Common'), ('9', 'Rare')):
+        cards[card_id] = dict(CARD, name=card_id, rarity=rarity)
+    bot.rebuild_indexes()
+    bot.init_user(5)
+    for card_id, count in (('1', 2), ('2', 1), ('3', 1)):
+        bot.add_card('5', card_id, count)
+    user = bot.bot_data['users']['5']
+    user['favorite_cards'] = ['2', '3']
+
+    inputs = bot.fusion_inputs(user, 'Common')
+    assert inputs == ['1', '1', '2', '3']
+    assert bot.fuse('5', 'Common', inputs, 1) == ['9']
+    assert dict(user['cards']) == {'3': 1, '9': 1}
+    assert user['favorite_cards'] == ['3']
@@ -0,0 +1,60 @@
+import itertools
+import random
+from fractions import Fraction
+
+import pytest
+
+BET = 40
+
+
+# Single-spin payouts of the original /slots, /basket and /wheel
+def old_slots(a, b, c):
+    if a == b == c:
+        return BET * 10 if a == '7️⃣' else BET * 3
+    return -BET
+
+
+def old_basket(roll):
+    return BET * 2 if roll < 50 else -BET
+
+
+def old_wheel(multiplier):
+    return -BET if multiplier == 0 else int(BET * multiplier) - BET
+
+
+def old_outcomes(bot):
+    return {
+        'slots': [old_slots(*draw) for draw in itertools.product(bot.SLOT_SYMBOLS, repeat=3)],
+        'basket': [old_basket(roll) for roll in range(101)],
+        'wheel': [old_wheel(m) for m in bot.WHEEL_MULTIPLIERS],
+    }
+
+
+# Every equally likely draw pays what the single-spin command paid, so a
+# batch of spins has the same expected value per spin
+def test_spin_payouts_match_single_spins(load_bot, monkeypatch):
+    bot = load_bot()
+    draws = {
+        'slots': [list(d) for d in itertools.product(bot.SLOT_SYMBOLS, repeat=3)],
+        'basket': [[roll] for roll in range(101)],
+        'wheel': [[m] for m in bot.WHEEL_MULTIPLIERS],
+    }
+    expected = old_outcomes(bot)
+    for game, game_draws in draws.items():
+        batch = [value for draw in game_draws for value in draw]
+        monkeypatch.setattr(bot.random, 'choices', lambda population, k: batch[:k])
+        assert bot.spin_deltas(game, BET, len(game_draws)) == expected[game]
+    evs = {game: Fraction(sum(values), len(values)) for game, values in expected.items()}
+    assert evs == {'slots': Fraction(-BET * 98, 125), 'basket': Fraction(BET * 49, 101),
+                   'wheel': Fraction(BET * 23, 8) - BET}
+
+
+def test_spin_sample_mean_is_close_to_ev(load_bot):
+    bot = load_bot()
+    random.seed(11)
+    for game, values in old_outcomes(bot).items():
+        ev = sum(values) / len(values)
+        deltas = bot.spin_deltas(game, BET, 200000)
+        assert len(deltas) == 200000 and set(deltas) <= set(values)
+        spread = (sum((v - ev) ** 2 for v in values) / len(values)) ** 0.5
+        assert sum(deltas) / len(deltas) == pytest.approx(ev, abs=5 * spread / 200000 ** 0.5)
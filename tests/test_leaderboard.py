@@ -0,0 +1,22 @@
+import random
+
+
+# Bucket splits and removals keep the same order as one sorted list
+def test_bucketed_leaderboard_matches_sorted_list(load_bot, monkeypatch):
+    bot = load_bot()
+    monkeypatch.setattr(bot.Leaderboard, 'BUCKET_SIZE', 4)
+    rng = random.Random(1)
+    totals = {str(uid): rng.randrange(0, 20) for uid in range(60)}
+    board = bot.Leaderboard()
+    board.rebuild(dict(totals))
+    for _ in range(3000):
+        uid = str(rng.randrange(80))
+        totals[uid] = rng.randrange(0, 30)
+        board.update(uid, totals[uid])
+    expected = sorted((-total, uid) for uid, total in totals.items() if total > 0)
+    assert len(board) == len(expected)
+    assert board.entries(0, len(expected)) == expected
+    assert board.entries(7, 23) == expected[7:23]
+    assert board.page(3, 10) == [(uid, -neg) for neg, uid in expected[20:30]]
+    assert board.pages(10) == (len(expected) + 9) // 10
+    assert all(0 < len(bucket) <= 8 for bucket in board.buckets)
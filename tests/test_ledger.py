@@ -0,0 +1,54 @@
+import asyncio
+
+
+# Balances are the last checkpoint plus the entries after it, and every
+# ledger sums to zero
+def test_ledger_checkpoint(load_bot):
+    bot = load_bot(LEDGER_CHECKPOINT_ENTRIES=6)
+    ledger = bot.CoinLedger()
+    ledger.post('5', 1000, 'signup')
+    ledger.post('6', 1000, 'signup')
+    ledger.write(ledger.take())
+    assert ledger.checkpoint_id() == 0 and ledger.unchecked == 4
+    ledger.post('5', -300, 'transfer', '6')
+    ledger.post('6', 300, 'transfer', '5')
+    ledger.write(ledger.take())
+    assert ledger.checkpoint_id() == 8 and ledger.unchecked == 0
+    ledger.post('5', 50, 'daily')
+    ledger.write(ledger.take())
+    assert ledger.balance('5') == 750 and ledger.balance('6') == 1300
+    balances = ledger.balances()
+    assert balances[5] == 750 and balances[6] == 1300 and sum(balances.values()) == 0
+    assert [entry[1:3] for entry in ledger.history('5')] == [(50, 'daily'), (-300, 'transfer'), (1000, 'signup')]
+    # A reopened ledger counts the entries after its last checkpoint
+    assert bot.CoinLedger().balance('5') == 750
+    reopened = bot.CoinLedger()
+    reopened.connect()
+    assert reopened.unchecked == 2
+
+
+# A crash between the ledger write and the balance write (either order)
+# is put right by 'adjust' entries on the next load
+def test_ledger_reconciles_after_crash(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0, LEDGER_CHECKPOINT_ENTRIES=3, LEDGER_RECONCILE_INTERVAL=0)
+    bot.load_data()
+    bot.init_user(5)
+    bot.init_user(6)
+    # Balance saved, ledger entries lost
+    bot.add_coins('6', 70, 'daily')
+    bot.ledger.take()
+    bot.save_data(('users', '6'))
+    # Ledger written, balance change never saved
+    bot.add_coins('5', 50, 'daily')
+    bot.ledger.write(bot.ledger.take())
+
+    bot = load_bot(FLUSH_INTERVAL=0, LEDGER_CHECKPOINT_ENTRIES=3, LEDGER_RECONCILE_INTERVAL=0)
+    bot.load_data()
+    assert bot.bot_data['users']['5']['balance'] == 1000
+    assert bot.bot_data['users']['6']['balance'] == 1070
+    report = asyncio.run(bot.reconcile_ledger())
+    assert report['mismatches'] == {} and report['total'] == 0 and report['missing'] == 0
+    assert bot.ledger.balance('5') == 1000 and bot.ledger.balance('6') == 1070
+    assert bot.ledger.history('5', 1)[0][1:3] == (-50, 'adjust')
+    assert bot.ledger.history('6', 1)[0][1:3] == (70, 'adjust')
+    assert bot.ledger.checkpoint_id() > 0
@@ -0,0 +1,46 @@
+import random
+
+
+def levenshtein(a, b):
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+# The banded check agrees with the full edit distance table
+def test_within_edits_matches_levenshtein(load_bot):
+    bot = load_bot()
+    rng = random.Random(7)
+    for _ in range(3000):
+        a = ''.join(rng.choice('abc') for _ in range(rng.randrange(9)))
+        b = ''.join(rng.choice('abc') for _ in range(rng.randrange(9)))
+        for k in range(4):
+            assert bot.within_edits(a, b, k) == (levenshtein(a, b) <= k), (a, b, k)
+
+
+def catch(bot, guess, name):
+    return bot.names_match(bot.normalize_name(guess), bot.normalize_name(name))
+
+
+def test_names_match_normalises_and_allows_typos(load_bot):
+    bot = load_bot(CATCH_MAX_EDITS=2)
+    # Decomposed vs composed accents (NFC), case and spacing
+    assert catch(bot, 'Cafe\u0301  NOIR ', 'caf\u00e9 noir')
+    # Zero-width space and non-joiner (Cf) inside Burmese text
+    assert catch(bot, '\u1019\u200b\u1004\u103a\u200c\u1002\u101c\u102c', '\u1019\u1004\u103a\u1002\u101c\u102c')
+    assert bot.normalize_name('a\u200db') == 'ab'
+    # Short names must be exact; 4-7 characters allow one typo, 8+ two
+    assert catch(bot, 'kid', 'kid') and not catch(bot, 'kit', 'kid')
+    assert catch(bot, 'narto', 'naruto') and not catch(bot, 'nrto', 'naruto')
+    assert catch(bot, 'sasuke uciha', 'sasuke uchiha') and catch(bot, 'sasuk uciha', 'sasuke uchiha')
+    assert not catch(bot, 'sask uciha', 'sasuke uchiha')
+
+
+def test_names_match_honours_max_edits(load_bot):
+    bot = load_bot(CATCH_MAX_EDITS=0)
+    assert catch(bot, 'sasuke uchiha', 'Sasuke Uchiha')
+    assert not catch(bot, 'sasuke uciha', 'sasuke uchiha')
@@ -0,0 +1,73 @@
+import asyncio
+import types
+
+
+def test_card_inventory_matches_only_canonical_ids(load_bot):
+    bot = load_bot()
+    cards = bot.CardInventory({'1': 2, '10': 1})
+    assert '1' in cards and cards['10'] == 1
+    for key in ('01', ' 1', '1 ', '-1', '١'):
+        assert key not in cards
+    assert type(bot.pack_cards({'01': 1})) is dict
+
+
+def test_add_card_with_non_numeric_id(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.bot_data['cards']['abc'] = {'name': 'a', 'movie': 'm', 'rarity': 'Rare', 'file_id': 'f', 'type': 'photo'}
+    bot.init_user(5)
+    bot.add_card('5', '1')
+    bot.add_card('5', 'abc', 2)
+    user = bot.bot_data['users']['5']
+    assert dict(user['cards']) == {'1': 1, 'abc': 2}
+    assert user['total_cards'] == 3
+
+
+def test_add_card_below_zero(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.init_user(5)
+    bot.add_card('5', '1', 2)
+    bot.add_card('5', '2')
+    bot.bot_data['users']['5']['favorite_cards'] = ['1']
+    bot.add_card('5', '1', -3)
+    bot.add_card('5', '3', -1)
+    user = bot.bot_data['users']['5']
+    assert isinstance(user['cards'], bot.CardInventory)
+    assert dict(user['cards']) == {'2': 1}
+    assert user['total_cards'] == 1
+    assert user['favorite_cards'] == []
+
+
+def test_favorite_stores_canonical_id(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.bot_data['cards']['1'] = {'name': 'a', 'movie': 'm', 'rarity': 'Rare', 'file_id': 'f', 'type': 'photo'}
+    bot.init_user(5)
+    bot.add_card('5', '1')
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    user = types.SimpleNamespace(id=5, username='u5')
+    update = types.SimpleNamespace(effective_user=user, message=types.SimpleNamespace(reply_text=reply_text))
+    asyncio.run(bot.set_favorite(update, types.SimpleNamespace(args=['01'])))
+    asyncio.run(bot.set_favorite(update, types.SimpleNamespace(args=['1'])))
+    assert bot.bot_data['users']['5']['favorite_cards'] == ['1']
+    asyncio.run(bot.remove_favorite(update, types.SimpleNamespace(args=['001'])))
+    assert bot.bot_data['users']['5']['favorite_cards'] == []
+    assert replies[0].startswith('✅') and replies[1].startswith('❌') and replies[2].startswith('✅')
+
+
+def test_binary_snapshot_round_trip(load_bot, tmp_path):
+    bot = load_bot()
+    data = bot.empty_data()
+    data['users'] = {
+        '1': {'username': 'a', 'balance': 5, 'cards': {'3': 2, '10': 1}, 'titles': [], 'last_daily': None, 'x': 1},
+        '2': {'username': 'b', 'balance': 0, 'cards': {'01': 1}, 'favorite_cards': ['01']},
+    }
+    path = str(tmp_path / 'snapshot.bin')
+    bot.write_snapshot_file(path, data)
+    loaded = bot.read_snapshot_file(path)
+    assert loaded == data
+    assert isinstance(loaded['users']['1'], bot.UserRecord)
+    assert isinstance(loaded['users']['1']['cards'], bot.CardInventory)
+    assert type(loaded['users']['2']['cards']) is dict
@@ -0,0 +1,83 @@
+import asyncio
+import os
+
+
+# Importing the module must not move, create or open any data file
+def test_import_leaves_working_directory_alone(load_bot, tmp_path):
+    (tmp_path / 'bot_data.json').write_text('{}')
+    bot = load_bot()
+    assert sorted(os.listdir(tmp_path)) == ['bot_data.json']
+    assert bot.storage is None
+    bot.load_data()
+    assert os.path.exists(tmp_path / 'data' / 'bot_data.json')
+    assert not os.path.exists(tmp_path / 'bot_data.json')
+
+
+def journal_data(bot):
+    data = bot.empty_data()
+    data['cards']['1'] = {'name': 'a', 'movie': 'm', 'rarity': 'Rare', 'file_id': 'f', 'type': 'photo'}
+    data['users']['5'] = {'username': 'u', 'balance': 10, 'cards': {'1': 1}}
+    return data
+
+
+# Changes after the snapshot are replayed from the journal on load and
+# then folded into a new snapshot; a torn last line is ignored
+def test_journal_replay(load_bot, tmp_path):
+    bot = load_bot(STORAGE_MODE='journal')
+    storage = bot.create_storage()
+    data = journal_data(bot)
+    storage.save(data, ())
+    data['users']['5']['balance'] = 20
+    data['groups']['-1'] = {'title': 'g', 'message_count': 3, 'last_drop': None}
+    del data['cards']['1']
+    storage.save(data, (('users', '5'), ('groups', '-1'), ('cards', '1')))
+    storage.write_records([{'s': 'sudo_users', 'v': [7]}])
+    storage.close_journal()
+    with open(bot.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"s": "users", "k": "5", "v": {"bal')
+    data['sudo_users'] = [7]
+
+    loaded = bot.create_storage().load()
+    assert dict(loaded['users']['5']) == dict(data['users']['5'])
+    assert {k: v for k, v in loaded.items() if k != 'users'} == {k: v for k, v in data.items() if k != 'users'}
+    assert not os.path.exists(bot.JOURNAL_FILE)
+    assert bot.create_storage().load()['users']['5']['balance'] == 20
+
+
+# After JOURNAL_COMPACT_RECORDS records the journal becomes a snapshot
+def test_journal_compaction(load_bot):
+    bot = load_bot(STORAGE_MODE='journal', JOURNAL_COMPACT_RECORDS=3)
+    storage = bot.create_storage()
+    data = journal_data(bot)
+    storage.save(data, ())
+    for balance in (11, 12):
+        data['users']['5']['balance'] = balance
+        storage.save(data, (('users', '5'),))
+    assert storage.records == 2 and os.path.exists(bot.JOURNAL_FILE)
+    data['users']['5']['balance'] = 13
+    storage.save(data, (('users', '5'),))
+    assert storage.records == 0 and not os.path.exists(bot.JOURNAL_FILE)
+    for balance in (14, 15, 16):
+        storage.write_records([{'s': 'users', 'k': '5', 'v': dict(data['users']['5'], balance=balance)}])
+    assert storage.records == 0 and not os.path.exists(bot.JOURNAL_FILE)
+    assert bot.read_snapshot_file(bot.DATA_FILE)['users']['5']['balance'] == 16
+
+
+# add_coins marks the user changed; the next flush writes it even if the
+# handler never calls save_data()
+def test_flush_writes_touched_records(load_bot):
+    bot = load_bot(STORAGE_MODE='sqlite', FLUSH_INTERVAL=60)
+    bot.load_data()
+
+    async def scenario():
+        await bot.flusher.start()
+        bot.init_user(100)
+        bot.save_data(('users', '100'))
+        bot.flusher.flush()
+        bot.add_coins('100', 50, 'daily')
+        bot.flusher.flush()
+        await bot.flusher.stop()
+
+    asyncio.run(scenario())
+    assert bot.flusher.dirty == set()
+    assert bot.create_storage('sqlite').load()['users']['100']['balance'] == 1050
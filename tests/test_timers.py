@@ -0,0 +1,29 @@
+# Ticks until each value comes due, including delays longer than a lap
+def test_timer_wheel_schedule_cancel_expire(load_bot):
+    bot = load_bot()
+    wheel = bot.TimerWheel(1.0, 8)
+    wheel.schedule('a', 3, 'A')
+    wheel.schedule('b', 0.2, 'B')
+    wheel.schedule('c', 20, 'C')
+    wheel.schedule('d', 5, 'D')
+    wheel.schedule('e', 8, 'E')
+    assert len(wheel) == 5
+    wheel.cancel('d')
+    wheel.cancel('missing')
+    # Rescheduling replaces the old entry
+    wheel.schedule('e', 2, 'E2')
+    due = {tick: wheel.advance() for tick in range(1, 25)}
+    assert {tick: values for tick, values in due.items() if values} == {1: ['B'], 2: ['E2'], 3: ['A'], 20: ['C']}
+    assert len(wheel) == 0 and wheel.where == {}
+
+
+# An expired drop leaves its chat, while a newer drop there is kept
+def test_expire_drop_only_removes_its_own_drop(load_bot):
+    bot = load_bot()
+    old, new = {'chat_id': 1}, {'chat_id': 1}
+    chat_data = {'last_drop': new}
+    bot.expire_drop(chat_data, old)
+    assert chat_data == {'last_drop': new}
+    bot.expire_drop(chat_data, new)
+    assert chat_data == {}
+    assert bot.expired_drops.qsize() == 2
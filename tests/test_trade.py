@@ -0,0 +1,196 @@
+import asyncio
+import types
+
+CARDS = {
+    '1': {'name': 'A', 'movie': 'm', 'rarity': 'Rare', 'file_id': 'f', 'type': 'photo'},
+    '2': {'name': 'B', 'movie': 'm', 'rarity': 'Rare', 'file_id': 'f', 'type': 'photo'},
+    '3': {'name': 'C', 'movie': 'm', 'rarity': 'Epic', 'file_id': 'f', 'type': 'photo'},
+}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def load_market(load_bot):
+    bot = load_bot(FLUSH_INTERVAL=0)
+    bot.bot_data['cards'].update(CARDS)
+    bot.rebuild_indexes()
+    return bot
+
+
+def trade(bot, user_id, *args, fake_bot=None):
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    user = types.SimpleNamespace(id=int(user_id), username=f'u{user_id}', first_name=f'U{user_id}')
+    update = types.SimpleNamespace(effective_user=user, message=types.SimpleNamespace(reply_text=reply_text))
+    context = types.SimpleNamespace(args=list(args), bot=fake_bot or FakeBot())
+    asyncio.run(bot.trade(update, context))
+    assert len(replies) == 1
+    return replies[0]
+
+
+def holdings(bot, user_id):
+    user = bot.bot_data['users'][user_id]
+    return user['balance'], dict(user['cards'])
+
+
+def test_buy_fills_cheapest_ask_and_returns_overbid(load_bot):
+    bot = load_market(load_bot)
+    for seller in ('10', '11'):
+        bot.init_user(int(seller))
+        bot.add_card(seller, '1')
+    assert trade(bot, '10', 'sell', '1', '150').startswith('✅ Offer')
+    assert trade(bot, '11', 'sell', '1', '100').startswith('✅ Offer')
+    # Cards are in escrow while listed
+    assert holdings(bot, '10') == (1000, {}) and holdings(bot, '11') == (1000, {})
+    assert trade(bot, '12', 'buy', '1', '90').startswith('✅ Offer')
+    assert holdings(bot, '12') == (910, {})
+    assert trade(bot, '13', 'buy', '1', '120').startswith('✅ Trade')
+    assert holdings(bot, '13') == (900, {'1': 1})
+    assert holdings(bot, '11') == (1100, {})
+    assert len(bot.trade_book.offers) == 2
+
+
+def test_own_offers_never_match(load_bot):
+    bot = load_market(load_bot)
+    bot.init_user(10)
+    bot.add_card('10', '1')
+    trade(bot, '10', 'sell', '1', '100')
+    assert trade(bot, '10', 'buy', '1', '200').startswith('✅ Offer')
+    assert len(bot.trade_book.offers) == 2
+
+
+def test_swap_by_rarity(load_bot):
+    bot = load_market(load_bot)
+    bot.init_user(10)
+    bot.add_card('10', '1')
+    bot.init_user(11)
+    bot.add_card('11', '3')
+    assert trade(bot, '10', 'swap', '1', 'epic').startswith('✅ Offer')
+    assert trade(bot, '11', 'swap', '3', '1').startswith('✅ Trade')
+    assert holdings(bot, '10') == (1000, {'3': 1})
+    assert holdings(bot, '11') == (1000, {'1': 1})
+    assert bot.trade_book.offers == {}
+
+
+def test_cancel_and_expiry_refund_escrow(load_bot):
+    bot = load_market(load_bot)
+    bot.init_user(10)
+    bot.add_card('10', '1')
+    trade(bot, '10', 'sell', '1', '100')
+    trade(bot, '10', 'buy', '2', '300')
+    assert holdings(bot, '10') == (700, {})
+    (sell_id,) = [oid for oid, offer in bot.trade_book.offers.items() if offer['kind'] == 'sell']
+    assert trade(bot, '11', 'cancel', sell_id).startswith('❌')
+    assert trade(bot, '10', 'cancel', sell_id).startswith('✅')
+    assert holdings(bot, '10') == (700, {'1': 1})
+    bot.expire_trades(bot.time.time() + bot.TRADE_OFFER_HOURS * 3600 + 1)
+    assert holdings(bot, '10') == (1000, {'1': 1})
+    assert bot.trade_book.offers == {}
+    assert bot.storage.load()['pending_trades'] == {}
+
+
+# Worker 0's reply to the first attempt is lost
+class LossyCentral:
+    index = 1
+
+    def __init__(self, bot, lost):
+        self.bot, self.lost = bot, lost
+
+    def owns(self, entity_id):
+        return True
+
+    def replicate(self, keys):
+        pass
+
+    async def call(self, worker, op, *args):
+        result = await self.bot.CLUSTER_OPS[op](*args)
+        if self.lost:
+            self.lost -= 1
+            raise asyncio.TimeoutError
+        return result
+
+
+def test_unconfirmed_offer_is_placed_once(load_bot):
+    bot = load_market(load_bot)
+    bot.cluster = LossyCentral(bot, lost=0)
+    bot.init_user(10)
+    bot.add_card('10', '1')
+    bot.init_user(11)
+    trade(bot, '11', 'buy', '1', '100')
+    bot.cluster.lost = 1
+    assert trade(bot, '10', 'sell', '1', '100').startswith('⏳')
+    assert len(bot.bot_data['pending_offers']) == 1
+    fake_bot = FakeBot()
+    asyncio.run(bot.retry_offers(fake_bot))
+    assert bot.bot_data['pending_offers'] == {}
+    assert holdings(bot, '10') == (1100, {})
+    assert holdings(bot, '11') == (900, {'1': 1})
+    assert [chat_id for chat_id, _ in fake_bot.sent] == [11]
+    assert bot.trade_book.offers == {}
+
+
+def test_refused_offer_refunds_escrow(load_bot):
+    bot = load_market(load_bot)
+
+    async def refuse(offer):
+        raise bot.ClusterError('trade_place')
+
+    bot.CLUSTER_OPS['trade_place'] = refuse
+    bot.init_user(10)
+    assert trade(bot, '10', 'buy', '1', '100').startswith('❌')
+    assert holdings(bot, '10') == (1000, {})
+    assert bot.bot_data['pending_offers'] == {}
+
+
+# Worker 0 with the users in remote on worker 1; ops still run in this
+# process, and the first `lost` credit replies never arrive
+class RemoteUsers:
+    index = 0
+
+    def __init__(self, bot, remote, lost):
+        self.bot, self.remote, self.lost = bot, remote, lost
+
+    def owner(self, entity_id):
+        return 1 if str(entity_id) in self.remote else 0
+
+    def owns(self, entity_id):
+        return self.owner(entity_id) == self.index
+
+    def replicate(self, keys):
+        pass
+
+    async def call(self, worker, op, *args):
+        result = await self.bot.CLUSTER_OPS[op](*args)
+        if op == 'credit_user' and self.lost:
+            self.lost -= 1
+            raise asyncio.TimeoutError
+        return result
+
+
+# A fill for another worker's user is saved as a pending credit and
+# retried until confirmed, landing once
+def test_remote_delivery_is_retried_once(load_bot):
+    bot = load_market(load_bot)
+    bot.cluster = RemoteUsers(bot, {'11'}, lost=0)
+    bot.init_user(10)
+    bot.add_card('10', '1')
+    bot.init_user(11)
+    trade(bot, '11', 'buy', '1', '100')
+    bot.cluster.lost = 2
+    assert trade(bot, '10', 'sell', '1', '100').startswith('✅ Trade')
+    assert len(bot.bot_data['pending_credits']) == 1
+    assert bot.storage.load()['pending_credits'] == bot.bot_data['pending_credits']
+    for _ in range(2):
+        asyncio.run(bot.retry_credits())
+    assert bot.bot_data['pending_credits'] == {}
+    assert holdings(bot, '10') == (1100, {})
+    assert holdings(bot, '11') == (900, {'1': 1})
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+import time
+
+CARD = {'name': 'A', 'movie': 'm', 'rarity': 'Epic', 'file_id': 'f', 'type': 'photo'}
+
+
+# A handler changes a user, awaits (a reply, a cluster call) and only then
+# calls save_data(); other users evict it from the cache in between
+def test_change_survives_eviction_before_save(load_bot):
+    bot = load_bot(STORAGE_MODE='sqlite', USER_CACHE_SIZE=5, FLUSH_INTERVAL=0.01)
+    bot.load_data()
+    bot.bot_data['cards'] = {'1': CARD}
+    bot.rebuild_indexes()
+
+    async def scenario():
+        await bot.flusher.start()
+        for user_id in range(100, 120):
+            bot.init_user(user_id)
+        bot.add_coins('101', -500, 'trade')
+        bot.add_card('101', '1')
+        for user_id in map(str, range(102, 115)):
+            bot.add_coins(user_id, 1, 'daily')
+            bot.save_data(('users', user_id))
+        assert '101' not in bot.bot_data['users'].records
+        await asyncio.sleep(0.05)
+        for user_id in map(str, range(102, 115)):
+            bot.bot_data['users'][user_id]
+        await asyncio.sleep(0.05)
+        bot.save_data(('users', '101'))
+        report = await bot.reconcile_ledger()
+        await bot.flusher.stop()
+        return report
+
+    report = asyncio.run(scenario())
+    assert report['mismatches'] == {}
+    user = bot.create_storage('sqlite').load_user('101')
+    assert user['balance'] == 500
+    assert dict(user['cards']) == {'1': 1}
+
+
+# Misses read on their own connection while the writer thread is busy,
+# and a user whose write is still queued comes from the flusher's copy
+def test_miss_does_not_wait_for_queued_writes(load_bot):
+    bot = load_bot(STORAGE_MODE='sqlite', USER_CACHE_SIZE=2, FLUSH_INTERVAL=60)
+    bot.load_data()
+    gate = threading.Event()
+
+    async def scenario():
+        await bot.flusher.start()
+        for user_id in range(100, 103):
+            bot.init_user(user_id)
+            bot.save_data(('users', str(user_id)))
+        bot.flusher.flush()
+        balance = bot.bot_data['users']['100']['balance']
+        bot.flusher.executor.submit(gate.wait, 5)
+        bot.add_coins('100', 50, 'daily')
+        bot.save_data(('users', '100'))
+        bot.flusher.flush()
+        start = time.perf_counter()
+        bot.bot_data['users']['101']
+        bot.bot_data['users']['102']
+        assert '100' not in bot.bot_data['users'].records
+        user = bot.bot_data['users']['100']
+        elapsed = time.perf_counter() - start
+        gate.set()
+        await bot.flusher.stop()
+        return balance, user['balance'], elapsed
+
+    balance, now, elapsed = asyncio.run(scenario())
+    assert now == balance + 50
+    assert elapsed < 1
+    assert bot.create_storage('sqlite').load_user('100')['balance'] == balance + 50